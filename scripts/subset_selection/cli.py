@@ -7,6 +7,7 @@ import argparse
 import sys
 
 from .subset_selection import subset_datasets
+from .utils.subset_selection_utils import TerminationRequested
 
 
 def parse_args():
@@ -43,6 +44,13 @@ def parse_args():
         default=100000,
         help="Batch size for processing (default: 100000)",
     )
+    parser.add_argument(
+        "--prefetch-batches",
+        type=int,
+        default=None,
+        help="Batches tokenized on a background thread ahead of the encoder "
+        "(default: 2, 0 tokenizes and encodes serially)",
+    )
     parser.add_argument(
         "--num-folds",
         type=int,
@@ -55,6 +63,67 @@ def parse_args():
         default=160.0,
         help="Epsilon parameter for optimization (default: 160.0 for large datasets, use 0.1-1.0 for small)",
     )
+    parser.add_argument(
+        "--optimizer-backend",
+        type=str,
+        default="submodlib",
+        choices=["submodlib", "torch"],
+        help="Facility location maximizer: submodlib on the CPU, or batched stochastic "
+        "greedy in torch on the fold's device (default: submodlib)",
+    )
+    parser.add_argument(
+        "--similarity-mode",
+        type=str,
+        default="dense",
+        choices=["dense", "sparse", "ann", "streaming"],
+        help="Facility location kernel: dense n x n matrix per fold, exact sparse top-k "
+        "neighbours, approximate top-k neighbours from an ANN index, or similarities "
+        "recomputed from the embeddings at every step with --optimizer-backend torch "
+        "(default: dense)",
+    )
+    parser.add_argument(
+        "--num-neighbors",
+        type=int,
+        default=None,
+        help="Neighbours kept per example with --similarity-mode sparse or ann (default: 100)",
+    )
+    parser.add_argument(
+        "--ann-backend",
+        type=str,
+        default="hnswlib",
+        choices=["hnswlib", "faiss"],
+        help="ANN index of --similarity-mode ann: hnswlib (HNSW) or faiss (IVF-Flat) (default: hnswlib)",
+    )
+    parser.add_argument(
+        "--ann-m",
+        type=int,
+        default=None,
+        help="Links per node of the HNSW graph (default: 32)",
+    )
+    parser.add_argument(
+        "--ann-ef-construction",
+        type=int,
+        default=None,
+        help="Candidate list size while building the HNSW graph (default: 200)",
+    )
+    parser.add_argument(
+        "--ann-ef-search",
+        type=int,
+        default=None,
+        help="Candidate list size of HNSW queries, higher is more accurate (default: 200)",
+    )
+    parser.add_argument(
+        "--ann-nlist",
+        type=int,
+        default=None,
+        help="Inverted lists of the faiss IVF index (default: 4 * sqrt(fold size))",
+    )
+    parser.add_argument(
+        "--ann-nprobe",
+        type=int,
+        default=None,
+        help="Inverted lists searched per faiss query, higher is more accurate (default: 32)",
+    )
     parser.add_argument(
         "--num-gpus",
         type=int,
@@ -66,16 +135,82 @@ def parse_args():
         action="store_true",
         help="Combine multiple input files before processing",
     )
+    parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        help="Collapse identical rendered texts and weight them by their count during selection",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only encode rows missing from existing embeddings and append them to the store",
+    )
+    parser.add_argument(
+        "--virtual-merge",
+        action="store_true",
+        help="Merge per-device shard files into a virtual embeddings.h5 instead of copying "
+        "them; the shard files must then be kept next to it",
+    )
+    parser.add_argument(
+        "--no-persistent-workers",
+        action="store_true",
+        help="Start new encoder workers for every input file instead of reusing them for the whole run",
+    )
+    parser.add_argument(
+        "--file-bundle-rows",
+        type=int,
+        default=None,
+        help="Encode input files with fewer rows than this together (default: 50000, 0 disables)",
+    )
+    parser.add_argument(
+        "--encode-block-rows",
+        type=int,
+        default=None,
+        help="Rows per work block that encoder devices pull from a shared queue "
+        "(default: 8192, 0 gives every device one contiguous shard)",
+    )
     parser.add_argument(
         "--testing-mode",
         action="store_true",
         help="Enable testing mode (allows CPU usage, for testing only)",
     )
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Run on CPU worker processes in production (no GPU required)",
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        default=None,
+        help="Number of CPU worker processes with --cpu (default: derived from available cores)",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="Intra-op threads per CPU worker with --cpu (default: derived from available cores)",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Run as one rank of a torchrun launch (gloo backend with --cpu, nccl otherwise)",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Run the encoder under bfloat16 autocast",
+    )
+    parser.add_argument(
+        "--quantize-int8",
+        action="store_true",
+        help="Apply dynamic int8 quantization to the encoder's linear layers (CPU only)",
+    )
     parser.add_argument(
         "--encoder-type",
         type=str,
         default="arctic",
-        help="Encoder type to use (default: arctic)",
+        help="Encoder type to use: arctic or onnx (default: arctic)",
     )
     parser.add_argument(
         "--encoder-model",
@@ -83,6 +218,73 @@ def parse_args():
         default="Snowflake/snowflake-arctic-embed-l-v2.0",
         help="Encoder model name (default: Snowflake/snowflake-arctic-embed-l-v2.0)",
     )
+    parser.add_argument(
+        "--max-tokens-per-batch",
+        type=int,
+        default=None,
+        help="Padded-token budget per encoder forward pass (default: fixed model batch size)",
+    )
+    parser.add_argument(
+        "--output-dim",
+        type=int,
+        default=None,
+        help="Reduce embeddings to this dimension before storing them (default: full dimension)",
+    )
+    parser.add_argument(
+        "--projection",
+        type=str,
+        default="truncate",
+        help="Reduction to --output-dim: truncate (Matryoshka prefix), random, or the path "
+        "of a fitted projection .npz file (default: truncate)",
+    )
+    parser.add_argument(
+        "--max-length",
+        type=int,
+        default=None,
+        help="Cap on the tokens per input (default: model maximum, 4096 for Arctic embed)",
+    )
+    parser.add_argument(
+        "--truncation",
+        type=str,
+        default="head",
+        choices=["head", "tail", "head+tail"],
+        help="Which part of inputs longer than --max-length to keep (default: head)",
+    )
+    parser.add_argument(
+        "--profile-token-lengths",
+        action="store_true",
+        help="Write a token length and padding waste report next to the embeddings",
+    )
+    parser.add_argument(
+        "--profile-only",
+        action="store_true",
+        help="Only write the token length report, skipping encoding and subset selection",
+    )
+    parser.add_argument(
+        "--storage-precision",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "bfloat16", "int8"],
+        help="Precision of the stored embeddings (default: float32)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory of a persistent embedding cache reused across runs (default: disabled)",
+    )
+    parser.add_argument(
+        "--cache-max-size-gb",
+        type=float,
+        default=None,
+        help="Evict least recently used cache entries beyond this size (default: unbounded)",
+    )
+    parser.add_argument(
+        "--render-num-proc",
+        type=int,
+        default=None,
+        help="Number of processes rendering templates (default: one per 50k rows, up to the core count)",
+    )
     parser.add_argument(
         "--template-name",
         type=str,
@@ -126,25 +328,72 @@ def main():
         "batch_size": args.batch_size,
         "num_folds": args.num_folds,
         "epsilon": args.epsilon,
+        "optimizer_backend": args.optimizer_backend,
+        "similarity_mode": args.similarity_mode,
+        "ann_backend": args.ann_backend,
         "combine_files": args.combine_files,
+        "deduplicate": args.deduplicate,
+        "incremental": args.incremental,
+        "virtual_merge": args.virtual_merge,
+        "persistent_workers": not args.no_persistent_workers,
         "encoder_type": args.encoder_type,
         "encoder_model": args.encoder_model,
+        "projection": args.projection,
+        "truncation": args.truncation,
+        "profile_token_lengths": args.profile_token_lengths,
+        "profile_only": args.profile_only,
+        "distributed": args.distributed,
+        "storage_precision": args.storage_precision,
+        "use_bf16": args.bf16,
+        "quantize_int8": args.quantize_int8,
         "template_name": args.template_name,
         "seed": args.seed,
     }
     
     if args.num_gpus is not None:
         kwargs["num_gpus"] = args.num_gpus
+    if args.cpu_workers is not None:
+        kwargs["cpu_workers"] = args.cpu_workers
+    if args.threads_per_worker is not None:
+        kwargs["threads_per_worker"] = args.threads_per_worker
+    if args.num_neighbors is not None:
+        kwargs["num_neighbors"] = args.num_neighbors
+    for name in ("ann_m", "ann_ef_construction", "ann_ef_search", "ann_nlist", "ann_nprobe"):
+        if getattr(args, name) is not None:
+            kwargs[name] = getattr(args, name)
+    if args.prefetch_batches is not None:
+        kwargs["prefetch_batches"] = args.prefetch_batches
+    if args.file_bundle_rows is not None:
+        kwargs["file_bundle_rows"] = args.file_bundle_rows
+    if args.encode_block_rows is not None:
+        kwargs["encode_block_rows"] = args.encode_block_rows
+    if args.render_num_proc is not None:
+        kwargs["render_num_proc"] = args.render_num_proc
+    if args.max_tokens_per_batch is not None:
+        kwargs["max_tokens_per_batch"] = args.max_tokens_per_batch
+    if args.max_length is not None:
+        kwargs["max_length"] = args.max_length
+    if args.output_dim is not None:
+        kwargs["output_dim"] = args.output_dim
+    if args.cache_dir is not None:
+        kwargs["cache_dir"] = args.cache_dir
+    if args.cache_max_size_gb is not None:
+        kwargs["cache_max_size_gb"] = args.cache_max_size_gb
     
     try:
         subset_datasets(
             input_files=args.input,
             subset_sizes=subset_sizes,
             testing_mode=args.testing_mode,
+            cpu_mode=args.cpu,
             **kwargs,
         )
         print(f"\n✓ Subset selection complete! Results saved to {args.output_dir}")
         return 0
+    except TerminationRequested as e:
+        # Committed batches are resumed by the next run
+        print(f"\n✗ Stopped: {e}", file=sys.stderr)
+        return 143
     except Exception as e:
         print(f"\n✗ Error: {e}", file=sys.stderr)
         return 1
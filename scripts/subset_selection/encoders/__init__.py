@@ -2,10 +2,12 @@
 
 # Local
 from .arctic_encoder import ArcticEmbedEncoder
+from .onnx_encoder import ArcticOnnxEncoder
 
 # Create a mapping of encoder types to their classes
 ENCODER_REGISTRY = {
     "arctic": ArcticEmbedEncoder,
+    "onnx": ArcticOnnxEncoder,
 }
 
 
@@ -1,6 +1,7 @@
 # Standard
 from dataclasses import dataclass
-from typing import Dict, List, Optional, TypedDict, Union
+from typing import Any, Dict, List, Optional, Tuple, TypedDict, Union
+import gc
 import logging
 import os
 
@@ -12,6 +13,15 @@ import torch
 import torch.distributed as dist
 import torch.nn.functional as F
 
+# Local
+from ..utils.embedding_projection import load_projection
+from ..utils.model_weights import load_model_mmap
+from ..utils.token_lengths import (
+    make_batches,
+    truncate_token_ids,
+    validate_truncation_policy,
+)
+
 logger = logging.getLogger(__name__)
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -42,6 +52,44 @@ MODEL_CONFIGS: Dict[str, ModelConfig] = {
 }
 
 
+def resolve_model_source(
+    model_name: str, testing_mode: bool = False
+) -> Tuple[str, Dict[str, Any]]:
+    """Return the path or hub name to load a model from, with loading kwargs."""
+    home_dir = os.path.expanduser("~")
+    model_path = os.path.join(home_dir, ".cache", "instructlab", "models", model_name)
+
+    # In testing mode, allow direct download from HuggingFace
+    if testing_mode:
+        logger.warning(
+            f"Model not found locally at {model_path}. "
+            "Testing mode enabled - downloading from HuggingFace..."
+        )
+        return model_name, {}
+
+    if not os.path.exists(model_path):
+        raise ValueError(f"Model not found in available models: {model_name}\n")
+    return model_path, {"local_files_only": True}
+
+
+# Successful forward calls after which a batch limit lowered by an out-of-memory
+# error is doubled again
+OOM_RECOVERY_STEPS = 16
+
+_OOM_MESSAGES = ("out of memory", "can't allocate memory", "Failed to allocate memory")
+
+
+def is_out_of_memory_error(error: BaseException) -> bool:
+    """Whether an exception raised by a forward call means the device ran out of memory."""
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    return any(message in str(error) for message in _OOM_MESSAGES)
+
+
+# Row positions of a forward batch within the encoded inputs, and its padded tensors
+PreparedBatch = Tuple[np.ndarray, Dict[str, torch.Tensor]]
+
+
 # pylint: disable=too-many-instance-attributes
 @dataclass
 class EncoderConfig:
@@ -53,6 +101,16 @@ class EncoderConfig:
     use_default_instruction: bool
     use_fp16: bool
     testing_mode: bool = False
+    sort_by_length: bool = True
+    max_tokens_per_batch: Optional[int] = None
+    num_threads: Optional[int] = None
+    use_bf16: bool = False
+    quantize_int8: bool = False
+    output_dim: Optional[int] = None
+    projection: str = "truncate"
+    mmap_weights: bool = True
+    max_length: Optional[int] = None
+    truncation: str = "head"
 
 
 class ArcticEmbedEncoder:
@@ -63,12 +121,57 @@ class ArcticEmbedEncoder:
         use_fp16: bool = False,
         use_default_instruction: bool = True,
         testing_mode: bool = False,
+        sort_by_length: bool = True,
+        max_tokens_per_batch: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        use_bf16: bool = False,
+        quantize_int8: bool = False,
+        output_dim: Optional[int] = None,
+        projection: str = "truncate",
+        mmap_weights: bool = True,
+        max_length: Optional[int] = None,
+        truncation: str = "head",
     ) -> None:
-        """Initialize the Arctic encoder."""
+        """Initialize the Arctic encoder.
+
+        When ``sort_by_length`` is set, inputs are bucketed by token length so
+        that every forward batch is only padded to its own longest sequence.
+        When ``max_tokens_per_batch`` is set, forward batches are packed up to
+        that many padded tokens instead of a fixed number of sequences.
+
+        For CPU inference, ``num_threads`` bounds the intra-op threads of this
+        encoder, ``use_bf16`` runs the forward pass under bfloat16 autocast and
+        ``quantize_int8`` applies dynamic int8 quantization to the linear layers.
+
+        ``output_dim`` reduces the embeddings on device before they leave the
+        encoder, either by keeping a Matryoshka prefix (``projection="truncate"``),
+        by a seeded random projection (``"random"``) or by a fitted projection
+        loaded from the given file. Reduced embeddings are renormalized.
+
+        With ``mmap_weights``, CPU encoders map local safetensors weights read-only
+        instead of loading private copies, so all workers on a host share them.
+
+        ``max_length`` caps the tokens per input below the model's maximum. Longer
+        inputs keep their instruction and, depending on ``truncation``, the
+        beginning (``"head"``), the end (``"tail"``) or both halves (``"head+tail"``)
+        of the text.
+        """
         if model_name not in MODEL_CONFIGS:
             raise ValueError(
                 f"Model {model_name} not supported. Supported models: {list(MODEL_CONFIGS.keys())}"
             )
+        if max_tokens_per_batch is not None and max_tokens_per_batch <= 0:
+            raise ValueError("max_tokens_per_batch must be positive")
+        if num_threads is not None and num_threads <= 0:
+            raise ValueError("num_threads must be positive")
+        model_max_length = MODEL_CONFIGS[model_name]["max_length"]
+        if max_length is not None and not 0 < max_length <= model_max_length:
+            raise ValueError(f"max_length must be between 1 and {model_max_length}")
+        validate_truncation_policy(truncation)
+        if quantize_int8 and (use_fp16 or use_bf16):
+            raise ValueError(
+                "quantize_int8 cannot be combined with use_fp16 or use_bf16"
+            )
 
         # Use the provided device or default to CUDA
         self.device = device or torch.device(
@@ -78,6 +181,11 @@ class ArcticEmbedEncoder:
         # Get device ID for logging
         self.device_id = self.device.index if hasattr(self.device, "index") else 0
 
+        if quantize_int8 and self.device.type != "cpu":
+            raise ValueError("quantize_int8 is only supported on CPU")
+        if num_threads is not None and self.device.type == "cpu":
+            torch.set_num_threads(num_threads)
+
         # We don't need multi-GPU inside this encoder instance since each instance
         # will run on a dedicated GPU
         self.cfg = EncoderConfig(
@@ -89,59 +197,121 @@ class ArcticEmbedEncoder:
             use_default_instruction=use_default_instruction,
             use_fp16=use_fp16,
             testing_mode=testing_mode,
+            sort_by_length=sort_by_length,
+            max_tokens_per_batch=max_tokens_per_batch,
+            num_threads=num_threads,
+            use_bf16=use_bf16,
+            quantize_int8=quantize_int8,
+            output_dim=output_dim,
+            projection=projection,
+            mmap_weights=mmap_weights,
+            max_length=max_length or model_max_length,
+            truncation=truncation,
         )
+        self._prefix_lengths: Dict[str, int] = {}
+        # Padded tokens per forward call after an out-of-memory error (None: unlimited)
+        self._token_limit: Optional[int] = None
+        self._steps_since_oom = 0
 
         self._initialize_model()
+        self._initialize_projection()
 
-    def _initialize_model(self) -> None:
-        """Initialize model on the specific GPU."""
-        home_dir = os.path.expanduser("~")
-        model_path = os.path.join(
-            home_dir, ".cache", "instructlab", "models", self.cfg.model_name
-        )
+    def _model_source(self) -> Tuple[str, Dict[str, Any]]:
+        """Return the path or hub name to load the model from, with loading kwargs."""
+        return resolve_model_source(self.cfg.model_name, self.cfg.testing_mode)
 
-        # In testing mode, allow direct download from HuggingFace
-        if hasattr(self.cfg, "testing_mode") and self.cfg.testing_mode:
-            logger.warning(
-                f"Model not found locally at {model_path}. "
-                "Testing mode enabled - downloading from HuggingFace..."
-            )
-            self.tokenizer = AutoTokenizer.from_pretrained(self.cfg.model_name)
-            self.model = AutoModel.from_pretrained(
-                self.cfg.model_name,
-                add_pooling_layer=False,
-                trust_remote_code=True,
-            )
-        else:
-            if not os.path.exists(model_path):
-                raise ValueError(
-                    f"Model not found in available models: {self.cfg.model_name}\n"
-                )
+    @classmethod
+    def load_tokenizer(
+        cls,
+        model_name: str = "Snowflake/snowflake-arctic-embed-l-v2.0",
+        testing_mode: bool = False,
+    ):
+        """Load only the tokenizer of a model, e.g. for profiling token lengths."""
+        source, _ = resolve_model_source(model_name, testing_mode)
+        return AutoTokenizer.from_pretrained(source)
 
-            self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-            self.model = AutoModel.from_pretrained(
-                model_path,
-                add_pooling_layer=False,
-                trust_remote_code=True,
-                local_files_only=True,
-            )
+    def _load_model(self, source: str, load_kwargs: Dict[str, Any]):
+        """Load the transformer without its pooling layer."""
+        if (
+            self.cfg.mmap_weights
+            and self.cfg.device.type == "cpu"
+            and not self.cfg.use_fp16
+            and os.path.isdir(source)
+        ):
+            model = load_model_mmap(source, add_pooling_layer=False)
+            if model is not None:
+                logger.info(f"Memory-mapped model weights from {source}")
+                return model
+        return AutoModel.from_pretrained(
+            source,
+            add_pooling_layer=False,
+            trust_remote_code=True,
+            **load_kwargs,
+        )
+
+    def _initialize_model(self) -> None:
+        """Initialize model on the specific GPU."""
+        source, load_kwargs = self._model_source()
+        self.tokenizer = AutoTokenizer.from_pretrained(source)
+        self.model = self._load_model(source, load_kwargs)
 
         if self.cfg.use_fp16:
             self.model = self.model.half()
 
         self.model = self.model.to(self.cfg.device)
+        if self.cfg.quantize_int8:
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
         logger.info(f"Model loaded on device: {self.cfg.device}")
 
         # No need for DataParallel since we're running one encoder per GPU
         self.model.eval()
 
-    def _prepare_inputs(
-        self, texts: Union[str, List[str]], instruction: str = ""
-    ) -> List[str]:
-        """Prepare inputs with model-specific formatting."""
-        if isinstance(texts, str):
-            texts = [texts]
+    def _initialize_projection(self) -> None:
+        """Resolve the output dimension and move any projection onto the device."""
+        self._output_dim, matrix, mean, self._projection_id = load_projection(
+            self.cfg.projection, self.hidden_size, self.cfg.output_dim
+        )
+        self._projection_matrix = (
+            torch.from_numpy(matrix).to(self.cfg.device) if matrix is not None else None
+        )
+        self._projection_mean = (
+            torch.from_numpy(mean).to(self.cfg.device) if mean is not None else None
+        )
 
+    @property
+    def hidden_size(self) -> int:
+        """Dimension of the pooled model output."""
+        return self.model.config.hidden_size
+
+    @property
+    def embedding_dim(self) -> int:
+        """Dimension of the embeddings produced by this encoder."""
+        return self._output_dim
+
+    @property
+    def cache_key_fields(self) -> Dict[str, Any]:
+        """Encoder settings that affect the embedding of a given text."""
+        fields: Dict[str, Any] = {
+            "model_name": self.cfg.model_name,
+            "max_length": self.cfg.max_length,
+        }
+        if self.cfg.truncation != "head":
+            fields["truncation"] = self.cfg.truncation
+        # Reduced-precision compute changes the embeddings slightly; keep those
+        # entries apart while leaving existing full-precision keys unchanged
+        if self.cfg.use_bf16:
+            fields["use_bf16"] = True
+        if self.cfg.quantize_int8:
+            fields["quantize_int8"] = True
+        if self._output_dim != self.hidden_size or self._projection_id != "truncate":
+            fields["output_dim"] = self._output_dim
+            fields["projection"] = self._projection_id
+        return fields
+
+    def _resolve_instruction(self, instruction: str = "") -> str:
+        """Return the instruction prepended to inputs."""
         # Ensure we always have an instruction
         if not instruction and not self.cfg.use_default_instruction:
             raise ValueError(
@@ -161,10 +331,215 @@ class ArcticEmbedEncoder:
                 "No instruction available. Either provide an instruction or ensure "
                 "the model config has a valid default_instruction."
             )
+        return instruction
+
+    def _prepare_inputs(
+        self, texts: Union[str, List[str]], instruction: str = ""
+    ) -> List[str]:
+        """Prepare inputs with model-specific formatting."""
+        if isinstance(texts, str):
+            texts = [texts]
 
+        instruction = self._resolve_instruction(instruction)
         texts = [f"{instruction}: {text}" for text in texts]
         return texts
 
+    def _tokenize(
+        self, inputs: Union[str, List[str]], instruction: str = ""
+    ) -> List[List[int]]:
+        """Tokenize inputs, without special tokens and without truncation."""
+        instruction = self._resolve_instruction(instruction)
+        if instruction not in self._prefix_lengths:
+            self._prefix_lengths[instruction] = len(
+                self.tokenizer(f"{instruction}:", add_special_tokens=False)["input_ids"]
+            )
+        return self.tokenizer(
+            self._prepare_inputs(inputs, instruction),
+            add_special_tokens=False,
+            padding=False,
+            truncation=False,
+            verbose=False,
+        )["input_ids"]
+
+    def token_lengths(
+        self, inputs: Union[str, List[str]], instruction: str = ""
+    ) -> np.ndarray:
+        """Untruncated token length of every input, including special tokens."""
+        num_special = self.tokenizer.num_special_tokens_to_add()
+        return np.array(
+            [len(ids) + num_special for ids in self._tokenize(inputs, instruction)],
+            dtype=np.int64,
+        )
+
+    def _make_batches(self, lengths: List[int]) -> List[np.ndarray]:
+        """Group input positions into forward batches (see ``make_batches``)."""
+        return make_batches(
+            lengths,
+            self.cfg.batch_size,
+            max_tokens_per_batch=self.cfg.max_tokens_per_batch,
+            sort_by_length=self.cfg.sort_by_length,
+        )
+
+    def prepare_batches(
+        self, inputs: Union[str, List[str]], instruction: str = ""
+    ) -> List[PreparedBatch]:
+        """Tokenize inputs and pad them into host-side forward batches.
+
+        This only touches the tokenizer, so it can run on a background thread
+        while the model is busy with previously prepared batches.
+
+        Returns:
+            List of ``(positions, tensors)`` pairs, where ``positions`` are the
+            indices of the batch rows in ``inputs``.
+        """
+        # Tokenize without padding; each batch is padded to its own max length
+        token_ids = self._tokenize(inputs, instruction)
+        budget = self.cfg.max_length - self.tokenizer.num_special_tokens_to_add()
+        num_prefix_tokens = self._prefix_lengths[self._resolve_instruction(instruction)]
+        input_ids = [
+            self.tokenizer.build_inputs_with_special_tokens(
+                truncate_token_ids(ids, budget, num_prefix_tokens, self.cfg.truncation)
+            )
+            for ids in token_ids
+        ]
+        encodings = {
+            "input_ids": input_ids,
+            "attention_mask": [[1] * len(ids) for ids in input_ids],
+        }
+
+        prepared = []
+        for batch_indices in self._make_batches(
+            [len(ids) for ids in encodings["input_ids"]]
+        ):
+            batch = self.tokenizer.pad(
+                {k: [v[i] for i in batch_indices] for k, v in encodings.items()},
+                padding=True,
+                return_tensors="pt",
+            )
+            if self.cfg.device.type == "cuda":
+                batch = {k: v.pin_memory() for k, v in batch.items()}
+            prepared.append((batch_indices, dict(batch)))
+        return prepared
+
+    def _embed_batch(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Run the model on one padded forward batch and return normalized embeddings."""
+        batch = {k: v.to(self.cfg.device, non_blocking=True) for k, v in batch.items()}
+        with torch.autocast(
+            device_type=self.cfg.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.cfg.use_bf16,
+        ):
+            outputs = self.model(**batch)
+        # Take the first token embedding (CLS)
+        return self._pool(outputs.last_hidden_state[:, 0])
+
+    def _embed_batch_adaptive(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Embed a forward batch, splitting it up after out-of-memory errors.
+
+        On an out-of-memory error, the padded-token limit per forward call is
+        halved and only the rows that failed are run again, in slices that fit
+        the limit. After ``OOM_RECOVERY_STEPS`` successful calls the limit is
+        doubled, so a transient memory spike only slows down the batches that
+        follow it for a while.
+        """
+        num_rows, seq_len = batch["input_ids"].shape
+        results = []
+        start = 0
+        while start < num_rows:
+            rows = num_rows - start
+            if self._token_limit is not None:
+                rows = min(rows, max(1, self._token_limit // seq_len))
+            try:
+                embeddings = self._embed_batch(
+                    {k: v[start : start + rows] for k, v in batch.items()}
+                )
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                if rows == 1 or not is_out_of_memory_error(e):
+                    raise
+                embeddings = None
+
+            if embeddings is None:
+                # Free the failed call's activations outside the except block,
+                # where the traceback no longer holds on to them
+                self._shrink_token_limit(rows, seq_len)
+                continue
+            results.append(embeddings)
+            start += rows
+            self._grow_token_limit()
+        return results[0] if len(results) == 1 else torch.cat(results)
+
+    def _shrink_token_limit(self, rows: int, seq_len: int) -> None:
+        """Halve the padded tokens per forward call after a call ran out of memory."""
+        gc.collect()
+        if self.cfg.device.type == "cuda":
+            torch.cuda.empty_cache()
+        self._token_limit = max(1, rows * seq_len // 2)
+        self._steps_since_oom = 0
+        logger.warning(
+            f"Out of memory on a forward batch of {rows} x {seq_len} tokens, retrying "
+            f"with up to {max(1, self._token_limit // seq_len)} rows "
+            f"({self._token_limit} padded tokens) per forward call"
+        )
+
+    def _grow_token_limit(self) -> None:
+        """Double a lowered token limit after ``OOM_RECOVERY_STEPS`` successful calls."""
+        if self._token_limit is None:
+            return
+        self._steps_since_oom += 1
+        if self._steps_since_oom >= OOM_RECOVERY_STEPS:
+            self._token_limit *= 2
+            self._steps_since_oom = 0
+            logger.info(
+                f"Raised the forward batch limit to {self._token_limit} padded tokens"
+            )
+
+    def _pool(self, cls: torch.Tensor) -> torch.Tensor:
+        """Normalize pooled outputs and reduce them to ``embedding_dim``."""
+        embeddings = F.normalize(cls.float(), p=2, dim=1)
+        if self._projection_matrix is not None:
+            if self._projection_mean is not None:
+                embeddings = embeddings - self._projection_mean
+            embeddings = embeddings @ self._projection_matrix
+        elif self._output_dim < embeddings.shape[1]:
+            # Matryoshka truncation keeps the leading dimensions
+            embeddings = embeddings[:, : self._output_dim]
+        else:
+            return embeddings
+        return F.normalize(embeddings, p=2, dim=1)
+
+    @torch.no_grad()
+    def encode_into(
+        self,
+        prepared: List[PreparedBatch],
+        out: np.ndarray,
+        offset: int = 0,
+        show_progress: bool = False,
+    ) -> None:
+        """
+        Run the model over prepared batches, writing embeddings into a preallocated array.
+
+        The embedding of input ``i`` is written to ``out[offset + i]`` as soon as its
+        forward batch completes, so no intermediate copy of all embeddings is made.
+        ``out`` can be any array supporting numpy row assignment, such as a numpy
+        array or an ``np.memmap``.
+        """
+        num_inputs = sum(len(positions) for positions, _ in prepared)
+        for positions, batch in tqdm(
+            prepared,
+            disable=not show_progress or num_inputs < 256,
+        ):
+            embeddings = self._embed_batch_adaptive(batch)
+            out[offset + positions] = embeddings.float().cpu().numpy()
+
+    def encode_prepared(
+        self, prepared: List[PreparedBatch], show_progress: bool = True
+    ) -> torch.Tensor:
+        """Run the model over prepared batches and return embeddings in input order."""
+        num_inputs = sum(len(positions) for positions, _ in prepared)
+        embeddings = np.empty((num_inputs, self.embedding_dim), dtype=np.float32)
+        self.encode_into(prepared, embeddings, show_progress=show_progress)
+        return torch.from_numpy(embeddings)
+
     @torch.no_grad()
     def encode(
         self,
@@ -175,34 +550,34 @@ class ArcticEmbedEncoder:
     ) -> Union[torch.Tensor, np.ndarray]:
         """Encode texts into embeddings."""
         input_was_string = isinstance(inputs, str)
-        inputs = self._prepare_inputs(inputs, instruction)
-
-        encodings = self.tokenizer(
-            inputs,
-            max_length=self.cfg.model_config["max_length"],
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-        ).to(self.cfg.device)
-
-        embeddings_list = []
-        for i in tqdm(
-            range(0, len(inputs), self.cfg.batch_size),
-            disable=not show_progress or len(inputs) < 256,
-        ):
-            batch = {k: v[i : i + self.cfg.batch_size] for k, v in encodings.items()}
-            outputs = self.model(**batch)
-            # Take the first token embedding (CLS) and normalize it
-            embeddings = F.normalize(outputs.last_hidden_state[:, 0], p=2, dim=1)
-            embeddings_list.append(embeddings.cpu())
-
-        embeddings = torch.cat(embeddings_list, dim=0)
+        embeddings = self.encode_prepared(
+            self.prepare_batches(inputs, instruction), show_progress=show_progress
+        )
         if input_was_string:
             embeddings = embeddings[0]
 
         return embeddings if return_tensors else embeddings.numpy()
 
 
+def setup_distributed(backend: Optional[str] = None) -> Tuple[int, int, int]:
+    """
+    Join the process group of a torchrun launch.
+
+    Args:
+        backend (Optional[str]): Process group backend; defaults to nccl when
+            CUDA is available and gloo otherwise.
+
+    Returns:
+        Tuple[int, int, int]: Rank, world size and local rank of this process.
+    """
+    if not dist.is_initialized():
+        if backend is None:
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+        dist.init_process_group(backend=backend)
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    return dist.get_rank(), dist.get_world_size(), local_rank
+
+
 def cleanup():
     if dist.is_initialized():
         dist.destroy_process_group()
\ No newline at end of file
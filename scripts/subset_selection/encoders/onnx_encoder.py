@@ -0,0 +1,224 @@
+# Standard
+from typing import Callable, Dict, List, Optional
+import logging
+import os
+import shutil
+
+# Third Party
+from transformers import AutoConfig, AutoTokenizer
+import numpy as np
+import torch
+
+# Local
+from .arctic_encoder import ArcticEmbedEncoder
+
+logger = logging.getLogger(__name__)
+
+ONNX_OPSET_VERSION = 17
+
+
+class ArcticOnnxEncoder(ArcticEmbedEncoder):
+    """
+    Arctic embed encoder running on ONNX Runtime.
+
+    The model is exported to ONNX once and the exported graph is cached under
+    ``~/.cache/instructlab/onnx/<model_name>/opset<opset>-len<max_length>/<fp32|int8>/``;
+    later runs only load the graph, so workers never materialize the PyTorch
+    model. Models beyond the 2GB protobuf limit keep their weights in external
+    data files next to ``model.onnx``: the exporter writes them on its own and
+    quantization is asked to. Tokenization,
+    batching and CLS pooling with L2 normalization are the same as for
+    ``ArcticEmbedEncoder``.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "Snowflake/snowflake-arctic-embed-l-v2.0",
+        device: Optional[torch.device] = None,
+        use_fp16: bool = False,
+        use_default_instruction: bool = True,
+        testing_mode: bool = False,
+        sort_by_length: bool = True,
+        max_tokens_per_batch: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        use_bf16: bool = False,
+        quantize_int8: bool = False,
+        output_dim: Optional[int] = None,
+        projection: str = "truncate",
+        mmap_weights: bool = True,
+        max_length: Optional[int] = None,
+        truncation: str = "head",
+    ) -> None:
+        """Initialize the ONNX Runtime encoder.
+
+        ``quantize_int8`` runs a dynamically int8-quantized copy of the exported
+        graph, which is cached next to it. Half-precision compute is not supported.
+        """
+        if use_fp16 or use_bf16:
+            raise ValueError(
+                "The ONNX encoder does not support use_fp16 or use_bf16; "
+                "use quantize_int8 for reduced-precision inference"
+            )
+        super().__init__(
+            model_name=model_name,
+            device=device,
+            use_fp16=use_fp16,
+            use_default_instruction=use_default_instruction,
+            testing_mode=testing_mode,
+            sort_by_length=sort_by_length,
+            max_tokens_per_batch=max_tokens_per_batch,
+            num_threads=num_threads,
+            use_bf16=use_bf16,
+            quantize_int8=quantize_int8,
+            output_dim=output_dim,
+            projection=projection,
+            mmap_weights=mmap_weights,
+            max_length=max_length,
+            truncation=truncation,
+        )
+
+    def _onnx_dir(self, variant: str) -> str:
+        """Cache directory of one variant (``fp32`` or ``int8``) of the exported graph."""
+        home_dir = os.path.expanduser("~")
+        return os.path.join(
+            home_dir,
+            ".cache",
+            "instructlab",
+            "onnx",
+            self.cfg.model_name,
+            f"opset{ONNX_OPSET_VERSION}-len{self.cfg.max_length}",
+            variant,
+        )
+
+    def _write_onnx_dir(self, onnx_dir: str, write: Callable[[str], None]) -> str:
+        """
+        Create a cached graph with ``write(path)`` unless it exists; returns its path.
+
+        The graph is written into a private directory that is then moved into
+        place, so concurrent workers never load a partially written graph and its
+        external data files always come along with it.
+        """
+        onnx_path = os.path.join(onnx_dir, "model.onnx")
+        if os.path.exists(onnx_path):
+            return onnx_path
+
+        tmp_dir = f"{onnx_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        write(os.path.join(tmp_dir, "model.onnx"))
+        try:
+            os.rename(tmp_dir, onnx_dir)
+        except OSError:
+            # Another worker finished first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.exists(onnx_path):
+                raise
+        return onnx_path
+
+    def _export_onnx(self, source: str, load_kwargs: Dict) -> str:
+        """Export the model to ONNX unless a cached export exists; returns its path."""
+        onnx_dir = self._onnx_dir("fp32")
+        if os.path.exists(os.path.join(onnx_dir, "model.onnx")):
+            return os.path.join(onnx_dir, "model.onnx")
+
+        logger.info(f"Exporting {self.cfg.model_name} to ONNX at {onnx_dir}")
+        model = self._load_model(source, load_kwargs).eval()
+        sample = dict(self.tokenizer(["export"], return_tensors="pt"))
+        input_names = list(sample.keys())
+        dynamic_axes = {
+            name: {0: "batch", 1: "sequence"}
+            for name in input_names + ["last_hidden_state"]
+        }
+
+        def export(path: str) -> None:
+            with torch.no_grad():
+                torch.onnx.export(
+                    model,
+                    (sample,),
+                    path,
+                    input_names=input_names,
+                    output_names=["last_hidden_state"],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=ONNX_OPSET_VERSION,
+                )
+
+        onnx_path = self._write_onnx_dir(onnx_dir, export)
+        del model
+        return onnx_path
+
+    def _quantize_onnx(self, onnx_path: str) -> str:
+        """Create a dynamically int8-quantized copy of the exported graph if needed."""
+        # Third Party
+        # pylint: disable=import-error, import-outside-toplevel
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        def quantize(path: str) -> None:
+            logger.info(f"Quantizing ONNX graph of {self.cfg.model_name} to int8")
+            quantize_dynamic(
+                onnx_path,
+                path,
+                weight_type=QuantType.QInt8,
+                use_external_data_format=True,
+            )
+
+        return self._write_onnx_dir(self._onnx_dir("int8"), quantize)
+
+    def _initialize_model(self) -> None:
+        """Load the exported graph into an ONNX Runtime session."""
+        try:
+            # Third Party
+            # pylint: disable=import-error, import-outside-toplevel
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError(
+                "The onnx encoder requires onnxruntime. Install it with "
+                "`pip install onnxruntime` (or onnxruntime-gpu)."
+            ) from e
+
+        source, load_kwargs = self._model_source()
+        self.tokenizer = AutoTokenizer.from_pretrained(source)
+        self.model_config = AutoConfig.from_pretrained(
+            source, trust_remote_code=True, **load_kwargs
+        )
+
+        onnx_path = self._export_onnx(source, load_kwargs)
+        if self.cfg.quantize_int8:
+            onnx_path = self._quantize_onnx(onnx_path)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.cfg.num_threads is not None:
+            options.intra_op_num_threads = self.cfg.num_threads
+
+        providers: List = ["CPUExecutionProvider"]
+        if self.cfg.device.type == "cuda":
+            if "CUDAExecutionProvider" not in ort.get_available_providers():
+                raise RuntimeError(
+                    "CUDA device requested but onnxruntime has no CUDA support; "
+                    "install onnxruntime-gpu"
+                )
+            providers.insert(
+                0, ("CUDAExecutionProvider", {"device_id": self.cfg.device.index or 0})
+            )
+
+        self.session = ort.InferenceSession(
+            onnx_path, sess_options=options, providers=providers
+        )
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        logger.info(
+            f"ONNX model loaded from {onnx_path} with providers "
+            f"{self.session.get_providers()}"
+        )
+
+    @property
+    def hidden_size(self) -> int:
+        """Dimension of the pooled model output."""
+        return self.model_config.hidden_size
+
+    def _embed_batch(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Run the ONNX graph on one padded forward batch and return normalized embeddings."""
+        inputs = {name: batch[name].numpy() for name in self.input_names}
+        (last_hidden_state,) = self.session.run(["last_hidden_state"], inputs)
+        # Take the first token embedding (CLS)
+        cls = torch.from_numpy(np.ascontiguousarray(last_hidden_state[:, 0]))
+        return self._pool(cls.to(self.cfg.device, non_blocking=True))
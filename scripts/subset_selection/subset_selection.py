@@ -1,17 +1,22 @@
 # Standard
-from dataclasses import dataclass, field
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
 from multiprocessing import Pool
 import multiprocessing as mp
 
 
     
-from typing import Any, Dict, List, TypedDict, TypeVar, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, TypedDict, TypeVar, Union
 import gc
 import glob
+import hashlib
+import json
 import logging
 import math
 import os
 import re
+import signal
+import threading
 
 # Third Party
 from datasets import concatenate_datasets, load_dataset
@@ -19,7 +24,9 @@ from jinja2 import BaseLoader, Environment
 from tqdm import tqdm
 import h5py
 import numpy as np
+import pyarrow.compute as pc
 import torch
+import torch.distributed as dist
 
 # Only use spawn method if CUDA is available, otherwise use default method
 if torch.cuda.is_available() and mp.get_start_method(allow_none=True) != 'spawn':
@@ -27,21 +34,100 @@ if torch.cuda.is_available() and mp.get_start_method(allow_none=True) != 'spawn'
     
 # Local
 from .encoders import get_encoder_class
+from .encoders.arctic_encoder import MODEL_CONFIGS, cleanup, setup_distributed
+from .utils.ann_index import (
+    ann_index_path,
+    compute_ann_similarities,
+    validate_ann_backend,
+)
+from .utils.embedding_cache import (
+    KEY_DTYPE,
+    KEY_SIZE,
+    EmbeddingCache,
+    build_key_index,
+    compute_cache_keys,
+    keys_from_uint8,
+    keys_to_uint8,
+    match_keys,
+)
+from .utils.facility_location import (
+    DenseKernel,
+    EmbeddingKernel,
+    SparseKernel,
+    maximize_facility_location,
+    symmetrize_knn_graph,
+)
+from .utils.embedding_storage import (
+    StoredEmbeddings,
+    quantize_embeddings,
+    storage_dtype,
+    validate_storage_precision,
+)
 from .utils.subset_selection_utils import (
+    TerminationRequested,
+    assign_blocks,
     compute_pairwise_dense,
+    compute_topk_similarities,
+    get_available_cpu_cores,
+    get_cpu_worker_layout,
     get_default_num_gpus,
+    prefetch_iterator,
     retry_on_exception,
+    split_row_blocks,
+)
+from .utils.token_lengths import (
+    TOKEN_LENGTH_REPORT_FILE,
+    count_tokens,
+    summarize_token_lengths,
+    validate_truncation_policy,
+)
+from .utils.template_rendering import (
+    CONVERSATION_TEMPLATE,
+    DEFAULT_TEMPLATE,
+    QA_TEMPLATE,
+    RENDERED_TEXT_COLUMN,
+    render_dataset,
 )
 
 # Type variables
 T = TypeVar("T")
 
+# Name of the per-shard manifest recording which rows have been committed
+SHARD_PROGRESS_FILE = "progress.json"
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
 
+# Similarity kernels of facility location
+SIMILARITY_MODES = ("dense", "sparse", "ann", "streaming")
+
+# Facility location maximizers
+OPTIMIZER_BACKENDS = ("submodlib", "torch")
+
+# Folds and greedy orderings of the last selection, under the dataset's output directory
+GREEDY_ORDERINGS_FILE = "greedy_orderings.npz"
+
+
+def validate_similarity_mode(similarity_mode: str) -> None:
+    """Raise a ValueError for unsupported similarity modes."""
+    if similarity_mode not in SIMILARITY_MODES:
+        raise ValueError(
+            f"Unsupported similarity mode: '{similarity_mode}'. "
+            f"Supported modes are: {list(SIMILARITY_MODES)}"
+        )
+
+
+def validate_optimizer_backend(optimizer_backend: str) -> None:
+    """Raise a ValueError for unsupported optimizer backends."""
+    if optimizer_backend not in OPTIMIZER_BACKENDS:
+        raise ValueError(
+            f"Unsupported optimizer backend: '{optimizer_backend}'. "
+            f"Supported backends are: {list(OPTIMIZER_BACKENDS)}"
+        )
+
 
 @dataclass
 class BasicConfig:
@@ -51,6 +137,14 @@ class BasicConfig:
     batch_size: int = 100000
     num_folds: int = 50
     combine_files: bool = False
+    prefetch_batches: int = field(
+        default=2,
+        metadata={
+            "advanced": True,
+            "help": "Number of tokenized batches prepared on a background thread ahead of the "
+            "encoder. Set to 0 to tokenize and encode serially.",
+        },
+    )
     epsilon: float = field(
         default=160.0,
         metadata={
@@ -60,11 +154,195 @@ class BasicConfig:
             "For smaller datasets, consider using much smaller values (starting from 0.1).",
         },
     )
+    optimizer_backend: str = field(
+        default="submodlib",
+        metadata={
+            "advanced": True,
+            "help": "Facility location maximizer. 'submodlib' runs submodlib's "
+            "LazierThanLazyGreedy on the CPU. 'torch' runs the in-tree stochastic greedy "
+            "with batched gain computation on the fold's device (GPU or CPU threads), "
+            "with the same epsilon semantics and without copying the similarities to the host.",
+        },
+    )
+    similarity_mode: str = field(
+        default="dense",
+        metadata={
+            "advanced": True,
+            "help": "Similarity kernel of facility location. 'dense' builds the full n x n "
+            "matrix of every fold. 'sparse' keeps the exact num_neighbors most similar "
+            "examples of every row, computed block by block on the device, so memory grows "
+            "linearly with the fold size and far fewer folds are needed. 'ann' finds the "
+            "neighbours with an approximate nearest-neighbour index instead, which avoids the "
+            "quadratic compute of exact search for folds of millions of examples. 'streaming' "
+            "stores no similarities at all and recomputes the needed columns from the "
+            "embeddings at every greedy step, so memory is O(n * dim); it requires "
+            "optimizer_backend='torch'.",
+        },
+    )
+    num_neighbors: int = field(
+        default=100,
+        metadata={
+            "advanced": True,
+            "help": "Neighbours kept per example with similarity_mode='sparse' or 'ann'.",
+        },
+    )
+    ann_backend: str = field(
+        default="hnswlib",
+        metadata={
+            "advanced": True,
+            "help": "ANN library of similarity_mode='ann': 'hnswlib' (HNSW graph) or 'faiss' "
+            "(IVF-Flat index, faiss-cpu). Indexes are saved under embeddings/ann/ and reused "
+            "by reruns over the same embeddings.",
+        },
+    )
+    ann_m: int = field(
+        default=32,
+        metadata={"advanced": True, "help": "Links per node of the HNSW graph."},
+    )
+    ann_ef_construction: int = field(
+        default=200,
+        metadata={"advanced": True, "help": "Candidate list size while building the HNSW graph."},
+    )
+    ann_ef_search: int = field(
+        default=200,
+        metadata={
+            "advanced": True,
+            "help": "Candidate list size of HNSW queries; higher values give higher recall.",
+        },
+    )
+    ann_nlist: int = field(
+        default=0,
+        metadata={
+            "advanced": True,
+            "help": "Inverted lists of the faiss IVF index (0: 4 * sqrt(fold size)).",
+        },
+    )
+    ann_nprobe: int = field(
+        default=32,
+        metadata={
+            "advanced": True,
+            "help": "Inverted lists searched per faiss query; higher values give higher recall.",
+        },
+    )
+
+    deduplicate: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Collapse examples whose rendered text is byte-identical before subset "
+            "selection. Each unique text is selected at most once and weighted by its number "
+            "of occurrences in the facility location objective. Percentage subset sizes stay "
+            "relative to all rows of the dataset; a subset holds at most every unique text.",
+        },
+    )
+
+    incremental: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Treat existing embeddings as an append-only store. Rows are identified by "
+            "their source file and a fingerprint of their content; only rows missing from the "
+            "store are encoded and appended to it.",
+        },
+    )
+
+    virtual_merge: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Merge per-device shard files into embeddings.h5 through HDF5 virtual "
+            "datasets instead of copying them. The shard files are kept and embeddings.h5 "
+            "cannot be read without them, so they must be moved together. Incremental stores are always copied so they can be appended to.",
+        },
+    )
+
+    render_num_proc: Optional[int] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Number of processes rendering templates before encoding. Defaults to one "
+            "process per 50k rows, up to the number of available cores.",
+        },
+    )
+
+    profile_token_lengths: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Run a tokenizer-only pass before encoding and write the token length "
+            "histogram, truncation statistics and padding waste to token_lengths.json next "
+            "to the embeddings.",
+        },
+    )
+
+    profile_only: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Only write the token length report; skip encoding and subset selection.",
+        },
+    )
+
+    persistent_workers: bool = field(
+        default=True,
+        metadata={
+            "advanced": True,
+            "help": "Keep one encoder worker process per device alive for the whole run. Each "
+            "worker loads the model once and encodes the shards of every input file.",
+        },
+    )
+
+    file_bundle_rows: int = field(
+        default=50000,
+        metadata={
+            "advanced": True,
+            "help": "When files are processed separately, input files with fewer rows than this "
+            "are encoded together in bundles of about this many rows and the embeddings are "
+            "split per file afterwards. Only files with identical columns are bundled. "
+            "Set to 0 to encode every file on its own.",
+        },
+    )
+
+    encode_block_rows: int = field(
+        default=8192,
+        metadata={
+            "advanced": True,
+            "help": "Rows per work block of embedding generation. Blocks are queued longest "
+            "first by rendered text length and every device pulls the next block when it is "
+            "done with one, so devices finish together even when text lengths are skewed. "
+            "Set to 0 to give every device one contiguous shard of equal row count.",
+        },
+    )
 
     def __post_init__(self):
         """Validate configuration after initialization."""
         if not 0 < self.epsilon <= 160:
             raise ValueError("epsilon must be between 0 and 160")
+        if self.prefetch_batches < 0:
+            raise ValueError("prefetch_batches must be non-negative")
+        if self.file_bundle_rows < 0:
+            raise ValueError("file_bundle_rows must be non-negative")
+        if self.encode_block_rows < 0:
+            raise ValueError("encode_block_rows must be non-negative")
+        validate_similarity_mode(self.similarity_mode)
+        if self.num_neighbors <= 0:
+            raise ValueError("num_neighbors must be positive")
+        validate_ann_backend(self.ann_backend)
+        validate_optimizer_backend(self.optimizer_backend)
+        if self.similarity_mode == "streaming" and self.optimizer_backend != "torch":
+            raise ValueError("similarity_mode='streaming' requires optimizer_backend='torch'")
+
+    @property
+    def ann_params(self) -> Dict[str, Any]:
+        """Backend and parameters of the ANN index (see ``compute_ann_similarities``)."""
+        return {
+            "backend": self.ann_backend,
+            "m": self.ann_m,
+            "ef_construction": self.ann_ef_construction,
+            "ef_search": self.ann_ef_search,
+            "nlist": self.ann_nlist,
+            "nprobe": self.ann_nprobe,
+        }
 
     def validate_epsilon_for_dataset_size(self, dataset_size: int) -> None:
         """
@@ -99,6 +377,103 @@ class EncoderConfig:
         default="Snowflake/snowflake-arctic-embed-l-v2.0", metadata={"advanced": True}
     )
     testing_mode: bool = False
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Padded-token budget per encoder forward pass. When set, the encoder packs "
+            "as many sequences as fit the budget instead of using the model's fixed batch size.",
+        },
+    )
+    output_dim: Optional[int] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Reduce embeddings to this dimension on device before they are stored. "
+            "Shrinks storage, transfer and similarity computation proportionally.",
+        },
+    )
+    projection: str = field(
+        default="truncate",
+        metadata={
+            "advanced": True,
+            "help": "How embeddings are reduced to output_dim: 'truncate' keeps a Matryoshka "
+            "prefix, 'random' applies a seeded random projection, and any other value is the "
+            "path of a fitted projection saved with save_projection (e.g. from "
+            "fit_pca_projection). Reduced embeddings are renormalized.",
+        },
+    )
+    mmap_weights: bool = field(
+        default=True,
+        metadata={
+            "advanced": True,
+            "help": "On CPU, memory-map local safetensors weights instead of loading a private "
+            "copy in every worker, so all workers on a host share one copy of the weights. "
+            "Requires the accelerate package; falls back to regular loading otherwise.",
+        },
+    )
+    max_length: Optional[int] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Cap on the tokens per input, below the model's maximum (4096 for Arctic "
+            "embed). Bounds the attention cost of the longest inputs.",
+        },
+    )
+    truncation: str = field(
+        default="head",
+        metadata={
+            "advanced": True,
+            "help": "Which tokens inputs longer than max_length keep besides the instruction: "
+            "head (the beginning), tail (the end) or head+tail (both halves).",
+        },
+    )
+    storage_precision: str = field(
+        default="float32",
+        metadata={
+            "advanced": True,
+            "help": "Precision of the stored embeddings: float32, float16, bfloat16 (stored as "
+            "uint16) or int8 (with a per-row scale). Embeddings are dequantized to float32 one "
+            "fold at a time during subset selection.",
+        },
+    )
+    cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Directory of a persistent embedding cache shared across runs and datasets. "
+            "Entries are keyed by rendered text, encoder model, instruction and max length, "
+            "so only texts that were never encoded before are sent to the model.",
+        },
+    )
+    use_bf16: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Run the encoder forward pass under bfloat16 autocast. Mostly useful on CPUs "
+            "with native bfloat16 support (AVX-512 BF16 / AMX).",
+        },
+    )
+    quantize_int8: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Apply dynamic int8 quantization to the encoder's linear layers. CPU only.",
+        },
+    )
+    cache_max_size_gb: Optional[float] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Size bound of the embedding cache. Least recently used cache entries are "
+            "evicted once it is exceeded. Unbounded by default.",
+        },
+    )
+
+    def __post_init__(self):
+        """Validate configuration after initialization."""
+        validate_storage_precision(self.storage_precision)
+        validate_truncation_policy(self.truncation)
 
 
 @dataclass
@@ -108,9 +483,9 @@ class TemplateConfig:
     template_name: str = field(default="conversation", metadata={"advanced": True})
     templates: Dict[str, str] = field(
         default_factory=lambda: {
-            "default": "{{ text }}",
-            "conversation": "{% for msg in messages if msg.role != 'system' %}{{ msg.role }}: {{ msg.content }}\n{% endfor %}",
-            "qa": "Question: {{ question }}\nAnswer: {{ answer }}",
+            "default": DEFAULT_TEMPLATE,
+            "conversation": CONVERSATION_TEMPLATE,
+            "qa": QA_TEMPLATE,
         },
         metadata={"advanced": True},
     )
@@ -125,10 +500,61 @@ class SystemConfig:
     max_retries: int = field(default=3, metadata={"advanced": True})
     retry_delay: int = field(default=30, metadata={"advanced": True})
     testing_mode: bool = field(default=False, metadata={"advanced": True})
+    cpu_mode: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Run embedding generation and subset selection on CPU worker processes. "
+            "num_gpus is then the number of CPU workers.",
+        },
+    )
+    cpu_workers: Optional[int] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Number of CPU worker processes in CPU mode. Derived from the available "
+            "cores by default.",
+        },
+    )
+    threads_per_worker: Optional[int] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Intra-op threads per CPU worker in CPU mode. Derived from the available "
+            "cores and the number of workers by default.",
+        },
+    )
+
+    distributed: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Run as one rank of a torchrun launch. Each rank encodes a slice of every "
+            "dataset and a share of the folds on its own device; rank 0 merges the shards and "
+            "writes the results. output_dir must be on a filesystem shared by all ranks.",
+        },
+    )
 
     def __post_init__(self):
         """Initialize num_gpus after other fields are set."""
-        self.num_gpus = get_default_num_gpus(testing_mode=self.testing_mode)
+        if self.cpu_mode:
+            self.num_gpus = get_cpu_worker_layout(
+                self.cpu_workers, self.threads_per_worker
+            )[0]
+        else:
+            self.num_gpus = get_default_num_gpus(testing_mode=self.testing_mode)
+
+    @property
+    def cpu_threads(self) -> Optional[int]:
+        """Intra-op threads of each CPU worker in CPU mode, None otherwise."""
+        if not self.cpu_mode:
+            return None
+        return get_cpu_worker_layout(self.num_gpus, self.threads_per_worker)[1]
+
+    @property
+    def use_cuda(self) -> bool:
+        """Whether workers run on CUDA devices."""
+        return torch.cuda.is_available() and not self.cpu_mode
 
 
 @dataclass
@@ -190,7 +616,17 @@ class DataProcessor:
         self.templates = {
             k: self.env.from_string(v) for k, v in config.template.templates.items()
         }
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = torch.device("cuda" if config.system.use_cuda else "cpu")
+        # Source file and row count of each dataset loaded by the last
+        # load_and_combine_datasets call, in concatenation order
+        self.dataset_sources: List[Tuple[str, int]] = []
+        # Long-lived encoder workers, set while process_files runs
+        self._encoder_pool: Optional[_EncoderWorkerPool] = None
+        # Rank of this process in a torchrun launch
+        self.distributed = config.system.distributed and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0)) if self.distributed else 0
 
         # Set random seeds
         np.random.seed(config.system.seed)
@@ -235,6 +671,11 @@ class DataProcessor:
             )
             datasets.append(dataset)
 
+        self.dataset_sources = [
+            (input_file, len(dataset))
+            for input_file, dataset in zip(input_files, datasets, strict=True)
+        ]
+
         if self.config.basic.combine_files:
             logger.info("Combining datasets...")
             return concatenate_datasets(datasets)
@@ -245,6 +686,25 @@ class DataProcessor:
             )
         return datasets[0]
 
+    @property
+    def is_main_process(self) -> bool:
+        """Whether this process writes shared outputs (rank 0, or not distributed)."""
+        return self.rank == 0
+
+    def _barrier(self) -> None:
+        """Wait for all ranks when distributed."""
+        if self.distributed:
+            dist.barrier()
+
+    @contextmanager
+    def _main_process_first(self):
+        """Let rank 0 run a block (e.g. filling a cache) before the other ranks."""
+        if not self.is_main_process:
+            self._barrier()
+        yield
+        if self.is_main_process:
+            self._barrier()
+
     def calculate_subset_size(
         self, total_samples: int, size_spec: Union[int, float]
     ) -> int:
@@ -284,14 +744,40 @@ class DataProcessor:
             return f"percent_{size_spec:.1f}"
         return f"samples_{actual_size}"
 
+    def _get_encoder_kwargs(self) -> Dict[str, Any]:
+        """
+        Build the keyword arguments used to instantiate the encoder in each worker.
+
+        Returns:
+            Dict[str, Any]: Encoder constructor arguments (excluding the device).
+        """
+        return {
+            "model_name": self.config.encoder.encoder_model,
+            "testing_mode": self.config.encoder.testing_mode,
+            "max_tokens_per_batch": self.config.encoder.max_tokens_per_batch,
+            "output_dim": self.config.encoder.output_dim,
+            "projection": self.config.encoder.projection,
+            "mmap_weights": self.config.encoder.mmap_weights,
+            "max_length": self.config.encoder.max_length,
+            "truncation": self.config.encoder.truncation,
+            "use_bf16": self.config.encoder.use_bf16,
+            "quantize_int8": self.config.encoder.quantize_int8,
+            "num_threads": self.config.system.cpu_threads,
+        }
+
     @retry_on_exception
-    def generate_embeddings(self, dataset, output_dir: str) -> str:
+    def generate_embeddings(
+        self, dataset, output_dir: str, row_fingerprints: Optional[np.ndarray] = None
+    ) -> str:
         """
         Generates embeddings for the dataset and saves them to the output directory, using multiple GPUs in parallel.
 
         Args:
             dataset: The dataset to process.
             output_dir (str): The directory where embeddings will be saved.
+            row_fingerprints (Optional[np.ndarray]): Fingerprint of every dataset row.
+                When given, existing embeddings are treated as an append-only store and
+                only rows whose fingerprint is missing from it are encoded.
 
         Returns:
             str: The path to the merged embeddings file.
@@ -299,52 +785,169 @@ class DataProcessor:
         os.makedirs(output_dir, exist_ok=True)
         merged_path = os.path.join(output_dir, "embeddings.h5")
 
-        # If embeddings already exist, return early
+        # If embeddings already exist, return early or only encode the new rows
         if os.path.exists(merged_path):
+            if row_fingerprints is not None:
+                return self._update_embedding_store(
+                    dataset, output_dir, merged_path, row_fingerprints
+                )
             logger.info(f"Embeddings file already exists in {output_dir}, skipping")
             return merged_path
 
-        # Get number of GPUs to use
-        if torch.cuda.is_available():
-            num_gpus = min(self.config.system.num_gpus, torch.cuda.device_count())
+        self._encode_dataset(
+            dataset,
+            output_dir,
+            merged_path,
+            virtual_merge=self.config.basic.virtual_merge and row_fingerprints is None,
+        )
+
+        if row_fingerprints is not None:
+            if self.is_main_process:
+                with h5py.File(merged_path, "a") as f:
+                    _create_row_index(f, row_fingerprints, np.arange(len(dataset)))
+            self._barrier()
+
+        return merged_path
+
+    def _update_embedding_store(
+        self, dataset, output_dir: str, store_path: str, row_fingerprints: np.ndarray
+    ) -> str:
+        """
+        Encode the rows missing from an existing embeddings store and append them to it.
+
+        Args:
+            dataset: The dataset to process.
+            output_dir (str): The directory holding the embeddings store.
+            store_path (str): Path to the embeddings store.
+            row_fingerprints (np.ndarray): Fingerprint of every dataset row.
+
+        Returns:
+            str: The path to the embeddings store.
+        """
+        with h5py.File(store_path, "r") as f:
+            if "row_fingerprints" not in f:
+                logger.warning(
+                    f"{store_path} was not created in incremental mode, reusing it as is"
+                )
+                return store_path
+            store_index = build_key_index(keys_from_uint8(f["row_fingerprints"][:]))
+
+        store_rows = match_keys(store_index, row_fingerprints)
+        new_rows = np.flatnonzero(store_rows < 0)
+        logger.info(
+            f"Found {len(dataset) - len(new_rows)} rows in the embeddings store, "
+            f"encoding {len(new_rows)} new rows"
+        )
+
+        if len(new_rows) > 0:
+            delta_dir = os.path.join(output_dir, "delta")
+            delta_path = os.path.join(delta_dir, "embeddings.h5")
+            if os.path.exists(delta_path) and self.is_main_process:
+                os.remove(delta_path)  # Left over from an interrupted update
+            self._encode_dataset(dataset.select(new_rows), delta_dir, delta_path)
+
+            if self.is_main_process:
+                start = _append_embedding_file(
+                    store_path, delta_path, row_fingerprints[new_rows]
+                )
+                store_rows[new_rows] = np.arange(start, start + len(new_rows))
+                os.remove(delta_path)
+                if not os.listdir(delta_dir):
+                    os.rmdir(delta_dir)
+
+        if self.is_main_process:
+            with h5py.File(store_path, "a") as f:
+                del f["current_rows"]
+                f.create_dataset("current_rows", data=store_rows, dtype="int64")
+        self._barrier()
+
+        return store_path
+
+    def _encode_dataset(
+        self, dataset, output_dir: str, merged_path: str, virtual_merge: bool = False
+    ) -> None:
+        """
+        Encode a dataset on all available devices and merge the results into one file.
+
+        Args:
+            dataset: The dataset to encode.
+            output_dir (str): Directory for the per-block shard files.
+            merged_path (str): Path of the merged embeddings file to create.
+            virtual_merge (bool): Merge through HDF5 virtual datasets instead of
+                copying the shard files.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Get number of GPUs to use; when distributed, every rank encodes one shard
+        use_cuda = self.config.system.use_cuda
+        num_gpus = self.world_size if self.distributed else self._num_encoder_workers()
+        if self.distributed:
+            logger.info(f"Rank {self.rank} of {self.world_size} taking part in embedding generation")
         else:
-            # In testing mode without GPU, use 1 CPU "worker"
-            num_gpus = 1
-        logger.info(f"Using {num_gpus} {'GPU' if torch.cuda.is_available() else 'CPU worker'}{'s' if num_gpus > 1 else ''} for embedding generation")
+            logger.info(f"Using {num_gpus} {'GPU' if use_cuda else 'CPU worker'}{'s' if num_gpus > 1 else ''} for embedding generation")
 
-        # Create dataset shards - one per GPU
+        # Render all texts once into an Arrow column that every shard memory-maps
+        with self._main_process_first():
+            rendered = self._render_dataset(dataset)
+        if self.config.basic.profile_token_lengths and self.is_main_process:
+            self._write_token_length_report(rendered, output_dir)
+
+        # Split the rows into blocks, queued longest first
         total_samples = len(dataset)
         per_gpu_samples = (total_samples + num_gpus - 1) // num_gpus  # Ceiling division
-
-        # Prepare arguments for parallel processing
+        block_rows = self.config.basic.encode_block_rows
+        block_rows = min(block_rows, per_gpu_samples) if block_rows else per_gpu_samples
+        row_costs = pc.utf8_length(
+            rendered.with_format("arrow")[RENDERED_TEXT_COLUMN]
+        ).to_numpy(zero_copy_only=False)
+        blocks, block_order = split_row_blocks(row_costs, max(1, block_rows))
+        logger.info(f"Encoding {total_samples} samples in {len(blocks)} blocks")
+
+        # Prepare arguments for parallel processing; pool workers encode on their
+        # own device, ranks on their local one
+        encoder_kwargs = self._get_encoder_kwargs()
         args_list = []
-        for gpu_id in range(num_gpus):
-            # Calculate start and end indices for this shard
-            start_idx = gpu_id * per_gpu_samples
-            end_idx = min(start_idx + per_gpu_samples, total_samples)
-
-            if start_idx >= total_samples:
-                continue  # Skip if this GPU has no data to process
-
-            # Create arguments for this GPU
+        for block_id, (start_idx, end_idx) in enumerate(blocks):
             args_list.append(
                 (
-                    gpu_id,
-                    dataset.select(range(start_idx, end_idx)),
+                    block_id,
+                    rendered.select(range(start_idx, end_idx)),
+                    (start_idx, end_idx),
                     output_dir,
                     self.config.encoder.encoder_type,
-                    self.config.encoder.encoder_model,
+                    encoder_kwargs,
                     self.config.encoder.instruction,
-                    self.config.template.template_name,
-                    self.config.template.templates,
                     self.config.basic.batch_size,
-                    self.config.encoder.testing_mode,
+                    self.config.basic.prefetch_batches,
+                    self.config.encoder.cache_dir,
+                    self.config.encoder.storage_precision,
+                    use_cuda,
+                    self.local_rank if self.distributed else None,
                 )
             )
 
-        # Process dataset shards in parallel
-        with Pool(processes=num_gpus) as pool:
-            shard_files = pool.map(_process_dataset_shard, args_list)
+        if self.distributed:
+            # Ranks cannot share a queue, so blocks are balanced up front by cost
+            block_costs = np.add.reduceat(
+                row_costs.astype(np.float64), [start for start, _ in blocks]
+            )
+            assignment = assign_blocks(block_costs, self.world_size)[self.rank]
+            self._encode_shards_distributed(
+                [args_list[i] for i in assignment], merged_path, virtual_merge
+            )
+            return
+
+        # Devices pull blocks from a shared queue; results come back in block order
+        if self._encoder_pool is not None:
+            shard_files = self._encoder_pool.map_shards(args_list, block_order)
+        else:
+            encoder_pool = _EncoderWorkerPool(num_gpus)
+            try:
+                shard_files = encoder_pool.map_shards(args_list, block_order)
+            except BaseException:
+                encoder_pool.terminate()
+                raise
+            encoder_pool.close()
 
         # Filter out None values (failed shards)
         shard_files = [f for f in shard_files if f is not None]
@@ -352,62 +955,360 @@ class DataProcessor:
         if not shard_files:
             raise ValueError("No embeddings were generated from any GPU")
 
-        # Merge all shard files
-        _merge_shard_files(shard_files, merged_path)
+        # Merge all shard files; stores that get appended to need a real copy
+        _merge_shard_files(shard_files, merged_path, virtual=virtual_merge)
 
-        return merged_path
+        if self.config.encoder.cache_dir:
+            self._update_embedding_cache(merged_path)
 
-    def select_subsets(
-        self, dataset_name: str, embeddings: torch.Tensor
-    ) -> Dict[Union[int, float], List[int]]:
+    def _encode_shards_distributed(
+        self, args_list: List[tuple], merged_path: str, virtual_merge: bool
+    ) -> None:
         """
-        Enhanced subset selection supporting both percentage and absolute size specifications.
+        Encode the blocks of this rank, then let rank 0 merge the blocks of all ranks.
+
+        Args:
+            args_list (List[tuple]): ``_process_dataset_shard`` arguments of the
+                blocks assigned to this rank.
+            merged_path (str): Path of the merged embeddings file to create.
+            virtual_merge (bool): Merge through HDF5 virtual datasets.
         """
-        indices = np.arange(len(embeddings))
-        np.random.shuffle(indices)
+        local_files = [(args[0], _process_dataset_shard(args)) for args in args_list]
+        gathered: List[Optional[List[Tuple[int, Optional[str]]]]] = [None] * self.world_size
+        dist.all_gather_object(gathered, local_files)
+        shard_files = [
+            f for _, f in sorted(pair for files in gathered for pair in files)
+            if f is not None
+        ]
 
-        fold_size = len(embeddings) // self.config.basic.num_folds
-        remainder = len(embeddings) % self.config.basic.num_folds
+        if not shard_files:
+            raise ValueError("No embeddings were generated on any rank")
 
-        folds = []
-        start_idx = 0
-        for i in range(self.config.basic.num_folds):
-            extra = 1 if i < remainder else 0
-            end_idx = start_idx + fold_size + extra
-            folds.append(indices[start_idx:end_idx])
-            start_idx = end_idx
+        if self.is_main_process:
+            _merge_shard_files(shard_files, merged_path, virtual=virtual_merge)
+            if self.config.encoder.cache_dir:
+                self._update_embedding_cache(merged_path)
+        self._barrier()
 
-        gpu_assignments = []
-        folds_per_gpu = self.config.basic.num_folds // self.config.system.num_gpus
-        extra_folds = self.config.basic.num_folds % self.config.system.num_gpus
+    def _render_dataset(self, dataset):
+        """
+        Render the configured template for every row of a dataset.
 
-        start_fold = 0
-        for gpu_id in range(self.config.system.num_gpus):
-            num_folds_this_gpu = folds_per_gpu + (1 if gpu_id < extra_folds else 0)
-            end_fold = start_fold + num_folds_this_gpu
-            gpu_folds_info = [
-                (fold_idx, folds[fold_idx]) for fold_idx in range(start_fold, end_fold)
-            ]
+        Args:
+            dataset: The dataset to render.
 
-            gpu_assignments.append(
-                (
-                    gpu_id,
-                    gpu_folds_info,
-                    embeddings,
-                    self.config.subset_sizes,
-                    len(embeddings),  # Pass total samples for absolute size calculation
-                    self.config.basic.epsilon,
-                    self.config.system.testing_mode,  # Explicitly pass testing_mode
-                )
+        Returns:
+            A dataset with the rendered texts in ``RENDERED_TEXT_COLUMN``.
+        """
+        template_name = self.config.template.template_name
+        if template_name not in self.config.template.templates:
+            raise ValueError(f"Unknown format type: {template_name}")
+
+        num_proc = self.config.basic.render_num_proc
+        if num_proc is None:
+            num_proc = min(get_available_cpu_cores(), max(1, len(dataset) // 50000))
+        return render_dataset(
+            dataset, self.config.template.templates[template_name], num_proc=num_proc
+        )
+
+    def _write_token_length_report(self, rendered, output_dir: str) -> str:
+        """
+        Tokenize rendered texts without the model and write a token length report.
+
+        Args:
+            rendered: Dataset with the rendered texts in ``RENDERED_TEXT_COLUMN``.
+            output_dir (str): Directory to write the report to.
+
+        Returns:
+            str: Path to the report.
+        """
+        encoder_cls = get_encoder_class(self.config.encoder.encoder_type)
+        model_name = self.config.encoder.encoder_model
+        tokenizer = encoder_cls.load_tokenizer(
+            model_name, testing_mode=self.config.encoder.testing_mode
+        )
+        model_config = MODEL_CONFIGS.get(model_name, {})
+        instruction = self.config.encoder.instruction or model_config.get(
+            "default_instruction", ""
+        )
+
+        num_proc = self.config.basic.render_num_proc
+        if num_proc is None:
+            num_proc = min(get_available_cpu_cores(), max(1, len(rendered) // 50000))
+        lengths = rendered.map(
+            count_tokens,
+            batched=True,
+            num_proc=num_proc if num_proc > 1 else None,
+            fn_kwargs={
+                "tokenizer": tokenizer,
+                "prefix": f"{instruction}: ",
+                "column": RENDERED_TEXT_COLUMN,
+            },
+            remove_columns=rendered.column_names,
+            desc="Counting tokens",
+        )["num_tokens"]
+
+        model_max_length = model_config.get("max_length", tokenizer.model_max_length)
+        report = summarize_token_lengths(
+            np.asarray(lengths),
+            max_length=self.config.encoder.max_length or model_max_length,
+            truncation=self.config.encoder.truncation,
+            chunk_size=self.config.basic.batch_size,
+            batch_size=model_config.get("batch_size", 1),
+            max_tokens_per_batch=self.config.encoder.max_tokens_per_batch,
+        )
+        report["model_max_length"] = model_max_length
+
+        os.makedirs(output_dir, exist_ok=True)
+        report_path = os.path.join(output_dir, TOKEN_LENGTH_REPORT_FILE)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+        if report["num_texts"] > 0:
+            logger.info(
+                f"Token lengths: p50={report['percentiles']['p50']}, "
+                f"p99={report['percentiles']['p99']}, max={report['percentiles']['max']}; "
+                f"{report['truncated_fraction']:.2%} of texts exceed {report['max_length']} tokens; "
+                f"padding waste {report['padding_waste_sorted']:.2%}. Report: {report_path}"
             )
-            start_fold = end_fold
+        return report_path
+
+    def _num_encoder_workers(self) -> int:
+        """Number of encoder worker processes, one per device."""
+        if self.config.system.use_cuda:
+            return min(self.config.system.num_gpus, torch.cuda.device_count())
+        if self.config.system.cpu_mode:
+            return self.config.system.num_gpus
+        # In testing mode without GPU, use 1 CPU "worker"
+        return 1
+
+    def _encode_file_bundles(
+        self, input_files: List[str], output_dir: str
+    ) -> Dict[str, Tuple[Any, Optional[np.ndarray]]]:
+        """
+        Encode small input files together and split the embeddings per file.
+
+        Consecutive files with fewer than ``file_bundle_rows`` rows and identical
+        columns are concatenated into bundles of about ``file_bundle_rows`` rows,
+        so that many small files share forward batches and worker round trips.
+        Each file then finds its embeddings file in place and skips encoding.
+
+        Args:
+            input_files (List[str]): Input files processed separately.
+            output_dir (str): Output directory for results.
+
+        Returns:
+            Dict[str, Tuple[Any, Optional[np.ndarray]]]: Dataset and, in incremental
+            mode, row fingerprints of every input file loaded here, so that they
+            are not loaded and fingerprinted again.
+        """
+        max_rows = self.config.basic.file_bundle_rows
+        loaded: Dict[str, Tuple[Any, Optional[np.ndarray]]] = {}
+        bundle: List[Tuple[str, Any, Optional[np.ndarray]]] = []
+        bundle_rows = 0
+        for input_file in input_files:
+            embeddings_path = os.path.join(
+                output_dir, self.get_dataset_name(input_file), "embeddings", "embeddings.h5"
+            )
+            if os.path.exists(embeddings_path):
+                continue
+            dataset = self.load_and_combine_datasets([input_file])
+            row_fingerprints = None
+            if self.config.basic.incremental:
+                row_fingerprints = _compute_row_fingerprints(
+                    dataset, self.dataset_sources
+                )
+            loaded[input_file] = (dataset, row_fingerprints)
+            if len(dataset) >= max_rows:
+                continue
+
+            if bundle and dataset.features != bundle[0][1].features:
+                self._encode_file_bundle(bundle, output_dir)
+                bundle, bundle_rows = [], 0
+            bundle.append((input_file, dataset, row_fingerprints))
+            bundle_rows += len(dataset)
+            if bundle_rows >= max_rows:
+                self._encode_file_bundle(bundle, output_dir)
+                bundle, bundle_rows = [], 0
+        self._encode_file_bundle(bundle, output_dir)
+        return loaded
+
+    def _encode_file_bundle(
+        self,
+        bundle: List[Tuple[str, Any, Optional[np.ndarray]]],
+        output_dir: str,
+    ) -> None:
+        """
+        Encode the datasets of several input files at once and split the result.
+
+        Args:
+            bundle (List[Tuple[str, Any, Optional[np.ndarray]]]): Input files with
+                their datasets and, in incremental mode, row fingerprints.
+            output_dir (str): Output directory for results.
+        """
+        if len(bundle) < 2:
+            return  # A single file is encoded on its own
+
+        bundle_dir = os.path.join(output_dir, "_file_bundle")
+        bundle_path = os.path.join(bundle_dir, "embeddings.h5")
+        if self.is_main_process and os.path.exists(bundle_path):
+            os.remove(bundle_path)  # Left over from an interrupted run
+        self._barrier()
+        logger.info(
+            f"Encoding {len(bundle)} small files together "
+            f"({sum(len(dataset) for _, dataset, _ in bundle)} rows)"
+        )
+        self._encode_dataset(
+            concatenate_datasets([dataset for _, dataset, _ in bundle]),
+            bundle_dir,
+            bundle_path,
+        )
+
+        if not self.is_main_process:
+            self._barrier()
+            return
+
+        start = 0
+        with h5py.File(bundle_path, "r") as src:
+            for input_file, dataset, row_fingerprints in bundle:
+                end = start + len(dataset)
+                embeddings_dir = os.path.join(
+                    output_dir, self.get_dataset_name(input_file), "embeddings"
+                )
+                os.makedirs(embeddings_dir, exist_ok=True)
+                _write_embedding_rows(
+                    src,
+                    os.path.join(embeddings_dir, "embeddings.h5"),
+                    start,
+                    end,
+                    row_fingerprints,
+                )
+                start = end
+
+        os.remove(bundle_path)
+        if not os.listdir(bundle_dir):
+            os.rmdir(bundle_dir)
+        self._barrier()
+
+    def _update_embedding_cache(self, embedding_file: str, chunk_size: int = 100000):
+        """
+        Add the embeddings of a merged embeddings file to the persistent cache.
+
+        Args:
+            embedding_file (str): Path to the merged embeddings file.
+            chunk_size (int): Number of rows read from the file at a time.
+        """
+        cache = EmbeddingCache(
+            self.config.encoder.cache_dir,
+            max_size_gb=self.config.encoder.cache_max_size_gb,
+        )
+        inserted = 0
+        with h5py.File(embedding_file, "r") as f:
+            if "keys" not in f:
+                return
+            for start in range(0, f["embeddings"].shape[0], chunk_size):
+                end = start + chunk_size
+                embeddings = StoredEmbeddings.from_h5(f, slice(start, end))
+                inserted += cache.insert(
+                    keys_from_uint8(f["keys"][start:end]), embeddings.dequantize()
+                )
+        logger.info(
+            f"Added {inserted} new embeddings to the cache at {self.config.encoder.cache_dir}"
+        )
+
+    def select_subsets(
+        self,
+        dataset_name: str,
+        embeddings: Union[torch.Tensor, StoredEmbeddings],
+        weights: Optional[torch.Tensor] = None,
+        row_ids: Optional[np.ndarray] = None,
+        orderings_file: Optional[str] = None,
+        store_id: Optional[str] = None,
+    ) -> Dict[Union[int, float], List[int]]:
+        """
+        Enhanced subset selection supporting both percentage and absolute size specifications.
+
+        Greedy facility location solutions are nested, so every fold is optimized
+        once for its largest budget and each subset size takes a prefix of that
+        greedy ordering.
+
+        Args:
+            dataset_name (str): Name of the dataset, used for metadata file names.
+            embeddings (Union[torch.Tensor, StoredEmbeddings]): Embeddings of the
+                candidate examples. Stored embeddings are dequantized one fold at a time.
+            weights (Optional[torch.Tensor]): Per-candidate weights (e.g. duplicate
+                counts) applied to the facility location objective.
+            row_ids (Optional[np.ndarray]): Dataset row of each candidate, used to map
+                selected candidates back to the dataset. Defaults to the identity.
+            orderings_file (Optional[str]): File persisting the folds and their greedy
+                orderings. When it holds orderings of the same embeddings and selection
+                settings that are long enough for every requested size, they are reused
+                instead of optimizing again. Requires ``store_id``.
+            store_id (Optional[str]): Identity of the stored embeddings, see
+                ``_embeddings_store_id``.
+
+        Returns:
+            Dict[Union[int, float], List[int]]: Selected dataset rows per subset size.
+        """
+        if orderings_file is not None and store_id is None:
+            raise ValueError("Persisting greedy orderings requires a store_id")
+
+        indices = np.arange(len(embeddings))
+        np.random.shuffle(indices)
+        if self.distributed:
+            # All ranks must agree on the folds
+            shared = [indices]
+            dist.broadcast_object_list(shared, src=0)
+            indices = shared[0]
 
-        with Pool(processes=self.config.system.num_gpus) as pool:
-            gpu_results = pool.map(process_folds_with_gpu, gpu_assignments)
+        fold_size = len(embeddings) // self.config.basic.num_folds
+        remainder = len(embeddings) % self.config.basic.num_folds
 
-        all_results = []
-        for gpu_result in gpu_results:
-            all_results.extend(gpu_result)
+        folds = []
+        start_idx = 0
+        for i in range(self.config.basic.num_folds):
+            extra = 1 if i < remainder else 0
+            end_idx = start_idx + fold_size + extra
+            folds.append(indices[start_idx:end_idx])
+            start_idx = end_idx
+
+        # Sizes are relative to the dataset rows, not to its unique texts
+        total_samples = _num_rows(np.arange(len(embeddings)), weights)
+        orderings_key = None
+        all_results = None
+        if orderings_file is not None:
+            orderings_key = self._selection_key(store_id, weights)
+            stored = _load_greedy_orderings(orderings_file, orderings_key)
+            if stored is not None:
+                stored_folds, stored_results = stored
+                if all(
+                    len(result["indices"])
+                    >= max(
+                        _fold_budget(
+                            size,
+                            len(stored_folds[fold_idx]),
+                            total_samples,
+                            _num_rows(stored_folds[fold_idx], weights),
+                        )
+                        for size in self.config.subset_sizes
+                    )
+                    for fold_idx, result in stored_results
+                ):
+                    logger.info(f"Reusing greedy orderings from {orderings_file}")
+                    folds, all_results = stored_folds, stored_results
+                else:
+                    logger.info(
+                        f"Greedy orderings in {orderings_file} are shorter than the "
+                        "requested subset sizes, optimizing again"
+                    )
+
+        if all_results is None:
+            all_results = self._optimize_folds(
+                dataset_name, folds, embeddings, weights
+            )
+            if orderings_file is not None and self.is_main_process:
+                _save_greedy_orderings(orderings_file, orderings_key, folds, all_results)
+                logger.info(f"Saved greedy orderings to {orderings_file}")
 
         class SubsetData(TypedDict):
             indices: List[int]
@@ -418,20 +1319,27 @@ class DataProcessor:
         }
 
         for fold_idx, result in all_results:
+            fold_size = len(folds[fold_idx])
+            fold_rows = _num_rows(folds[fold_idx], weights)
             for size in self.config.subset_sizes:
-                combined_subsets[size]["indices"].extend(result[size]["indices"])
-                combined_subsets[size]["gains"].extend(result[size]["gains"])
+                # Greedy solutions are nested: a smaller budget is a prefix
+                budget = _fold_budget(size, fold_size, total_samples, fold_rows)
+                combined_subsets[size]["indices"].extend(result["indices"][:budget])
+                combined_subsets[size]["gains"].extend(result["gains"][:budget])
 
         base_name = dataset_name
         subsets = {}
 
         for size_spec in self.config.subset_sizes:
-            actual_size = self.calculate_subset_size(len(embeddings), size_spec)
+            actual_size = min(
+                self.calculate_subset_size(total_samples, size_spec), len(embeddings)
+            )
             logger.info(f"Actual subset size: {actual_size}")
             sorted_indices_gains = sorted(
                 zip(
                     combined_subsets[size_spec]["indices"],
                     combined_subsets[size_spec]["gains"],
+                    strict=True,
                 ),
                 key=lambda x: x[1],
                 reverse=True,
@@ -439,6 +1347,8 @@ class DataProcessor:
 
             sorted_indices = [x[0] for x in sorted_indices_gains]
             sorted_gains = [x[1] for x in sorted_indices_gains]
+            if row_ids is not None:
+                sorted_indices = [int(row_ids[x]) for x in sorted_indices]
 
             subset_name = self.get_subset_name(size_spec, actual_size)
             metadata_file = os.path.join(
@@ -446,12 +1356,94 @@ class DataProcessor:
                 f"{base_name}_fl_{self.config.basic.num_folds}_partitions_{subset_name}_metadata.npz",
             )
 
-            np.savez(metadata_file, indices=sorted_indices, gains=sorted_gains)
-            logger.info(f"Saved metadata to {metadata_file}")
+            if self.is_main_process:
+                np.savez(metadata_file, indices=sorted_indices, gains=sorted_gains)
+                logger.info(f"Saved metadata to {metadata_file}")
             subsets[size_spec] = sorted_indices
 
         return subsets
 
+    def _selection_key(self, store_id: str, weights: Optional[torch.Tensor]) -> str:
+        """Digest of everything the folds and their greedy orderings depend on."""
+        basic = self.config.basic
+        params = {
+            "store_id": store_id,
+            "num_folds": basic.num_folds,
+            "epsilon": basic.epsilon,
+            "similarity_mode": basic.similarity_mode,
+            "num_neighbors": basic.num_neighbors,
+            "ann_params": basic.ann_params,
+            "optimizer_backend": basic.optimizer_backend,
+            "seed": self.config.system.seed,
+        }
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8"))
+        # Deduplication weights hold one value per candidate, far less than the
+        # embeddings themselves
+        if weights is not None:
+            digest.update(np.ascontiguousarray(weights.cpu().numpy()).data)
+        return digest.hexdigest()
+
+    def _optimize_folds(
+        self,
+        dataset_name: str,
+        folds: List[np.ndarray],
+        embeddings: Union[torch.Tensor, StoredEmbeddings],
+        weights: Optional[torch.Tensor],
+    ) -> List[Tuple[int, Dict[str, List]]]:
+        """Run facility location on every fold; returns the greedy ordering of each fold."""
+        gpu_assignments = []
+        num_gpus = self.world_size if self.distributed else self.config.system.num_gpus
+        folds_per_gpu = self.config.basic.num_folds // num_gpus
+        extra_folds = self.config.basic.num_folds % num_gpus
+
+        start_fold = 0
+        for gpu_id in range(num_gpus):
+            num_folds_this_gpu = folds_per_gpu + (1 if gpu_id < extra_folds else 0)
+            end_fold = start_fold + num_folds_this_gpu
+            gpu_folds_info = [
+                (fold_idx, folds[fold_idx]) for fold_idx in range(start_fold, end_fold)
+            ]
+
+            gpu_assignments.append(
+                (
+                    gpu_id,
+                    gpu_folds_info,
+                    embeddings,
+                    self.config.subset_sizes,
+                    # Total rows for absolute size calculation
+                    _num_rows(np.arange(len(embeddings)), weights),
+                    self.config.basic.epsilon,
+                    self.config.system.testing_mode,  # Explicitly pass testing_mode
+                    weights,
+                    self.config.system.use_cuda,
+                    self.config.system.cpu_threads,
+                    self.local_rank if self.distributed else gpu_id,
+                    self.config.basic.similarity_mode,
+                    self.config.basic.num_neighbors,
+                    self.config.basic.ann_params,
+                    os.path.join(
+                        self.config.basic.output_dir, dataset_name, "embeddings", "ann"
+                    ),
+                    self.config.basic.optimizer_backend,
+                )
+            )
+            start_fold = end_fold
+
+        if self.distributed:
+            # Every rank processes its own folds; all ranks receive all results
+            gpu_results = [None] * self.world_size
+            dist.all_gather_object(
+                gpu_results, process_folds_with_gpu(gpu_assignments[self.rank])
+            )
+        else:
+            with Pool(processes=num_gpus) as pool:
+                gpu_results = pool.map(process_folds_with_gpu, gpu_assignments)
+
+        all_results = []
+        for gpu_result in gpu_results:
+            all_results.extend(gpu_result)
+        return all_results
+
     def get_dataset_name(self, input_file: str) -> str:
         """
         Get a clean dataset name from the input file path.
@@ -476,6 +1468,13 @@ class DataProcessor:
             input_files (List[str]): List of input files to process
             output_dir (str): Output directory for results
         """
+        if self.config.basic.profile_only:
+            # Tokenizer-only pass: no workers, no bundling and no encoding
+            self._profile_files(input_files, output_dir)
+            return
+
+        if self.config.basic.persistent_workers and not self.distributed:
+            self._encoder_pool = _EncoderWorkerPool(self._num_encoder_workers())
         try:
             if self.config.basic.combine_files:
                 # Process combined datasets
@@ -490,20 +1489,67 @@ class DataProcessor:
             else:
                 # Process each dataset separately
                 logger.info("Processing datasets separately...")
+                loaded = {}
+                if self.config.basic.file_bundle_rows > 0 and len(input_files) > 1:
+                    loaded = self._encode_file_bundles(input_files, output_dir)
                 for input_file in input_files:
-                    dataset = self.load_and_combine_datasets([input_file])
+                    row_fingerprints = None
+                    if input_file in loaded:
+                        dataset, row_fingerprints = loaded.pop(input_file)
+                        self.dataset_sources = [(input_file, len(dataset))]
+                    else:
+                        dataset = self.load_and_combine_datasets([input_file])
                     dataset_name = self.get_dataset_name(input_file)
                     logger.info(f"Processing dataset: {dataset_name}")
                     self._process_single_dataset(
-                        dataset, dataset_name, output_dir, input_file
+                        dataset, dataset_name, output_dir, input_file, row_fingerprints
                     )
 
         except Exception as e:
             logger.error(f"Error processing files: {str(e)}")
+            if self._encoder_pool is not None:
+                self._encoder_pool.terminate()
+                self._encoder_pool = None
             raise
 
+        finally:
+            if self._encoder_pool is not None:
+                self._encoder_pool.close()
+                self._encoder_pool = None
+
+    def _profile_files(self, input_files: List[str], output_dir: str) -> None:
+        """
+        Write the token length report of every dataset without loading the model.
+
+        Args:
+            input_files (List[str]): List of input files to profile
+            output_dir (str): Output directory for results
+        """
+        if self.config.basic.combine_files:
+            named_files = [("combined_dataset", input_files)]
+        else:
+            named_files = [
+                (self.get_dataset_name(input_file), [input_file])
+                for input_file in input_files
+            ]
+
+        if self.is_main_process:
+            for dataset_name, files in named_files:
+                dataset = self.load_and_combine_datasets(files)
+                logger.info(f"Profiling token lengths of {dataset_name}")
+                self._write_token_length_report(
+                    self._render_dataset(dataset),
+                    os.path.join(output_dir, dataset_name, "embeddings"),
+                )
+        self._barrier()
+
     def _process_single_dataset(
-        self, dataset, dataset_name: str, output_dir: str, input_file: str
+        self,
+        dataset,
+        dataset_name: str,
+        output_dir: str,
+        input_file: str,
+        row_fingerprints: Optional[np.ndarray] = None,
     ):
         """
         Process a single dataset (either combined or individual).
@@ -513,6 +1559,8 @@ class DataProcessor:
             dataset_name (str): Name of the dataset
             output_dir (str): Output directory
             input_file (str): Original input file path (for extension)
+            row_fingerprints (Optional[np.ndarray]): Row fingerprints computed
+                earlier in incremental mode; computed here when not given
         """
         try:
             # Validate epsilon based on dataset size
@@ -522,39 +1570,77 @@ class DataProcessor:
             dataset_output_dir = os.path.join(output_dir, dataset_name)
             os.makedirs(dataset_output_dir, exist_ok=True)
 
+            if self.config.basic.incremental and row_fingerprints is None:
+                logger.info(f"Fingerprinting rows of {dataset_name}")
+                row_fingerprints = _compute_row_fingerprints(
+                    dataset, self.dataset_sources
+                )
+
             logger.info(f"Generating embeddings for {dataset_name}")
             embedding_file = self.generate_embeddings(
-                dataset, os.path.join(dataset_output_dir, "embeddings")
+                dataset,
+                os.path.join(dataset_output_dir, "embeddings"),
+                row_fingerprints=row_fingerprints,
             )
 
             logger.info("Loading embeddings for subset selection")
             with h5py.File(embedding_file, "r") as f:
-                embeddings_data = f["embeddings"][:]
-                if embeddings_data.size == 0:
+                # Incremental stores may hold rows that are no longer in the dataset
+                current_rows = f["current_rows"][:] if "current_rows" in f else None
+                # Embeddings stay in their storage precision until a fold needs them
+                embeddings = StoredEmbeddings.from_h5(f, current_rows)
+                if embeddings.size == 0:
                     logger.warning(
                         f"No embeddings generated for dataset {dataset_name}, skipping subset selection"
                     )
                     return
-                embeddings = torch.tensor(embeddings_data, dtype=torch.float32)
+
+                store_id = _embeddings_store_id(f, embedding_file, current_rows)
+                weights, row_ids = None, None
+                if self.config.basic.deduplicate:
+                    if "keys" in f:
+                        keys = keys_from_uint8(f["keys"][:])
+                        if current_rows is not None:
+                            keys = keys[current_rows]
+                        row_ids, counts = _find_unique_rows(keys)
+                        logger.info(
+                            f"Collapsed {len(embeddings)} examples into {len(row_ids)} unique texts"
+                        )
+                        embeddings = embeddings.select(row_ids)
+                        weights = torch.tensor(counts, dtype=torch.float32)
+                    else:
+                        logger.warning(
+                            f"{embedding_file} has no text keys, skipping deduplication"
+                        )
 
             logger.info("Selecting subsets")
-            subsets = self.select_subsets(dataset_name, embeddings)
+            subsets = self.select_subsets(
+                dataset_name,
+                embeddings,
+                weights,
+                row_ids,
+                orderings_file=os.path.join(
+                    dataset_output_dir, GREEDY_ORDERINGS_FILE
+                ),
+                store_id=store_id,
+            )
 
-            logger.info("Saving subsets")
-            for size_spec, indices in subsets.items():
-                subset_data = dataset.select(indices)
-                subset_name = self.get_subset_name(size_spec, len(indices))
+            if self.is_main_process:
+                logger.info("Saving subsets")
+                for size_spec, indices in subsets.items():
+                    subset_data = dataset.select(indices)
+                    subset_name = self.get_subset_name(size_spec, len(indices))
 
-                # Create subset filename with dataset name
-                output_file = os.path.join(
-                    dataset_output_dir,
-                    f"{dataset_name}_{subset_name}_subset.{input_file.split('.')[-1]}",
-                )
+                    # Create subset filename with dataset name
+                    output_file = os.path.join(
+                        dataset_output_dir,
+                        f"{dataset_name}_{subset_name}_subset.{input_file.split('.')[-1]}",
+                    )
 
-                self._save_subset(subset_data, output_file, input_file)
-                logger.info(
-                    f"Saved subset with {len(indices)} samples to {output_file}"
-                )
+                    self._save_subset(subset_data, output_file, input_file)
+                    logger.info(
+                        f"Saved subset with {len(indices)} samples to {output_file}"
+                    )
 
             # Clean up resources
             del dataset, embeddings
@@ -585,157 +1671,695 @@ class DataProcessor:
 
 
 def _process_dataset_shard(args):
-    """Process a dataset shard on a specific GPU."""
+    """
+    Process a dataset shard (one work block) on this worker's device.
+
+    Embeddings are written to a preallocated shard file batch by batch, and the
+    completed row ranges are recorded in a progress manifest next to it. A worker
+    restarted on the same shard (after a crash, a retry or SIGTERM preemption)
+    resumes from the last committed batch.
+    """
     (
-        gpu_id,
+        shard_id,
         dataset_shard,
+        shard_range,
         output_dir,
         encoder_type,
-        encoder_model,
+        encoder_kwargs,
         instruction,
-        template_name,
-        templates,
         batch_size,
-        testing_mode,
+        prefetch_batches,
+        cache_dir,
+        storage_precision,
+        use_cuda,
+        device_index,
     ) = args
 
+    if device_index is None:
+        device_index = _WORKER_DEVICE_INDEX
+    device_label = "GPU" if use_cuda else "CPU worker"
+    device_name = f"{device_label} {device_index}"
+
     try:
         # Set the device for this process
-        if torch.cuda.is_available():
-            torch.cuda.set_device(gpu_id)
-            device = f"cuda:{gpu_id}"
-            logger.info(f"GPU {gpu_id} started processing {len(dataset_shard)} samples")
+        if use_cuda:
+            torch.cuda.set_device(device_index)
+            device = f"cuda:{device_index}"
         else:
             device = "cpu"
-            logger.info(f"CPU worker {gpu_id} started processing {len(dataset_shard)} samples")
-
-        encoder_cls = get_encoder_class(encoder_type)
+        logger.info(f"{device_name} started processing {len(dataset_shard)} samples of shard {shard_id}")
 
-        # Create encoder instance
-        encoder = encoder_cls(
-            model_name=encoder_model,
-            device=torch.device(device),
-            testing_mode=testing_mode,
-        )
+        if len(dataset_shard) == 0:
+            logger.warning(f"No embeddings generated for shard {shard_id} on {device_name}")
+            return None
 
-        # Set up Jinja environment for templating
-        env = Environment(loader=BaseLoader())
-        templates_dict = {k: env.from_string(v) for k, v in templates.items()}
+        # Reuse the encoder loaded by a previous shard in this worker process
+        encoder = _get_worker_encoder(encoder_type, encoder_kwargs, device)
 
         # Create shard-specific output directory
-        shard_dir = os.path.join(output_dir, f"shard_{gpu_id}")
+        shard_dir = os.path.join(output_dir, f"shard_{shard_id}")
         os.makedirs(shard_dir, exist_ok=True)
+        shard_file = os.path.join(shard_dir, f"embeddings_shard_{shard_id}.h5")
+        progress_file = os.path.join(shard_dir, SHARD_PROGRESS_FILE)
+
+        # Resume from a previous attempt on the same shard, or start a new shard file
+        shard_layout = {
+            "shard_range": list(shard_range),
+            "embedding_dim": encoder.embedding_dim,
+            "storage_precision": storage_precision,
+            "encoder": encoder.cache_key_fields,
+        }
+        key_fields = _cache_key_fields(encoder, instruction, storage_precision)
+        completed = _load_shard_progress(progress_file, shard_file, shard_layout)
+        if completed and not _committed_keys_match(
+            shard_file, dataset_shard, completed, key_fields
+        ):
+            # Same layout, but the rows of the shard are different texts now
+            logger.info(f"Ignoring checkpoint of shard {shard_id} for changed rows")
+            completed = None
+        if completed is None:
+            completed = []
+            with h5py.File(shard_file, "w") as h5f:
+                h5f.create_dataset(
+                    "embeddings",
+                    shape=(len(dataset_shard), encoder.embedding_dim),
+                    dtype=storage_dtype(storage_precision),
+                    chunks=(min(len(dataset_shard), 1024), encoder.embedding_dim),
+                )
+                h5f["embeddings"].attrs["precision"] = storage_precision
+                h5f.create_dataset(
+                    "keys",
+                    shape=(len(dataset_shard), KEY_SIZE),
+                    dtype="uint8",
+                    chunks=(min(len(dataset_shard), 1024), KEY_SIZE),
+                )
+                if storage_precision == "int8":
+                    h5f.create_dataset(
+                        "scales", shape=(len(dataset_shard),), dtype="float32"
+                    )
+            _save_shard_progress(progress_file, shard_layout, completed)
+        pending = _pending_ranges(completed, len(dataset_shard))
+        num_completed = len(dataset_shard) - sum(end - start for start, end in pending)
+        if num_completed:
+            logger.info(
+                f"Resuming shard {shard_id} with {num_completed} rows already committed"
+            )
 
-        # Process batches
-        all_embeddings = []
-        batch_texts = []
+        # Cache lookups are read-only here; new entries are added after merging
+        cache = EmbeddingCache(cache_dir) if cache_dir else None
+        num_cache_hits = 0
 
         # Create progress bar
-        device_name = f"GPU {gpu_id}" if torch.cuda.is_available() else f"CPU worker {gpu_id}"
         progress_bar = tqdm(
             desc=f"{device_name} generating embeddings",
             total=len(dataset_shard),
+            initial=num_completed,
             unit=" samples",
-            position=gpu_id,  # Stack progress bars
-            leave=True,
+            position=device_index,  # Stack progress bars
+            leave=False,
         )
 
-        # Process each example in the shard
-        for idx, example in enumerate(dataset_shard):
-            # Format the text using the template
-            template = templates_dict.get(template_name)
-            if not template:
-                raise ValueError(f"Unknown format type: {template_name}")
-
-            text = template.render(**example)
-            batch_texts.append(text)
-
-            # Process when batch is full or at the end
-            if len(batch_texts) == batch_size or idx == len(dataset_shard) - 1:
-                # Generate embeddings for this batch
-                with torch.no_grad():
-                    batch_embeddings = (
-                        encoder.encode(
-                            inputs=batch_texts,
-                            instruction=instruction,
-                        )
-                        .cpu()
-                        .numpy()
-                    )
-
-                all_embeddings.append(batch_embeddings)
-                progress_bar.update(len(batch_texts))
-                batch_texts = []
+        # Cache lookups and tokenization run on a background thread
+        # so that the next batch is prepared while the model encodes the current one
+        prepared_batches = prefetch_iterator(
+            _prepare_shard_batches(
+                encoder,
+                dataset_shard,
+                instruction,
+                batch_size,
+                cache,
+                pending,
+                key_fields=key_fields,
+            ),
+            max_prefetch=prefetch_batches,
+        )
+        # Reused for every batch so that worker memory stays O(batch_size)
+        batch_buffer = np.empty(
+            (min(batch_size, len(dataset_shard)), encoder.embedding_dim),
+            dtype=np.float32,
+        )
+        # Pool workers keep the default SIGTERM action, which Pool.terminate() relies
+        # on; the main process stops them instead (see _EncoderWorkerPool.map_shards)
+        with _TerminationGuard(
+            enabled=not _IN_ENCODER_WORKER
+        ) as termination, h5py.File(shard_file, "a") as h5f:
+            for shard_batch in prepared_batches:
+                # Encoded texts fill the front of the buffer, cached ones follow
+                num_misses = len(shard_batch.miss_positions)
+                num_hits = len(shard_batch.hit_positions)
+                if shard_batch.prepared:
+                    encoder.encode_into(shard_batch.prepared, batch_buffer)
+                batch_buffer[num_misses : num_misses + num_hits] = (
+                    shard_batch.hit_embeddings
+                )
+                buffer_rows = np.empty(shard_batch.num_unique, dtype=np.int64)
+                buffer_rows[shard_batch.miss_positions] = np.arange(num_misses)
+                buffer_rows[shard_batch.hit_positions] = np.arange(
+                    num_misses, num_misses + num_hits
+                )
+                buffer_rows = buffer_rows[shard_batch.inverse]
+
+                # Commit the batch: write it, then record it in the manifest
+                start = shard_batch.offset
+                end = start + len(shard_batch.keys)
+                if np.array_equal(buffer_rows, np.arange(end - start)):
+                    batch_embeddings = batch_buffer[: end - start]
+                else:
+                    batch_embeddings = batch_buffer[buffer_rows]
+                stored, scales = quantize_embeddings(batch_embeddings, storage_precision)
+                h5f["embeddings"][start:end] = stored
+                if scales is not None:
+                    h5f["scales"][start:end] = scales
+                h5f["keys"][start:end] = keys_to_uint8(shard_batch.keys)
+                h5f.flush()
+                completed.append((start, end))
+                _save_shard_progress(progress_file, shard_layout, completed)
+
+                num_cache_hits += len(shard_batch.hit_positions)
+                progress_bar.update(len(shard_batch.keys))
 
                 # Clean up GPU memory
-                if torch.cuda.is_available():
+                if use_cuda:
                     torch.cuda.empty_cache()
 
-        progress_bar.close()
-
-        # Concatenate all batches
-        if not all_embeddings:
-            device_label = "GPU" if torch.cuda.is_available() else "CPU worker"
-            logger.warning(f"No embeddings generated for shard on {device_label} {gpu_id}")
-            return None
+                if termination.requested:
+                    raise TerminationRequested(
+                        f"{device_name} received SIGTERM, stopping after rows "
+                        f"[{start}, {end}) of shard {shard_id} were committed"
+                    )
 
-        embeddings = np.concatenate(all_embeddings, axis=0)
+        progress_bar.close()
 
-        # Save embeddings to file
-        shard_file = os.path.join(shard_dir, f"embeddings_shard_{gpu_id}.h5")
-        with h5py.File(shard_file, "w") as h5f:
-            h5f.create_dataset("embeddings", data=embeddings, dtype="float32")
+        if cache is not None:
+            logger.info(
+                f"{device_name} reused {num_cache_hits} of {len(dataset_shard)} embeddings from cache"
+            )
 
-        device_label = "GPU" if torch.cuda.is_available() else "CPU worker"
-        logger.info(f"{device_label} {gpu_id} completed processing. Saved to {shard_file}")
+        logger.info(f"{device_name} completed shard {shard_id}. Saved to {shard_file}")
         return shard_file
 
     # pylint: disable=broad-exception-caught
     except Exception as e:
-        device_label = "GPU" if torch.cuda.is_available() else "CPU worker"
-        logger.error(f"Error processing shard on {device_label} {gpu_id}: {str(e)}")
+        logger.error(f"Error processing shard {shard_id} on {device_name}: {str(e)}")
         raise
 
 
-def _merge_shard_files(shard_files, merged_file):
+# Encoder loaded in this worker process, with the settings it was created with
+_WORKER_ENCODER: Optional[Tuple[str, Any]] = None
+
+
+def _get_worker_encoder(encoder_type: str, encoder_kwargs: Dict[str, Any], device: str):
+    """Return the encoder of this worker process, loading it on first use."""
+    global _WORKER_ENCODER  # pylint: disable=global-statement
+
+    encoder_key = json.dumps(
+        [encoder_type, encoder_kwargs, device], sort_keys=True, default=str
+    )
+    if _WORKER_ENCODER is not None and _WORKER_ENCODER[0] == encoder_key:
+        return _WORKER_ENCODER[1]
+
+    _WORKER_ENCODER = None
+    gc.collect()
+    encoder_cls = get_encoder_class(encoder_type)
+    encoder = encoder_cls(device=torch.device(device), **encoder_kwargs)
+    _WORKER_ENCODER = (encoder_key, encoder)
+    return encoder
+
+
+# Device of this worker process, claimed from the pool's device queue at startup
+_WORKER_DEVICE_INDEX = 0
+# Whether this process is an encoder pool worker
+_IN_ENCODER_WORKER = False
+
+
+def _init_encoder_worker(device_queue) -> None:
+    """Claim a device for this pool worker."""
+    global _WORKER_DEVICE_INDEX, _IN_ENCODER_WORKER  # pylint: disable=global-statement
+    _WORKER_DEVICE_INDEX = device_queue.get()
+    _IN_ENCODER_WORKER = True
+    # Pool.terminate() stops workers with SIGTERM; never inherit a handler for it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+class _EncoderWorkerPool:
+    """
+    Long-lived encoder workers, one per device.
+
+    Every worker claims a device when it starts and keeps its encoder loaded
+    between jobs, so the model is loaded once per run instead of once per input
+    file. Shard jobs wait on a shared queue and idle workers pull the next one,
+    so devices that finish early take over work from slower ones.
+    """
+
+    def __init__(self, num_workers: int):
+        device_queue = mp.Queue()
+        for device_index in range(num_workers):
+            device_queue.put(device_index)
+        self._pool = Pool(
+            processes=num_workers,
+            initializer=_init_encoder_worker,
+            initargs=(device_queue,),
+        )
+
+    def map_shards(
+        self, args_list: List[tuple], order: Optional[Sequence[int]] = None
+    ) -> List[Optional[str]]:
+        """
+        Run ``_process_dataset_shard`` for every shard on whichever worker is free.
+
+        Args:
+            args_list (List[tuple]): ``_process_dataset_shard`` arguments of every shard.
+            order (Optional[Sequence[int]]): Order in which the shards are queued,
+                e.g. longest first. Defaults to the order of ``args_list``.
+
+        Returns:
+            List[Optional[str]]: Shard file of every shard, in the order of ``args_list``.
+        """
+        order = list(range(len(args_list)) if order is None else order)
+        results: List[Optional[str]] = [None] * len(args_list)
+        # On SIGTERM, stop waiting; the caller terminates the workers, which lose
+        # at most their uncommitted batch
+        with _TerminationGuard(raise_on_signal=True):
+            shard_files = self._pool.imap(
+                _process_dataset_shard, [args_list[i] for i in order], chunksize=1
+            )
+            for i, shard_file in zip(order, shard_files, strict=True):
+                results[i] = shard_file
+        return results
+
+    def close(self) -> None:
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self) -> None:
+        self._pool.terminate()
+        self._pool.join()
+
+
+class _TerminationGuard:
+    """
+    Context manager that handles SIGTERM from a scheduler.
+
+    By default SIGTERM only sets a flag checked between batches, so a preempted
+    rank can commit its current batch before exiting. With ``raise_on_signal``,
+    it raises ``TerminationRequested`` at once, e.g. to stop waiting on workers.
+    When not ``enabled``, SIGTERM keeps its current action.
+    """
+
+    def __init__(self, raise_on_signal: bool = False, enabled: bool = True):
+        self.requested = False
+        self.raise_on_signal = raise_on_signal
+        self.enabled = enabled
+        self._previous_handler = None
+
+    def _handle(self, signum, frame):  # pylint: disable=unused-argument
+        self.requested = True
+        if self.raise_on_signal:
+            raise TerminationRequested("SIGTERM received, stopping the encoder workers")
+        logger.warning("SIGTERM received, finishing the current batch")
+
+    def __enter__(self):
+        # Signal handlers can only be installed from the main thread
+        if self.enabled and threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(signal.SIGTERM, self._handle)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._previous_handler is not None:
+            signal.signal(signal.SIGTERM, self._previous_handler)
+        return False
+
+
+def _pending_ranges(
+    completed: List[Tuple[int, int]], num_rows: int
+) -> List[Tuple[int, int]]:
+    """Return the row ranges of ``[0, num_rows)`` not covered by ``completed``."""
+    pending = []
+    position = 0
+    for start, end in sorted(completed):
+        if start > position:
+            pending.append((position, start))
+        position = max(position, end)
+    if position < num_rows:
+        pending.append((position, num_rows))
+    return pending
+
+
+def _load_shard_progress(
+    progress_file: str, shard_file: str, shard_layout: Dict[str, Any]
+) -> Optional[List[Tuple[int, int]]]:
+    """
+    Load the completed row ranges of a previous attempt on the same shard.
+
+    Args:
+        progress_file (str): Path of the shard's progress manifest.
+        shard_file (str): Path of the shard's embeddings file.
+        shard_layout (Dict[str, Any]): Shard range and storage settings of the
+            current attempt; a checkpoint is only reused if they match.
+
+    Returns:
+        Optional[List[Tuple[int, int]]]: Completed ranges, or None when there is no
+        usable checkpoint (missing, or written for a different shard layout).
+    """
+    if not (os.path.exists(progress_file) and os.path.exists(shard_file)):
+        return None
+    with open(progress_file, encoding="utf-8") as f:
+        progress = json.load(f)
+    if any(progress.get(key) != value for key, value in shard_layout.items()):
+        logger.info(f"Ignoring stale checkpoint {progress_file}")
+        return None
+    return [tuple(r) for r in progress["completed"]]
+
+
+def _save_shard_progress(
+    progress_file: str,
+    shard_layout: Dict[str, Any],
+    completed: List[Tuple[int, int]],
+) -> None:
+    """Atomically write the progress manifest of a shard."""
+    # Merge adjacent ranges to keep the manifest small
+    merged: List[List[int]] = []
+    for start, end in sorted(completed):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    tmp_file = f"{progress_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump({**shard_layout, "completed": merged}, f)
+    os.replace(tmp_file, progress_file)
+
+
+@dataclass
+class _ShardBatch:
+    """
+    A tokenized batch of shard examples, ready for the encoder.
+
+    Identical texts are only looked up and encoded once: ``hit_positions`` and
+    ``miss_positions`` index the batch's unique texts, and ``inverse`` maps every
+    example back to its unique text.
+    """
+
+    offset: int
+    keys: np.ndarray
+    inverse: np.ndarray
+    num_unique: int
+    hit_positions: np.ndarray
+    hit_embeddings: np.ndarray
+    miss_positions: np.ndarray
+    prepared: List[Any]
+
+
+def _cache_key_fields(
+    encoder, instruction: str, storage_precision: str = "float32"
+) -> Dict[str, Any]:
+    """Everything besides the text that the cache key of an embedding covers."""
+    key_fields = {**encoder.cache_key_fields, "instruction": instruction}
+    # The cache is filled from the stored embeddings, which are lossy in reduced
+    # precision; keep those entries apart from exact float32 ones
+    if storage_precision != "float32":
+        key_fields["storage_precision"] = storage_precision
+    return key_fields
+
+
+def _committed_keys_match(
+    shard_file: str,
+    dataset_shard,
+    completed: List[Tuple[int, int]],
+    key_fields: Dict[str, Any],
+    chunk_size: int = 100000,
+) -> bool:
+    """Check that the committed rows of a shard file hold the shard's current texts."""
+    with h5py.File(shard_file, "r") as h5f:
+        for range_start, range_end in completed:
+            for start in range(range_start, range_end, chunk_size):
+                end = min(start + chunk_size, range_end)
+                keys = compute_cache_keys(
+                    dataset_shard[start:end][RENDERED_TEXT_COLUMN], key_fields
+                )
+                if not np.array_equal(keys, keys_from_uint8(h5f["keys"][start:end])):
+                    return False
+    return True
+
+
+def _prepare_shard_batch(
+    encoder, offset, texts, instruction, cache, key_fields
+) -> _ShardBatch:
+    """Compute cache keys for rendered texts and tokenize unique texts not found in the cache."""
+    keys = compute_cache_keys(texts, key_fields)
+    _, unique_positions, inverse = np.unique(
+        keys, return_index=True, return_inverse=True
+    )
+    unique_keys = keys[unique_positions]
+
+    if cache is not None:
+        hit_positions, hit_embeddings = cache.lookup(unique_keys, encoder.embedding_dim)
+    else:
+        hit_positions = np.empty(0, dtype=np.int64)
+        hit_embeddings = np.empty((0, encoder.embedding_dim), dtype=np.float32)
+
+    is_miss = np.ones(len(unique_keys), dtype=bool)
+    is_miss[hit_positions] = False
+    miss_positions = np.flatnonzero(is_miss)
+
+    prepared = []
+    if len(miss_positions) > 0:
+        prepared = encoder.prepare_batches(
+            [texts[unique_positions[i]] for i in miss_positions], instruction
+        )
+    return _ShardBatch(
+        offset=offset,
+        keys=keys,
+        inverse=inverse.reshape(-1),
+        num_unique=len(unique_keys),
+        hit_positions=hit_positions,
+        hit_embeddings=hit_embeddings,
+        miss_positions=miss_positions,
+        prepared=prepared,
+    )
+
+
+def _prepare_shard_batches(
+    encoder,
+    dataset_shard,
+    instruction,
+    batch_size,
+    cache=None,
+    ranges=None,
+    key_fields=None,
+):
+    """
+    Tokenize the rendered texts of a dataset shard in batches of ``batch_size`` examples.
+
+    Args:
+        ranges (Optional[List[Tuple[int, int]]]): Row ranges of the shard to
+            process. Defaults to the whole shard.
+        key_fields (Optional[Dict[str, Any]]): Cache key fields of the texts.
+            Defaults to those of float32 storage.
+
+    Yields:
+        _ShardBatch: The batch's shard offset, cache keys, cached embeddings and
+        the encoder's prepared forward batches for the remaining examples.
+    """
+    if ranges is None:
+        ranges = [(0, len(dataset_shard))]
+    if key_fields is None:
+        key_fields = _cache_key_fields(encoder, instruction)
+
+    for range_start, range_end in ranges:
+        for offset in range(range_start, range_end, batch_size):
+            end = min(offset + batch_size, range_end)
+            batch_texts = dataset_shard[offset:end][RENDERED_TEXT_COLUMN]
+            yield _prepare_shard_batch(
+                encoder, offset, batch_texts, instruction, cache, key_fields
+            )
+
+
+def _compute_row_fingerprints(dataset, sources: List[Tuple[str, int]]) -> np.ndarray:
+    """
+    Fingerprint every dataset row by its source file name and content.
+
+    Args:
+        dataset: The (possibly concatenated) dataset.
+        sources (List[Tuple[str, int]]): Source file and row count of each part of
+            the dataset, in concatenation order.
+
+    Returns:
+        np.ndarray: SHA-256 digest of every row with dtype ``S32``.
+    """
+    row_sources = [
+        os.path.basename(input_file)
+        for input_file, num_rows in sources
+        for _ in range(num_rows)
+    ]
+    if len(row_sources) != len(dataset):
+        raise ValueError("Dataset sources do not match the dataset length")
+
+    fingerprints = np.empty(len(dataset), dtype=KEY_DTYPE)
+    for idx, (source, example) in enumerate(zip(row_sources, dataset, strict=True)):
+        content = json.dumps(example, sort_keys=True, default=str)
+        fingerprints[idx] = hashlib.sha256(
+            f"{source}\0{content}".encode("utf-8")
+        ).digest()
+    return fingerprints
+
+
+def _create_row_index(h5f, row_fingerprints: np.ndarray, current_rows: np.ndarray):
+    """Add the datasets that make an embeddings file an incremental store."""
+    h5f.create_dataset(
+        "row_fingerprints",
+        data=keys_to_uint8(row_fingerprints),
+        maxshape=(None, KEY_SIZE),
+        dtype="uint8",
+    )
+    h5f.create_dataset("current_rows", data=current_rows, dtype="int64")
+
+
+def _write_embedding_rows(
+    src,
+    embeddings_path: str,
+    start: int,
+    end: int,
+    row_fingerprints: Optional[np.ndarray] = None,
+) -> None:
+    """
+    Write rows ``start:end`` of an open embeddings file to a new embeddings file.
+
+    The datasets are resizable like those of ``_merge_shard_files``, so the new
+    file can become an incremental store. With ``row_fingerprints``, it is
+    created as one.
+    """
+    tmp_path = f"{embeddings_path}.tmp"
+    with h5py.File(tmp_path, "w") as dst:
+        for name, source in src.items():
+            dst.create_dataset(
+                name,
+                data=source[start:end],
+                maxshape=(None, *source.shape[1:]),
+            )
+            dst[name].attrs.update(source.attrs)
+        if row_fingerprints is not None:
+            _create_row_index(dst, row_fingerprints, np.arange(end - start))
+    os.replace(tmp_path, embeddings_path)
+
+
+def _append_embedding_file(
+    store_path: str, delta_path: str, row_fingerprints: np.ndarray
+) -> int:
+    """
+    Append the rows of a merged embeddings file to an incremental embeddings store.
+
+    Rows are appended after the last fingerprinted row, so an append interrupted
+    before its fingerprints were written is simply overwritten by the next one.
+
+    Returns:
+        int: Store row of the first appended embedding.
+    """
+    with h5py.File(store_path, "a") as store_f, h5py.File(delta_path, "r") as delta_f:
+        start = store_f["row_fingerprints"].shape[0]
+        end = start + len(row_fingerprints)
+        if store_f["embeddings"].dtype != delta_f["embeddings"].dtype:
+            raise ValueError(
+                f"Cannot append {delta_f['embeddings'].dtype} embeddings to a store of "
+                f"{store_f['embeddings'].dtype} embeddings; use the store's storage precision"
+            )
+        for name in delta_f:
+            store_f[name].resize(end, axis=0)
+            store_f[name][start:end] = delta_f[name][:]
+        store_f["row_fingerprints"].resize(end, axis=0)
+        store_f["row_fingerprints"][start:end] = keys_to_uint8(row_fingerprints)
+    return start
+
+
+def _find_unique_rows(keys: np.ndarray):
+    """
+    Find the first row of every distinct key and how often each key occurs.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: First row of each distinct key in row order,
+        and the number of rows sharing that key.
+    """
+    _, first_rows, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first_rows)
+    return first_rows[order], counts[order]
+
+
+def _merge_shard_files(shard_files, merged_file, virtual=False, chunk_size=100000):
     """
     Merge all shard files into a single embeddings file.
+
+    With ``virtual`` set, the merged file only holds HDF5 virtual datasets that map
+    onto the shard files, so merging is a metadata operation; the shard files are
+    kept and must stay next to the merged file. Otherwise the shards are copied
+    chunk by chunk into resizable datasets and removed afterwards.
     """
     logger.info(f"Merging {len(shard_files)} shard files into {merged_file}")
 
-    # Get the shape and type of embeddings from the first shard
+    # Get the shape and type of every dataset from the first shard
     with h5py.File(shard_files[0], "r") as f:
-        first_embeddings = f["embeddings"]
-        embedding_dim = first_embeddings.shape[1]
-        dtype = first_embeddings.dtype
+        layouts = {name: (f[name].shape[1:], f[name].dtype) for name in f}
+        attrs = {name: dict(f[name].attrs) for name in f}
 
-    # Count total samples across all shards
-    total_samples = 0
+    # Count samples in each shard
+    shard_sizes = []
     for shard_file in shard_files:
         with h5py.File(shard_file, "r") as f:
-            total_samples += f["embeddings"].shape[0]
-
-    # Create the merged file
-    with h5py.File(merged_file, "w") as merged_f:
-        merged_dataset = merged_f.create_dataset(
-            "embeddings", shape=(total_samples, embedding_dim), dtype=dtype
-        )
-
-        # Copy embeddings from each shard
-        start_idx = 0
-        for shard_file in shard_files:
-            with h5py.File(shard_file, "r") as shard_f:
-                embeddings = shard_f["embeddings"][:]
-                end_idx = start_idx + embeddings.shape[0]
-                merged_dataset[start_idx:end_idx] = embeddings
-                start_idx = end_idx
-
-            # Remove shard file after merging
-            os.remove(shard_file)
-            # Remove shard directory if empty
-            shard_dir = os.path.dirname(shard_file)
-            if not os.listdir(shard_dir):
-                os.rmdir(shard_dir)
+            shard_sizes.append(f["embeddings"].shape[0])
+    total_samples = sum(shard_sizes)
+
+    if virtual:
+        merged_dir = os.path.dirname(os.path.abspath(merged_file))
+        with h5py.File(merged_file, "w") as merged_f:
+            for name, (row_shape, dtype) in layouts.items():
+                layout = h5py.VirtualLayout(
+                    shape=(total_samples, *row_shape), dtype=dtype
+                )
+                start_idx = 0
+                for shard_file, num_rows in zip(shard_files, shard_sizes, strict=True):
+                    # Relative paths are resolved against the merged file's directory
+                    source = h5py.VirtualSource(
+                        os.path.relpath(os.path.abspath(shard_file), merged_dir),
+                        name,
+                        shape=(num_rows, *row_shape),
+                    )
+                    layout[start_idx : start_idx + num_rows] = source
+                    start_idx += num_rows
+                merged_f.create_virtual_dataset(name, layout)
+                merged_f[name].attrs.update(attrs[name])
+    else:
+        with h5py.File(merged_file, "w") as merged_f:
+            # Resizable so that incremental runs can append to the file
+            for name, (row_shape, dtype) in layouts.items():
+                merged_f.create_dataset(
+                    name,
+                    shape=(total_samples, *row_shape),
+                    maxshape=(None, *row_shape),
+                    dtype=dtype,
+                )
+                merged_f[name].attrs.update(attrs[name])
+
+            # Copy each shard in chunks to bound memory use
+            start_idx = 0
+            for shard_file, num_rows in zip(shard_files, shard_sizes, strict=True):
+                with h5py.File(shard_file, "r") as shard_f:
+                    for offset in range(0, num_rows, chunk_size):
+                        end = min(offset + chunk_size, num_rows)
+                        for name in layouts:
+                            merged_f[name][start_idx + offset : start_idx + end] = (
+                                shard_f[name][offset:end]
+                            )
+                start_idx += num_rows
+
+                # Remove shard file and its progress manifest after merging
+                os.remove(shard_file)
+                shard_dir = os.path.dirname(shard_file)
+                progress_file = os.path.join(shard_dir, SHARD_PROGRESS_FILE)
+                if os.path.exists(progress_file):
+                    os.remove(progress_file)
+                # Remove shard directory if empty
+                if not os.listdir(shard_dir):
+                    os.rmdir(shard_dir)
 
     device_label = "GPUs" if torch.cuda.is_available() else "CPU workers"
     logger.info(
@@ -743,6 +2367,213 @@ def _merge_shard_files(shard_files, merged_file):
     )
 
 
+def _num_rows(candidates: np.ndarray, weights: Optional[torch.Tensor]) -> int:
+    """Number of dataset rows the given candidates stand for (their duplicate counts)."""
+    if weights is None:
+        return len(candidates)
+    return int(round(float(weights[torch.as_tensor(candidates)].sum())))
+
+
+def _fold_budget(
+    size_spec: Union[int, float],
+    fold_size: int,
+    total_samples: int,
+    fold_rows: Optional[int] = None,
+) -> int:
+    """
+    Number of examples a fold contributes to a subset of the given size.
+
+    ``total_samples`` and ``fold_rows`` count dataset rows; with deduplication,
+    a fold of ``fold_size`` unique texts stands for ``fold_rows`` rows.
+    """
+    if fold_rows is None:
+        fold_rows = fold_size
+    if isinstance(size_spec, float):
+        # Percentage-based selection
+        budget = math.ceil(size_spec * fold_rows)
+    else:
+        # Absolute number-based selection
+        budget = math.ceil(size_spec * (fold_rows / total_samples))
+    return max(1, min(budget, fold_size))
+
+
+def _embeddings_store_id(
+    h5f, path: str, current_rows: Optional[np.ndarray] = None
+) -> str:
+    """
+    Cheap identity of the embeddings held by an open embeddings file.
+
+    The text keys of the rows cover both their texts and the encoder settings,
+    so their digest identifies the embeddings without reading them; files
+    without keys fall back to their path, size and modification time. The
+    shape and precision of the embeddings and the selected ``current_rows`` of
+    incremental stores are included as well.
+    """
+    digest = hashlib.sha256()
+    embeddings = h5f["embeddings"]
+    identity = {
+        "shape": list(embeddings.shape),
+        "precision": str(embeddings.attrs.get("precision", "float32")),
+    }
+    if "keys" in h5f:
+        digest.update(np.ascontiguousarray(h5f["keys"][:]).data)
+    else:
+        stat = os.stat(path)
+        identity.update(
+            path=os.path.abspath(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns
+        )
+    digest.update(json.dumps(identity, sort_keys=True).encode("utf-8"))
+    if current_rows is not None:
+        digest.update(np.ascontiguousarray(current_rows, dtype=np.int64).data)
+    return digest.hexdigest()
+
+
+def _save_greedy_orderings(
+    path: str,
+    key: str,
+    folds: List[np.ndarray],
+    fold_results: List[Tuple[int, Dict[str, List]]],
+) -> None:
+    """Persist the folds and the greedy ordering of every fold."""
+    results = dict(fold_results)
+    orderings = [results[fold_idx] for fold_idx in range(len(folds))]
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            key=np.array(key),
+            folds=np.concatenate(folds).astype(np.int64),
+            fold_offsets=np.cumsum([0] + [len(fold) for fold in folds]),
+            indices=np.array(
+                [idx for ordering in orderings for idx in ordering["indices"]],
+                dtype=np.int64,
+            ),
+            gains=np.array(
+                [gain for ordering in orderings for gain in ordering["gains"]],
+                dtype=np.float64,
+            ),
+            ordering_offsets=np.cumsum(
+                [0] + [len(ordering["indices"]) for ordering in orderings]
+            ),
+        )
+    os.replace(tmp_path, path)
+
+
+def _load_greedy_orderings(
+    path: str, key: str
+) -> Optional[Tuple[List[np.ndarray], List[Tuple[int, Dict[str, List]]]]]:
+    """Load persisted folds and greedy orderings, or None if missing or stale."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if str(data["key"]) != key:
+            logger.info(f"Greedy orderings in {path} were computed for other inputs")
+            return None
+        fold_offsets, ordering_offsets = data["fold_offsets"], data["ordering_offsets"]
+        folds = [
+            data["folds"][start:end]
+            for start, end in zip(fold_offsets[:-1], fold_offsets[1:], strict=True)
+        ]
+        indices, gains = data["indices"].tolist(), data["gains"].tolist()
+    fold_results = [
+        (fold_idx, {"indices": indices[start:end], "gains": gains[start:end]})
+        for fold_idx, (start, end) in enumerate(
+            zip(ordering_offsets[:-1], ordering_offsets[1:], strict=True)
+        )
+    ]
+    return folds, fold_results
+
+
+def _build_fold_similarity(
+    fold_embeddings: torch.Tensor,
+    fold_weights: Optional[torch.Tensor],
+    similarity_mode: str,
+    num_neighbors: int,
+    device: str,
+    ann_params: Optional[Dict[str, Any]] = None,
+    ann_index_dir: Optional[str] = None,
+    fold_name: str = "fold",
+    num_threads: Optional[int] = None,
+    output_device: str = "cpu",
+) -> Dict[str, Any]:
+    """
+    Build the similarity kernel of a fold.
+
+    Similarities are cosine similarities mapped to ``[0, 1]``. With weights, row
+    ``i`` counts ``fold_weights[i]`` times in the facility location objective.
+
+    Returns:
+        Dict[str, Any]: Kernel arguments of ``FacilityLocationFunction``: a
+        symmetric scipy CSR matrix in sparse modes, and a tensor on ``output_device`` in dense mode.
+        In streaming mode, the embeddings and weights of an ``EmbeddingKernel``.
+    """
+    if similarity_mode == "streaming":
+        return {
+            "embeddings": fold_embeddings,
+            "weights": fold_weights,
+            "mode": "streaming",
+        }
+
+    if similarity_mode in ("sparse", "ann"):
+        # Third Party
+        # pylint: disable=import-error, import-outside-toplevel
+        from scipy.sparse import csr_matrix
+
+        if similarity_mode == "ann":
+            index_path = None
+            if ann_index_dir is not None:
+                index_path = ann_index_path(
+                    ann_index_dir,
+                    fold_name,
+                    fold_embeddings.cpu().numpy(),
+                    ann_params,
+                )
+            values, indices = compute_ann_similarities(
+                fold_embeddings,
+                num_neighbors,
+                ann_params,
+                index_path=index_path,
+                num_threads=num_threads,
+                scaling="additive",
+            )
+        else:
+            values, indices = compute_topk_similarities(
+                fold_embeddings, num_neighbors, device=device, scaling="additive"
+            )
+        # Approximate search may return fewer than k neighbours for some rows
+        num_rows, k = values.shape
+        found = (indices >= 0).numpy()
+        sijs = csr_matrix(
+            (
+                values.numpy()[found],
+                indices.numpy()[found],
+                np.concatenate([[0], np.cumsum(found.sum(axis=1))]),
+            ),
+            shape=(num_rows, num_rows),
+        )
+        # Symmetrize before weighting: the fallback to sijs[j, i] for a missing
+        # sijs[i, j] would otherwise carry the weight of row j into row i
+        sijs = symmetrize_knn_graph(sijs)
+        if fold_weights is not None:
+            # Weighted facility location: row i counts weights[i] times
+            sijs = sijs.multiply(fold_weights.cpu().numpy().reshape(-1, 1)).tocsr()
+            sijs.sort_indices()
+        return {"sijs": sijs, "mode": "sparse", "num_neighbors": k}
+
+    max_sim_mat = compute_pairwise_dense(
+        fold_embeddings,
+        batch_size=50000,
+        metric="cosine",
+        device=device,
+        scaling="additive",
+        output_device=output_device,
+    )
+    if fold_weights is not None:
+        # Weighted facility location: row i counts weights[i] times
+        max_sim_mat *= fold_weights.to(max_sim_mat.device).unsqueeze(1)
+    return {"sijs": max_sim_mat, "mode": "dense"}
+
+
 def process_folds_with_gpu(args):
     """
     Process folds on GPU or CPU with support for both percentage and absolute size specifications.
@@ -755,16 +2586,25 @@ def process_folds_with_gpu(args):
         total_samples,
         epsilon,
         testing_mode,
+        weights,
+        use_cuda,
+        num_threads,
+        device_index,
+        similarity_mode,
+        num_neighbors,
+        ann_params,
+        ann_index_dir,
+        optimizer_backend,
     ) = args
 
-    # Third Party
-    # pylint: disable=import-error, import-outside-toplevel
-    from submodlib import FacilityLocationFunction
-
     try:
-        if torch.cuda.is_available():
-            torch.cuda.set_device(gpu_id)
-            device = f"cuda:{gpu_id}"
+        if use_cuda:
+            torch.cuda.set_device(device_index)
+            device = f"cuda:{device_index}"
+        elif num_threads is not None:
+            # Production CPU mode: one worker per core partition
+            torch.set_num_threads(num_threads)
+            device = "cpu"
         else:
             if not testing_mode:
                 raise RuntimeError("GPU processing required but CUDA is not available")
@@ -779,44 +2619,63 @@ def process_folds_with_gpu(args):
                 logger.info(f"Processing fold {fold_idx + 1} on GPU {gpu_id}")
 
                 fold_embeddings = embeddings[fold_indices].to(device)
+                fold_size = len(fold_indices)
 
-                logger.info(f"Computing similarity matrix for fold {fold_idx + 1}")
-                max_sim_mat = compute_pairwise_dense(
+                logger.info(f"Computing {similarity_mode} similarities for fold {fold_idx + 1}")
+                similarity_kwargs = _build_fold_similarity(
                     fold_embeddings,
-                    batch_size=50000,
-                    metric="cosine",
-                    device=device,
-                    scaling="additive",
-                )
-                similarity_matrix = max_sim_mat.cpu().numpy()
-
-                subsets = {}
-                ds_func = FacilityLocationFunction(
-                    n=similarity_matrix.shape[0],
-                    sijs=similarity_matrix,
-                    mode="dense",
-                    separate_rep=False,
+                    None if weights is None else weights[fold_indices],
+                    similarity_mode,
+                    num_neighbors,
+                    device,
+                    ann_params=ann_params,
+                    ann_index_dir=ann_index_dir,
+                    fold_name=f"fold_{fold_idx}",
+                    num_threads=num_threads,
+                    output_device=device if optimizer_backend == "torch" else "cpu",
                 )
 
-                for size_spec in subset_sizes:
-                    if isinstance(size_spec, float):
-                        # Percentage-based selection
-                        budget = max(
-                            1, math.ceil(size_spec * similarity_matrix.shape[0])
+                if optimizer_backend == "torch":
+                    if similarity_kwargs["mode"] == "streaming":
+                        kernel = EmbeddingKernel(
+                            similarity_kwargs["embeddings"], similarity_kwargs["weights"]
                         )
+                    elif similarity_kwargs["mode"] == "dense":
+                        kernel = DenseKernel(similarity_kwargs["sijs"])
                     else:
-                        # Absolute number-based selection
-                        budget = max(
-                            1,
-                            math.ceil(
-                                size_spec * (similarity_matrix.shape[0] / total_samples)
-                            ),
+                        kernel = SparseKernel.from_scipy(
+                            similarity_kwargs["sijs"], device=device
                         )
-
-                    logger.info(
-                        f"Selecting subset of size {budget} for fold {fold_idx + 1}"
+                else:
+                    # Third Party
+                    # pylint: disable=import-error, import-outside-toplevel
+                    from submodlib import FacilityLocationFunction
+
+                    if similarity_kwargs["mode"] == "dense":
+                        similarity_kwargs["sijs"] = similarity_kwargs["sijs"].numpy()
+                    ds_func = FacilityLocationFunction(
+                        n=fold_size, separate_rep=False, **similarity_kwargs
                     )
 
+                # One greedy run serves every subset size as a prefix
+                fold_rows = _num_rows(fold_indices, weights)
+                budget = max(
+                    _fold_budget(size_spec, fold_size, total_samples, fold_rows)
+                    for size_spec in subset_sizes
+                )
+                logger.info(
+                    f"Selecting greedy ordering of size {budget} for fold {fold_idx + 1}"
+                )
+
+                if optimizer_backend == "torch":
+                    subset_result = maximize_facility_location(
+                        kernel,
+                        budget,
+                        optimizer="LazierThanLazyGreedy",
+                        epsilon=epsilon,
+                        seed=fold_idx,
+                    )
+                else:
                     subset_result = ds_func.maximize(
                         budget=budget,
                         optimizer="LazierThanLazyGreedy",
@@ -826,14 +2685,15 @@ def process_folds_with_gpu(args):
                         verbose=False,
                     )
 
-                    subset_indices = [fold_indices[x[0]] for x in subset_result]
-                    subset_gains = [x[1] for x in subset_result]
-                    subsets[size_spec] = {
-                        "indices": subset_indices,
-                        "gains": subset_gains,
-                    }
-
-                results.append((fold_idx, subsets))
+                results.append(
+                    (
+                        fold_idx,
+                        {
+                            "indices": [int(fold_indices[x[0]]) for x in subset_result],
+                            "gains": [x[1] for x in subset_result],
+                        },
+                    )
+                )
 
             except Exception as e:
                 logger.error(
@@ -844,12 +2704,14 @@ def process_folds_with_gpu(args):
                 # Clean up variables to free memory
                 if 'ds_func' in locals():
                     del ds_func
-                if 'similarity_matrix' in locals():
-                    del similarity_matrix
+                if 'kernel' in locals():
+                    del kernel
+                if 'similarity_kwargs' in locals():
+                    del similarity_kwargs
                 if 'fold_embeddings' in locals():
                     del fold_embeddings
                 gc.collect()
-                if torch.cuda.is_available():
+                if use_cuda:
                     torch.cuda.empty_cache()
 
         return results
@@ -869,22 +2731,45 @@ def get_supported_encoders():
     ]
 
 
+def _config_kwargs(config_cls, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Select the keyword arguments that are fields of a configuration dataclass."""
+    names = {config_field.name for config_field in fields(config_cls)}
+    return {key: value for key, value in kwargs.items() if key in names}
+
+
 def subset_datasets(
     input_files: List[str],
     subset_sizes: List[Union[int, float]],
     testing_mode: bool = False,
+    cpu_mode: bool = False,
     **kwargs: Any,
 ) -> None:
     """Create subsets of datasets using facility location for diverse subset selection."""
 
+    distributed = kwargs.get("distributed", False)
+    if distributed:
+        # One process per device; torchrun provides the rendezvous environment
+        use_cuda = torch.cuda.is_available() and not cpu_mode
+        _, _, local_rank = setup_distributed("nccl" if use_cuda else "gloo")
+        if use_cuda:
+            torch.cuda.set_device(local_rank)
+        elif kwargs.get("threads_per_worker") is None:
+            local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+            kwargs["threads_per_worker"] = max(
+                1, get_available_cpu_cores() // local_world_size
+            )
+
     # Get system's available GPU count
-    available_gpus = get_default_num_gpus(testing_mode=testing_mode)
+    available_gpus = get_default_num_gpus(testing_mode=testing_mode, cpu_mode=cpu_mode)
 
-    # Create configuration groups
-    basic_config = BasicConfig()
-    encoder_config = EncoderConfig(testing_mode=testing_mode)
+    # Create configuration groups; basic and encoder settings are passed to the
+    # constructors so that their __post_init__ validates them
+    basic_config = BasicConfig(**_config_kwargs(BasicConfig, kwargs))
+    encoder_config = EncoderConfig(
+        **{**_config_kwargs(EncoderConfig, kwargs), "testing_mode": testing_mode}
+    )
     template_config = TemplateConfig()
-    system_config = SystemConfig(testing_mode=testing_mode)
+    system_config = SystemConfig(testing_mode=testing_mode, cpu_mode=cpu_mode)
 
     # Update configuration groups from kwargs
     for key, value in kwargs.items():
@@ -897,8 +2782,18 @@ def subset_datasets(
         elif hasattr(system_config, key):
             setattr(system_config, key, value)
 
+    if cpu_mode:
+        # num_gpus counts CPU workers here and is sized from the core layout
+        if "num_gpus" not in kwargs or system_config.cpu_workers is not None:
+            system_config.num_gpus = get_cpu_worker_layout(
+                system_config.cpu_workers, system_config.threads_per_worker
+            )[0]
+        logger.info(
+            f"CPU mode: {system_config.num_gpus} workers with "
+            f"{system_config.cpu_threads} threads each"
+        )
     # Ensure num_gpus doesn't exceed available GPUs
-    if system_config.num_gpus > available_gpus:
+    elif system_config.num_gpus > available_gpus:
         logger.warning(
             f"Requested {system_config.num_gpus} GPUs but only {available_gpus} available. "
             f"Falling back to using {available_gpus} GPUs."
@@ -928,4 +2823,6 @@ def subset_datasets(
         # Cleanup
         gc.collect()
         if torch.cuda.is_available():
-            torch.cuda.empty_cache()
\ No newline at end of file
+            torch.cuda.empty_cache()
+        if distributed:
+            cleanup()
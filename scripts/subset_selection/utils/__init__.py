@@ -2,15 +2,73 @@
 Utility functions for subset selection.
 """
 
+from .ann_index import ANN_BACKENDS, compute_ann_similarities
+from .embedding_cache import EmbeddingCache, compute_cache_keys
+from .embedding_projection import (
+    PROJECTIONS,
+    fit_pca_projection,
+    load_projection,
+    save_projection,
+)
+from .facility_location import (
+    OPTIMIZERS,
+    DenseKernel,
+    EmbeddingKernel,
+    SparseKernel,
+    maximize_facility_location,
+    symmetrize_knn_graph,
+)
+from .embedding_storage import (
+    STORAGE_PRECISIONS,
+    StoredEmbeddings,
+    dequantize_embeddings,
+    quantize_embeddings,
+)
+from .model_weights import load_model_mmap, load_safetensors_mmap
+from .token_lengths import TRUNCATION_POLICIES, summarize_token_lengths
 from .subset_selection_utils import (
+    TerminationRequested,
+    assign_blocks,
     compute_pairwise_dense,
+    compute_topk_similarities,
+    get_cpu_worker_layout,
     get_default_num_gpus,
+    prefetch_iterator,
     retry_on_exception,
+    split_row_blocks,
 )
 
 __all__ = [
+    "ANN_BACKENDS",
+    "compute_ann_similarities",
+    "EmbeddingCache",
+    "STORAGE_PRECISIONS",
+    "StoredEmbeddings",
+    "compute_cache_keys",
+    "PROJECTIONS",
+    "fit_pca_projection",
+    "load_projection",
+    "save_projection",
+    "load_model_mmap",
+    "load_safetensors_mmap",
+    "TRUNCATION_POLICIES",
+    "summarize_token_lengths",
+    "OPTIMIZERS",
+    "DenseKernel",
+    "EmbeddingKernel",
+    "SparseKernel",
+    "maximize_facility_location",
+    "symmetrize_knn_graph",
+    "dequantize_embeddings",
+    "quantize_embeddings",
+    "TerminationRequested",
+    "assign_blocks",
     "compute_pairwise_dense",
+    "compute_topk_similarities",
+    "get_cpu_worker_layout",
     "get_default_num_gpus",
+    "prefetch_iterator",
     "retry_on_exception",
+    "split_row_blocks",
 ]
 
@@ -0,0 +1,185 @@
+# Standard
+from typing import Any, Dict, Optional, Tuple
+import hashlib
+import json
+import logging
+import math
+import os
+
+# Third Party
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+ANN_BACKENDS = ("hnswlib", "faiss")
+
+# Rows per query call, to bound the memory of the returned neighbour lists
+_QUERY_BATCH_SIZE = 100000
+
+
+def validate_ann_backend(backend: str) -> None:
+    """Raise a ValueError for unsupported ANN backends."""
+    if backend not in ANN_BACKENDS:
+        raise ValueError(
+            f"Unsupported ANN backend: '{backend}'. "
+            f"Supported backends are: {list(ANN_BACKENDS)}"
+        )
+
+
+def _import_backend(backend: str):
+    try:
+        if backend == "faiss":
+            # Third Party
+            # pylint: disable=import-error, import-outside-toplevel
+            import faiss
+
+            return faiss
+        # Third Party
+        # pylint: disable=import-error, import-outside-toplevel
+        import hnswlib
+
+        return hnswlib
+    except ImportError as e:
+        package = "faiss-cpu" if backend == "faiss" else "hnswlib"
+        raise ImportError(
+            f"similarity_mode='ann' with the {backend} backend requires {package}. "
+            f"Install it with `pip install {package}`."
+        ) from e
+
+
+def ann_index_path(
+    index_dir: str, name: str, embeddings: np.ndarray, params: Dict[str, Any]
+) -> str:
+    """
+    Path of the persisted index of a set of embeddings.
+
+    The file name includes a digest of the embeddings and the build parameters,
+    so an index is only reused for the exact vectors and settings it was built
+    with.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    digest.update(np.ascontiguousarray(embeddings).data)
+    return os.path.join(
+        index_dir, f"{name}_{params['backend']}_{digest.hexdigest()[:16]}.index"
+    )
+
+
+def _build_hnswlib(hnswlib, embeddings: np.ndarray, params: Dict[str, Any], num_threads):
+    index = hnswlib.Index(space="ip", dim=embeddings.shape[1])
+    index.init_index(
+        max_elements=len(embeddings),
+        M=params["m"],
+        ef_construction=params["ef_construction"],
+        random_seed=0,
+    )
+    if num_threads is not None:
+        index.set_num_threads(num_threads)
+    index.add_items(embeddings, np.arange(len(embeddings)))
+    return index
+
+
+def _build_faiss(faiss, embeddings: np.ndarray, params: Dict[str, Any]):
+    num_rows, dim = embeddings.shape
+    nlist = params["nlist"] or max(1, int(4 * math.sqrt(num_rows)))
+    nlist = min(nlist, num_rows)
+    quantizer = faiss.IndexFlatIP(dim)
+    index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    # k-means needs no more than a few hundred points per list
+    rng = np.random.default_rng(0)
+    sample_size = min(num_rows, 256 * nlist)
+    sample = embeddings[np.sort(rng.choice(num_rows, sample_size, replace=False))]
+    index.train(sample)
+    index.add(embeddings)
+    return index
+
+
+def compute_ann_similarities(
+    embeddings: torch.Tensor,
+    num_neighbors: int,
+    params: Dict[str, Any],
+    index_path: Optional[str] = None,
+    num_threads: Optional[int] = None,
+    scaling: Optional[str] = "additive",
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute approximate top-k cosine similarities of every row with an ANN index.
+
+    With ``index_path`` set, the index is loaded from that file if it exists and
+    saved there after building otherwise.
+
+    Args:
+        embeddings (torch.Tensor): Vectors of shape ``(n, dim)``.
+        num_neighbors (int): Neighbours returned per row.
+        params (Dict[str, Any]): ``backend`` (one of ``ANN_BACKENDS``) and its
+            parameters: ``m``, ``ef_construction`` and ``ef_search`` for hnswlib
+            (HNSW graph), ``nlist`` and ``nprobe`` for faiss (IVF-Flat). Higher
+            ``ef_search`` or ``nprobe`` give higher recall at a higher query cost.
+        index_path (Optional[str]): File to persist the index in.
+        num_threads (Optional[int]): Threads used to build and query the index.
+        scaling (Optional[str]): ``"additive"`` maps similarities to ``[0, 1]``
+            like ``compute_pairwise_dense``.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: Similarities and column indices of
+        shape ``(n, min(num_neighbors, n))``. Missing neighbours have index -1.
+    """
+    backend = params["backend"]
+    validate_ann_backend(backend)
+    module = _import_backend(backend)
+
+    vectors = torch.nn.functional.normalize(embeddings.float(), p=2, dim=1)
+    vectors = np.ascontiguousarray(vectors.cpu().numpy(), dtype=np.float32)
+    num_rows, dim = vectors.shape
+    k = min(num_neighbors, num_rows)
+
+    index = None
+    if index_path is not None and os.path.exists(index_path):
+        logger.info(f"Loading {backend} index from {index_path}")
+        if backend == "faiss":
+            index = module.read_index(index_path)
+        else:
+            index = module.Index(space="ip", dim=dim)
+            index.load_index(index_path, max_elements=num_rows)
+    if index is None:
+        logger.info(f"Building {backend} index over {num_rows} vectors")
+        if backend == "faiss":
+            if num_threads is not None:
+                module.omp_set_num_threads(num_threads)
+            index = _build_faiss(module, vectors, params)
+        else:
+            index = _build_hnswlib(module, vectors, params, num_threads)
+        if index_path is not None:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            tmp_path = f"{index_path}.tmp-{os.getpid()}"
+            if backend == "faiss":
+                module.write_index(index, tmp_path)
+            else:
+                index.save_index(tmp_path)
+            os.replace(tmp_path, index_path)
+
+    if backend == "faiss":
+        index.nprobe = min(params["nprobe"], index.nlist)
+    else:
+        index.set_ef(max(params["ef_search"], k))
+        if num_threads is not None:
+            index.set_num_threads(num_threads)
+
+    values = np.empty((num_rows, k), dtype=np.float32)
+    indices = np.empty((num_rows, k), dtype=np.int64)
+    for start in range(0, num_rows, _QUERY_BATCH_SIZE):
+        end = min(start + _QUERY_BATCH_SIZE, num_rows)
+        if backend == "faiss":
+            batch_values, batch_indices = index.search(vectors[start:end], k)
+        else:
+            batch_indices, distances = index.knn_query(vectors[start:end], k=k)
+            # Inner product space reports 1 - similarity
+            batch_values = 1 - distances
+        values[start:end] = batch_values
+        indices[start:end] = batch_indices
+
+    values, indices = torch.from_numpy(values), torch.from_numpy(indices)
+    if scaling == "additive":
+        values = (values + 1) / 2
+    return values, indices
@@ -0,0 +1,311 @@
+# Standard
+from typing import Any, Dict, List, Optional, Tuple
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+
+# Third Party
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Keys are raw SHA-256 digests held as fixed-length byte strings in memory and
+# as rows of 32 uint8 values on disk
+KEY_DTYPE = "S32"
+KEY_SIZE = 32
+
+
+def keys_to_uint8(keys: np.ndarray) -> np.ndarray:
+    """Convert keys to their on-disk ``(n, 32)`` uint8 representation."""
+    keys = np.ascontiguousarray(keys, dtype=KEY_DTYPE)
+    return keys.view(np.uint8).reshape(-1, KEY_SIZE)
+
+
+def keys_from_uint8(data: np.ndarray) -> np.ndarray:
+    """Convert ``(n, 32)`` uint8 rows read from disk back to keys."""
+    return np.ascontiguousarray(data, dtype=np.uint8).view(KEY_DTYPE).reshape(-1)
+
+
+def compute_cache_keys(texts: List[str], key_fields: Dict[str, Any]) -> np.ndarray:
+    """
+    Compute content-addressed keys for rendered texts.
+
+    Args:
+        texts (List[str]): Rendered texts, before the instruction is prepended.
+        key_fields (Dict[str, Any]): Everything besides the text that changes the
+            resulting embedding (encoder model, instruction, max length, ...).
+
+    Returns:
+        np.ndarray: Array of SHA-256 digests with dtype ``S32``.
+    """
+    prefix = json.dumps(key_fields, sort_keys=True).encode("utf-8") + b"\0"
+    return np.array(
+        [hashlib.sha256(prefix + text.encode("utf-8")).digest() for text in texts],
+        dtype=KEY_DTYPE,
+    )
+
+
+def build_key_index(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort keys for lookups with ``match_keys``; returns the sorted keys and their rows."""
+    order = np.argsort(keys, kind="stable")
+    return keys[order], order
+
+
+def match_keys(
+    key_index: Tuple[np.ndarray, np.ndarray], queries: np.ndarray
+) -> np.ndarray:
+    """
+    Find the row of each query key in an index built by ``build_key_index``.
+
+    Returns:
+        np.ndarray: Row of each query key, or -1 when the key is absent.
+    """
+    sorted_keys, order = key_index
+    if len(sorted_keys) == 0:
+        return np.full(len(queries), -1, dtype=np.int64)
+    pos = np.searchsorted(sorted_keys, queries)
+    pos = np.minimum(pos, len(sorted_keys) - 1)
+    found = sorted_keys[pos] == queries
+    return np.where(found, order[pos], -1)
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed embedding store shared across runs and datasets.
+
+    Entries are spread over ``num_shards`` HDF5 files by the first byte of their
+    key and grouped by embedding dimension (``<cache_dir>/dim_<d>/<xx>.h5``).
+    Lookups are read-only, so any number of encoder workers can query the cache
+    concurrently; inserts must come from a single process. Every entry records
+    when it was last inserted, and inserting an already cached key refreshes it:
+    a run adds all of its embeddings, so this also covers its cache hits. When
+    the cache grows beyond ``max_size_gb``, the least recently used entries are
+    evicted.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size_gb: Optional[float] = None,
+        num_shards: int = 256,
+    ):
+        if not 0 < num_shards <= 256:
+            raise ValueError("num_shards must be between 1 and 256")
+        self.cache_dir = cache_dir
+        self.max_size_bytes = (
+            int(max_size_gb * 1024**3) if max_size_gb is not None else None
+        )
+        self.num_shards = num_shards
+        # Per-shard sorted key index, invalidated when the shard file changes
+        self._indexes: Dict[str, Tuple[int, Tuple[np.ndarray, np.ndarray]]] = {}
+
+    def _shard_ids(self, keys: np.ndarray) -> np.ndarray:
+        first_bytes = keys_to_uint8(keys)[:, 0]
+        return first_bytes.astype(np.int64) % self.num_shards
+
+    def _shard_path(self, dim: int, shard_id: int) -> str:
+        return os.path.join(self.cache_dir, f"dim_{dim}", f"{shard_id:02x}.h5")
+
+    def _load_index(self, path: str) -> Tuple[np.ndarray, np.ndarray]:
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._indexes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with h5py.File(path, "r") as f:
+            key_index = build_key_index(keys_from_uint8(f["keys"][:]))
+        self._indexes[path] = (mtime, key_index)
+        return key_index
+
+    def _find(self, path: str, keys: np.ndarray) -> np.ndarray:
+        """Return the row of each key in the shard file, or -1 when absent."""
+        return match_keys(self._load_index(path), keys)
+
+    def lookup(self, keys: np.ndarray, dim: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up embeddings for the given keys.
+
+        Args:
+            keys (np.ndarray): Keys from ``compute_cache_keys``.
+            dim (int): Embedding dimension of the encoder.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Positions in ``keys`` that were found and
+            their float32 embeddings, in the same order.
+        """
+        hit_positions = []
+        hit_embeddings = []
+        shard_ids = self._shard_ids(keys)
+        for shard_id in np.unique(shard_ids):
+            path = self._shard_path(dim, shard_id)
+            if not os.path.exists(path):
+                continue
+
+            positions = np.flatnonzero(shard_ids == shard_id)
+            rows = self._find(path, keys[positions])
+            found = rows >= 0
+            if not found.any():
+                continue
+
+            positions, rows = positions[found], rows[found]
+            # h5py fancy indexing requires increasing row indices
+            row_order = np.argsort(rows)
+            unique_rows, inverse = np.unique(rows[row_order], return_inverse=True)
+            with h5py.File(path, "r") as f:
+                embeddings = f["embeddings"][unique_rows]
+            hit_positions.append(positions[row_order])
+            hit_embeddings.append(embeddings[inverse])
+
+        if not hit_positions:
+            return np.empty(0, dtype=np.int64), np.empty((0, dim), dtype=np.float32)
+        return (
+            np.concatenate(hit_positions),
+            np.concatenate(hit_embeddings).astype(np.float32, copy=False),
+        )
+
+    def insert(self, keys: np.ndarray, embeddings: np.ndarray) -> int:
+        """
+        Add embeddings that are not cached yet and mark their shards as recently used.
+
+        Args:
+            keys (np.ndarray): Keys from ``compute_cache_keys``.
+            embeddings (np.ndarray): Embeddings for ``keys``, shape ``(n, dim)``.
+
+        Returns:
+            int: Number of newly inserted entries.
+        """
+        dim = embeddings.shape[1]
+        inserted = 0
+        now = time.time()
+        shard_ids = self._shard_ids(keys)
+        for shard_id in np.unique(shard_ids):
+            path = self._shard_path(dim, shard_id)
+            positions = np.flatnonzero(shard_ids == shard_id)
+            cached_rows = np.empty(0, dtype=np.int64)
+
+            if os.path.exists(path):
+                rows = self._find(path, keys[positions])
+                cached_rows = np.unique(rows[rows >= 0])
+                positions = positions[rows < 0]
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Drop duplicates within the batch itself
+            positions = positions[np.unique(keys[positions], return_index=True)[1]]
+
+            with h5py.File(path, "a") as f:
+                if "keys" not in f:
+                    _create_shard_datasets(f, dim)
+                elif "last_used" not in f:
+                    # Entries written before usage was recorded count as the oldest
+                    num_entries = f["keys"].shape[0]
+                    f.create_dataset(
+                        "last_used",
+                        data=np.zeros(num_entries),
+                        maxshape=(None,),
+                        chunks=(4096,),
+                    )
+                if len(cached_rows) > 0:
+                    f["last_used"][cached_rows] = now
+                if len(positions) > 0:
+                    start = f["keys"].shape[0]
+                    end = start + len(positions)
+                    for name in ("keys", "embeddings", "last_used"):
+                        f[name].resize(end, axis=0)
+                    f["keys"][start:end] = keys_to_uint8(keys[positions])
+                    f["embeddings"][start:end] = embeddings[positions]
+                    f["last_used"][start:end] = now
+            inserted += len(positions)
+
+        self.evict()
+        return inserted
+
+    def size_bytes(self) -> int:
+        """Total size of all shard files in the cache."""
+        return sum(
+            os.path.getsize(path)
+            for path in glob.glob(os.path.join(self.cache_dir, "dim_*", "*.h5"))
+        )
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits its size bound."""
+        if self.max_size_bytes is None:
+            return
+
+        shard_files = glob.glob(os.path.join(self.cache_dir, "dim_*", "*.h5"))
+        sizes = [os.path.getsize(path) for path in shard_files]
+        excess = sum(sizes) - self.max_size_bytes
+        if excess <= 0:
+            return
+
+        # Every entry of a shard file is charged an equal share of the file size
+        last_used, entry_files, entry_rows, entry_sizes = [], [], [], []
+        for file_id, (path, size) in enumerate(zip(shard_files, sizes, strict=True)):
+            with h5py.File(path, "r") as f:
+                num_entries = f["keys"].shape[0]
+                last_used.append(
+                    f["last_used"][:] if "last_used" in f else np.zeros(num_entries)
+                )
+            entry_files.append(np.full(num_entries, file_id))
+            entry_rows.append(np.arange(num_entries))
+            entry_sizes.append(np.full(num_entries, size / max(num_entries, 1)))
+
+        order = np.argsort(np.concatenate(last_used), kind="stable")
+        freed = np.cumsum(np.concatenate(entry_sizes)[order])
+        num_evicted = min(int(np.searchsorted(freed, excess)) + 1, len(order))
+        evicted = order[:num_evicted]
+        evicted_files = np.concatenate(entry_files)[evicted]
+        evicted_rows = np.concatenate(entry_rows)[evicted]
+
+        for file_id in np.unique(evicted_files):
+            path = shard_files[file_id]
+            self._indexes.pop(path, None)
+            with h5py.File(path, "r") as f:
+                keep = np.ones(f["keys"].shape[0], dtype=bool)
+                keep[evicted_rows[evicted_files == file_id]] = False
+                if not keep.any():
+                    kept = None
+                else:
+                    kept = {
+                        name: f[name][:][keep]
+                        for name in ("keys", "embeddings", "last_used")
+                        if name in f
+                    }
+            if kept is None:
+                os.remove(path)
+                continue
+            # HDF5 files do not shrink, so the remaining entries are rewritten
+            tmp_path = f"{path}.tmp"
+            with h5py.File(tmp_path, "w") as f:
+                _create_shard_datasets(f, kept["embeddings"].shape[1])
+                for name in ("keys", "embeddings", "last_used"):
+                    f[name].resize(len(kept["keys"]), axis=0)
+                f["keys"][:] = kept["keys"]
+                f["embeddings"][:] = kept["embeddings"]
+                f["last_used"][:] = kept.get("last_used", 0.0)
+            os.replace(tmp_path, path)
+        logger.info(f"Evicted {num_evicted} least recently used embedding cache entries")
+
+
+def _create_shard_datasets(h5f, dim: int) -> None:
+    """Create the empty, resizable datasets of a cache shard file."""
+    h5f.create_dataset(
+        "keys",
+        shape=(0, KEY_SIZE),
+        maxshape=(None, KEY_SIZE),
+        dtype="uint8",
+        chunks=(4096, KEY_SIZE),
+    )
+    h5f.create_dataset(
+        "embeddings",
+        shape=(0, dim),
+        maxshape=(None, dim),
+        dtype="float32",
+        chunks=(256, dim),
+    )
+    h5f.create_dataset(
+        "last_used", shape=(0,), maxshape=(None,), dtype="float64", chunks=(4096,)
+    )
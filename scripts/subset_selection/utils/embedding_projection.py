@@ -0,0 +1,98 @@
+# Standard
+from typing import Optional, Tuple
+import hashlib
+import os
+
+# Third Party
+import numpy as np
+
+# Built-in projections; any other value is the path of an .npz file with a
+# fitted projection (see ``save_projection``)
+PROJECTIONS = ("truncate", "random")
+
+RANDOM_PROJECTION_SEED = 0
+
+
+def fit_pca_projection(
+    embeddings: np.ndarray, output_dim: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit a PCA projection on a sample of full-dimensional embeddings.
+
+    Args:
+        embeddings (np.ndarray): Normalized embeddings of shape ``(n, dim)``.
+        output_dim (int): Number of principal components to keep.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Components of shape ``(dim, output_dim)``
+        and the mean that is subtracted before projecting.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    if not 0 < output_dim <= min(embeddings.shape):
+        raise ValueError(
+            f"output_dim must be between 1 and {min(embeddings.shape)} for "
+            f"{embeddings.shape[0]} embeddings of dimension {embeddings.shape[1]}"
+        )
+    mean = embeddings.mean(axis=0)
+    _, _, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+    return vt[:output_dim].T.astype(np.float32), mean.astype(np.float32)
+
+
+def save_projection(path: str, components: np.ndarray, mean: np.ndarray) -> None:
+    """Save a fitted projection for use as the ``projection`` encoder setting."""
+    np.savez(path, components=components, mean=mean)
+
+
+def load_projection(
+    projection: str, hidden_size: int, output_dim: Optional[int]
+) -> Tuple[int, Optional[np.ndarray], Optional[np.ndarray], str]:
+    """
+    Resolve a projection setting of the encoder.
+
+    Args:
+        projection (str): ``"truncate"`` to keep a Matryoshka prefix, ``"random"``
+            for a seeded Gaussian random projection, or the path of a fitted
+            projection saved with ``save_projection``.
+        hidden_size (int): Dimension of the encoder's pooled output.
+        output_dim (Optional[int]): Requested embedding dimension. Inferred from
+            a fitted projection when not given.
+
+    Returns:
+        Tuple[int, Optional[np.ndarray], Optional[np.ndarray], str]: Output
+        dimension, projection matrix and mean (None for truncation), and an
+        identifier of the projection used in embedding cache keys.
+    """
+    if projection == "truncate":
+        matrix, mean, projection_id = None, None, "truncate"
+    elif projection == "random":
+        if output_dim is None:
+            raise ValueError("output_dim is required for a random projection")
+        rng = np.random.default_rng(RANDOM_PROJECTION_SEED)
+        matrix = rng.standard_normal((hidden_size, output_dim)).astype(np.float32)
+        matrix /= np.sqrt(output_dim)
+        mean, projection_id = None, f"random:{RANDOM_PROJECTION_SEED}"
+    else:
+        if not os.path.exists(projection):
+            raise ValueError(
+                f"Unknown projection '{projection}'. Use one of {list(PROJECTIONS)} "
+                "or the path of a fitted projection file"
+            )
+        with open(projection, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        with np.load(projection) as data:
+            matrix = data["components"].astype(np.float32)
+            mean = data["mean"].astype(np.float32) if "mean" in data else None
+        if output_dim is None:
+            output_dim = matrix.shape[1]
+        if matrix.shape != (hidden_size, output_dim):
+            raise ValueError(
+                f"Projection in {projection} has shape {matrix.shape}, "
+                f"expected {(hidden_size, output_dim)}"
+            )
+        projection_id = f"fitted:{digest}"
+
+    if output_dim is None:
+        output_dim = hidden_size
+    if not 0 < output_dim <= hidden_size:
+        raise ValueError(f"output_dim must be between 1 and {hidden_size}")
+    return output_dim, matrix, mean, projection_id
@@ -0,0 +1,146 @@
+# Standard
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union
+
+# Third Party
+import numpy as np
+import torch
+
+# Supported on-disk precisions for embeddings. bfloat16 is stored as the upper
+# 16 bits of the float32 representation (uint16), int8 with one float32 scale per row.
+STORAGE_PRECISIONS = ("float32", "float16", "bfloat16", "int8")
+
+_STORAGE_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.uint16,
+    "int8": np.int8,
+}
+
+
+def validate_storage_precision(precision: str) -> None:
+    """Raise a ValueError for unsupported storage precisions."""
+    if precision not in STORAGE_PRECISIONS:
+        raise ValueError(
+            f"Unsupported storage precision: '{precision}'. "
+            f"Supported precisions are: {list(STORAGE_PRECISIONS)}"
+        )
+
+
+def storage_dtype(precision: str) -> np.dtype:
+    """Numpy dtype used to store embeddings at the given precision."""
+    validate_storage_precision(precision)
+    return np.dtype(_STORAGE_DTYPES[precision])
+
+
+def quantize_embeddings(
+    embeddings: np.ndarray, precision: str
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Convert float32 embeddings to their storage representation.
+
+    Args:
+        embeddings (np.ndarray): Float32 embeddings of shape ``(n, dim)``.
+        precision (str): One of ``STORAGE_PRECISIONS``.
+
+    Returns:
+        Tuple[np.ndarray, Optional[np.ndarray]]: Stored values and, for int8,
+        the per-row scales.
+    """
+    validate_storage_precision(precision)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    if precision == "float32":
+        return embeddings, None
+    if precision == "float16":
+        return embeddings.astype(np.float16), None
+    if precision == "bfloat16":
+        # Round to nearest even on the bits that are dropped
+        bits = np.ascontiguousarray(embeddings).view(np.uint32)
+        rounding = np.uint32(0x7FFF) + ((bits >> np.uint32(16)) & np.uint32(1))
+        return ((bits + rounding) >> np.uint32(16)).astype(np.uint16), None
+
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(embeddings / scales[:, None]), -127, 127)
+    return quantized.astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize_embeddings(
+    data: np.ndarray, precision: str, scales: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Convert stored embeddings back to float32."""
+    validate_storage_precision(precision)
+
+    if precision == "bfloat16":
+        return (data.astype(np.uint32) << np.uint32(16)).view(np.float32)
+    if precision == "int8":
+        if scales is None:
+            raise ValueError("int8 embeddings require per-row scales")
+        return data.astype(np.float32) * scales[:, None]
+    return data.astype(np.float32, copy=False)
+
+
+@dataclass
+class StoredEmbeddings:
+    """
+    Embeddings held in their storage precision and dequantized on access.
+
+    Indexing with row indices returns a float32 tensor, so only the rows that are
+    needed at a time (e.g. one fold) are ever materialized in full precision.
+    """
+
+    data: np.ndarray
+    precision: str = "float32"
+    scales: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_h5(
+        cls, h5f, rows: Optional[Union[slice, np.ndarray]] = None
+    ) -> "StoredEmbeddings":
+        """
+        Load the embeddings of an embeddings file.
+
+        Args:
+            h5f: Open embeddings file.
+            rows (Optional[Union[slice, np.ndarray]]): Rows to load. A slice is read
+                directly from disk; an index array is applied after loading.
+        """
+        dataset = h5f["embeddings"]
+        precision = dataset.attrs.get("precision", "float32")
+        if isinstance(precision, bytes):
+            precision = precision.decode("utf-8")
+        region = rows if isinstance(rows, slice) else slice(None)
+        stored = cls(
+            data=dataset[region],
+            precision=precision,
+            scales=h5f["scales"][region] if "scales" in h5f else None,
+        )
+        if rows is None or isinstance(rows, slice):
+            return stored
+        return stored.select(rows)
+
+    @property
+    def size(self) -> int:
+        return self.data.size
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def select(self, rows: np.ndarray) -> "StoredEmbeddings":
+        """Return the stored embeddings of the given rows."""
+        return StoredEmbeddings(
+            data=self.data[rows],
+            precision=self.precision,
+            scales=self.scales[rows] if self.scales is not None else None,
+        )
+
+    def dequantize(self) -> np.ndarray:
+        """Return all embeddings as a float32 array."""
+        return dequantize_embeddings(self.data, self.precision, self.scales)
+
+    def __getitem__(self, rows) -> torch.Tensor:
+        scales = self.scales[rows] if self.scales is not None else None
+        return torch.from_numpy(
+            dequantize_embeddings(self.data[rows], self.precision, scales)
+        )
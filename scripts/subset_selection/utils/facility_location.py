@@ -0,0 +1,277 @@
+# Standard
+from typing import List, Optional, Tuple, Union
+import math
+
+# Third Party
+import numpy as np
+import torch
+
+OPTIMIZERS = ("NaiveGreedy", "StochasticGreedy", "LazierThanLazyGreedy")
+
+# Candidates whose gains are evaluated together, bounding the
+# (num_rows x block) temporary of dense kernels
+_GAIN_BLOCK_SIZE = 4096
+
+# Rows of an embedding kernel whose similarities are computed together
+_ROW_BLOCK_SIZE = 8192
+
+
+def validate_optimizer(optimizer: str) -> None:
+    """Raise a ValueError for unsupported optimizers."""
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(
+            f"Unsupported optimizer: '{optimizer}'. "
+            f"Supported optimizers are: {list(OPTIMIZERS)}"
+        )
+
+
+def stochastic_sample_size(num_rows: int, budget: int, epsilon: float) -> int:
+    """
+    Number of candidates evaluated per step of stochastic greedy.
+
+    Follows submodlib's LazierThanLazyGreedy: an ``epsilon`` below 1 is the
+    approximation parameter of stochastic greedy, giving
+    ``(n / budget) * ln(1 / epsilon)`` candidates, while an ``epsilon`` of 1 or
+    more is taken as the number of candidates itself (submodlib reports the same
+    random set size, e.g. 160 for the default ``epsilon``). Unlike submodlib,
+    which fails on an empty random set, at least one candidate is evaluated.
+    """
+    if epsilon >= 1:
+        size = int(epsilon)
+    else:
+        size = int(num_rows / budget * math.log(1 / epsilon))
+    return max(1, size)
+
+
+def symmetrize_knn_graph(sijs):
+    """
+    Make a scipy sparse similarity graph such as a kNN graph symmetric.
+
+    Like submodlib's sparse mode, a missing ``sijs[i, j]`` falls back to
+    ``sijs[j, i]``, so two elements are similar when either one is among the
+    neighbours of the other. Row weights must be applied afterwards: the
+    fallback copies an entry of row ``j`` into row ``i``.
+    """
+    sijs = sijs.tocsr()
+    pattern = sijs.copy()
+    pattern.data[:] = 1
+    symmetric = (sijs + sijs.T - sijs.T.multiply(pattern)).tocsr()
+    symmetric.sort_indices()
+    return symmetric
+
+
+class DenseKernel:
+    """Facility location over a dense similarity matrix ``sijs[i, j]``."""
+
+    def __init__(self, sijs: torch.Tensor):
+        self.sijs = sijs
+        self.num_rows = sijs.shape[0]
+        self.device = sijs.device
+
+    def gains(self, candidates: torch.Tensor, coverage: torch.Tensor) -> torch.Tensor:
+        """Marginal gains ``sum_i max(0, sijs[i, j] - coverage[i])`` of candidates ``j``."""
+        gains = torch.empty(len(candidates), dtype=coverage.dtype, device=self.device)
+        for start in range(0, len(candidates), _GAIN_BLOCK_SIZE):
+            block = candidates[start : start + _GAIN_BLOCK_SIZE]
+            columns = self.sijs[:, block].to(coverage.dtype)
+            gains[start : start + len(block)] = (
+                (columns - coverage.unsqueeze(1)).clamp_(min=0).sum(dim=0)
+            )
+        return gains
+
+    def update(self, item: torch.Tensor, coverage: torch.Tensor) -> None:
+        """Add ``item`` to the selection."""
+        torch.maximum(
+            coverage, self.sijs[:, item].to(coverage.dtype).reshape(-1), out=coverage
+        )
+
+
+class SparseKernel:
+    """
+    Facility location over a sparse similarity matrix; missing entries are 0.
+
+    The matrix is held column-wise, so the rows covered by a candidate are one
+    contiguous slice.
+    """
+
+    def __init__(
+        self,
+        col_ptr: torch.Tensor,
+        row_indices: torch.Tensor,
+        values: torch.Tensor,
+        num_rows: int,
+    ):
+        self.col_ptr = col_ptr
+        self.row_indices = row_indices
+        self.values = values
+        self.num_rows = num_rows
+        self.device = values.device
+
+    @classmethod
+    def from_scipy(
+        cls,
+        sijs,
+        device: Optional[Union[str, torch.device]] = None,
+        weights: Optional[np.ndarray] = None,
+    ) -> "SparseKernel":
+        """
+        Create a kernel from a scipy sparse matrix such as a kNN graph.
+
+        The graph is made symmetric with ``symmetrize_knn_graph`` (a no-op for
+        graphs that already are), then row ``i`` is scaled by ``weights[i]``.
+        """
+        symmetric = symmetrize_knn_graph(sijs)
+        if weights is not None:
+            symmetric = symmetric.multiply(np.asarray(weights).reshape(-1, 1))
+        csc = symmetric.tocsc()
+        csc.sort_indices()
+        return cls(
+            torch.from_numpy(csc.indptr.astype(np.int64)).to(device),
+            torch.from_numpy(csc.indices.astype(np.int64)).to(device),
+            torch.from_numpy(csc.data.astype(np.float32)).to(device),
+            csc.shape[0],
+        )
+
+    def _entries(self, candidates: torch.Tensor):
+        """Row indices, values and owning candidate of the nonzeros of candidate columns."""
+        starts = self.col_ptr[candidates]
+        counts = self.col_ptr[candidates + 1] - starts
+        owners = torch.repeat_interleave(
+            torch.arange(len(candidates), device=self.device), counts
+        )
+        offsets = torch.cumsum(counts, dim=0) - counts
+        positions = starts[owners] + torch.arange(len(owners), device=self.device)
+        positions -= offsets[owners]
+        return self.row_indices[positions], self.values[positions], owners
+
+    def gains(self, candidates: torch.Tensor, coverage: torch.Tensor) -> torch.Tensor:
+        """Marginal gains ``sum_i max(0, sijs[i, j] - coverage[i])`` of candidates ``j``."""
+        rows, values, owners = self._entries(candidates)
+        contributions = (values.to(coverage.dtype) - coverage[rows]).clamp_(min=0)
+        gains = torch.zeros(len(candidates), dtype=coverage.dtype, device=self.device)
+        return gains.index_add_(0, owners, contributions)
+
+    def update(self, item: torch.Tensor, coverage: torch.Tensor) -> None:
+        """Add ``item`` to the selection."""
+        rows, values, _ = self._entries(item.reshape(1))
+        coverage[rows] = torch.maximum(coverage[rows], values.to(coverage.dtype))
+
+
+class EmbeddingKernel:
+    """
+    Facility location over cosine similarities computed from embeddings on demand.
+
+    ``sijs[i, j] = weights[i] * (cos(x_i, x_j) + 1) / 2``, the kernel of
+    ``compute_pairwise_dense`` with additive scaling, is never stored: the
+    columns of the candidates are recomputed block by block at every step.
+    Memory is O(n * dim) instead of O(n^2), at the cost of one
+    ``n x candidates`` matrix product per greedy step.
+    """
+
+    def __init__(self, embeddings: torch.Tensor, weights: Optional[torch.Tensor] = None):
+        self.embeddings = torch.nn.functional.normalize(embeddings.float(), p=2, dim=1)
+        self.num_rows = embeddings.shape[0]
+        self.device = embeddings.device
+        self.weights = None
+        if weights is not None:
+            self.weights = weights.to(self.device, torch.float32)
+
+    def _similarities(self, start: int, columns: torch.Tensor) -> torch.Tensor:
+        """Similarities of rows ``start:start + _ROW_BLOCK_SIZE`` to ``columns``."""
+        rows = self.embeddings[start : start + _ROW_BLOCK_SIZE]
+        similarities = torch.mm(rows, columns.T).add_(1).div_(2)
+        if self.weights is not None:
+            similarities *= self.weights[start : start + len(rows)].unsqueeze(1)
+        return similarities
+
+    def gains(self, candidates: torch.Tensor, coverage: torch.Tensor) -> torch.Tensor:
+        """Marginal gains ``sum_i max(0, sijs[i, j] - coverage[i])`` of candidates ``j``."""
+        gains = torch.zeros(len(candidates), dtype=coverage.dtype, device=self.device)
+        for block_start in range(0, len(candidates), _GAIN_BLOCK_SIZE):
+            block = candidates[block_start : block_start + _GAIN_BLOCK_SIZE]
+            columns = self.embeddings[block]
+            block_gains = gains[block_start : block_start + len(block)]
+            for start in range(0, self.num_rows, _ROW_BLOCK_SIZE):
+                similarities = self._similarities(start, columns)
+                row_coverage = coverage[start : start + len(similarities)]
+                similarities -= row_coverage.to(similarities.dtype).unsqueeze(1)
+                block_gains += similarities.clamp_(min=0).sum(dim=0, dtype=coverage.dtype)
+        return gains
+
+    def update(self, item: torch.Tensor, coverage: torch.Tensor) -> None:
+        """Add ``item`` to the selection."""
+        column = self.embeddings[item.reshape(1)]
+        for start in range(0, self.num_rows, _ROW_BLOCK_SIZE):
+            similarities = self._similarities(start, column).reshape(-1)
+            row_coverage = coverage[start : start + len(similarities)]
+            torch.maximum(
+                row_coverage, similarities.to(coverage.dtype), out=row_coverage
+            )
+
+
+def maximize_facility_location(
+    kernel: Union[DenseKernel, SparseKernel, EmbeddingKernel],
+    budget: int,
+    optimizer: str = "LazierThanLazyGreedy",
+    epsilon: float = 0.1,
+    seed: int = 0,
+) -> List[Tuple[int, float]]:
+    """
+    Greedily maximize facility location ``f(S) = sum_i max_{j in S} sijs[i, j]``.
+
+    Every step evaluates the marginal gains of all candidates (naive greedy) or
+    of a uniform random sample of the remaining candidates (stochastic greedy)
+    in one batched operation, and keeps the best. Lazy evaluation in submodlib
+    only skips evaluations and picks the same element, so
+    ``"LazierThanLazyGreedy"`` and ``"StochasticGreedy"`` are the same here.
+    All state stays on the kernel's device.
+
+    Args:
+        kernel (Union[DenseKernel, SparseKernel, EmbeddingKernel]): Similarity kernel.
+        budget (int): Number of elements to select.
+        optimizer (str): One of ``OPTIMIZERS``.
+        epsilon (float): Sampling parameter of stochastic greedy, with the
+            semantics of submodlib (see ``stochastic_sample_size``).
+        seed (int): Seed of the candidate sampling.
+
+    Returns:
+        List[Tuple[int, float]]: Selected elements and their marginal gains, in
+        selection order, like submodlib's ``maximize``.
+    """
+    validate_optimizer(optimizer)
+    num_rows, device = kernel.num_rows, kernel.device
+    budget = min(budget, num_rows)
+    if budget <= 0:
+        return []
+
+    coverage = torch.zeros(num_rows, dtype=torch.float64, device=device)
+    available = torch.ones(num_rows, dtype=torch.bool, device=device)
+    selected = torch.empty(budget, dtype=torch.int64, device=device)
+    selected_gains = torch.empty(budget, dtype=torch.float64, device=device)
+
+    sample_size = None
+    if optimizer != "NaiveGreedy":
+        sample_size = stochastic_sample_size(num_rows, budget, epsilon)
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+
+    for step in range(budget):
+        remaining = num_rows - step
+        if sample_size is None or sample_size >= remaining:
+            candidates = torch.nonzero(available).reshape(-1)
+        else:
+            # Uniform sample without replacement: the smallest random keys
+            # among the remaining elements
+            keys = torch.rand(num_rows, generator=generator, device=device)
+            keys.masked_fill_(~available, 2.0)
+            candidates = torch.topk(keys, sample_size, largest=False).indices
+
+        gains = kernel.gains(candidates, coverage)
+        best = torch.argmax(gains)
+        item = candidates[best]
+        selected[step] = item
+        selected_gains[step] = gains[best]
+        available[item] = False
+        kernel.update(item, coverage)
+
+    return list(zip(selected.tolist(), selected_gains.tolist(), strict=True))
@@ -0,0 +1,120 @@
+# Standard
+from typing import Any, Dict, Optional
+import glob
+import json
+import logging
+import os
+import struct
+
+# Third Party
+from transformers import AutoConfig, AutoModel
+import torch
+
+logger = logging.getLogger(__name__)
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def load_safetensors_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Load a safetensors file as tensors backed by a private memory mapping of it.
+
+    The file is mapped copy-on-write, so processes that load the same file share
+    its pages through the page cache for as long as the tensors are only read.
+
+    Args:
+        path (str): Path to a ``.safetensors`` file.
+
+    Returns:
+        Dict[str, torch.Tensor]: Tensors by name.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+
+    storage = torch.UntypedStorage.from_file(
+        path, shared=False, nbytes=os.path.getsize(path)
+    )
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    data_start = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        raw = data[data_start + start : data_start + end]
+        if (data_start + start) % torch.empty(0, dtype=dtype).element_size():
+            raw = raw.clone()  # Misaligned tensors need a private, aligned copy
+        tensors[name] = raw.view(dtype).reshape(info["shape"])
+    return tensors
+
+
+def load_model_mmap(model_path: str, **model_kwargs: Any) -> Optional[torch.nn.Module]:
+    """
+    Build a transformers model whose weights are memory-mapped from its safetensors files.
+
+    Only parameters are created empty and then assigned the mapped tensors, so
+    worker processes on one host share a single copy of the weights. Returns None
+    when the checkpoint cannot be loaded this way (no local safetensors files, no
+    ``accelerate``, non-float32 weights or missing tensors), in which case the
+    caller should fall back to ``from_pretrained``.
+
+    Args:
+        model_path (str): Local model directory.
+        **model_kwargs: Extra arguments for the model constructor.
+    """
+    weight_files = sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+    if not weight_files:
+        return None
+    try:
+        # Third Party
+        # pylint: disable=import-outside-toplevel
+        from accelerate import init_empty_weights
+    except ImportError:
+        logger.warning("accelerate is not installed, weights will not be memory-mapped")
+        return None
+
+    config = AutoConfig.from_pretrained(
+        model_path, trust_remote_code=True, local_files_only=True
+    )
+    with init_empty_weights():
+        model = AutoModel.from_config(config, trust_remote_code=True, **model_kwargs)
+
+    expected = model.state_dict()
+    prefix = f"{model.base_model_prefix}."
+    state_dict = {}
+    for path in weight_files:
+        for name, tensor in load_safetensors_mmap(path).items():
+            if name not in expected and name.startswith(prefix):
+                name = name[len(prefix) :]
+            if name in expected:
+                state_dict[name] = tensor
+
+    missing = [name for name in expected if name not in state_dict]
+    if missing:
+        logger.warning(
+            f"{len(missing)} tensors missing from the safetensors files in {model_path}, "
+            "weights will not be memory-mapped"
+        )
+        return None
+    if any(
+        tensor.is_floating_point() and tensor.dtype != expected[name].dtype
+        for name, tensor in state_dict.items()
+    ):
+        # Converting the weights would give every process a private copy anyway
+        return None
+
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    return model
@@ -1,13 +1,18 @@
 # Standard
 from functools import wraps
-from typing import Optional, Union
+from typing import Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
 import gc
+import heapq
 import logging
+import os
+import queue
+import threading
 import time
 
 # Third Party
 from torch import Tensor
 from torch.nn import functional as F
+import numpy as np
 import torch
 
 # Configure logging
@@ -16,6 +21,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class TerminationRequested(Exception):
+    """Raised when a worker stops after SIGTERM; never retried."""
+
 
 def retry_on_exception(func):
     """
@@ -28,6 +39,9 @@ def retry_on_exception(func):
         for attempt in range(self.config.system.max_retries):
             try:
                 return func(self, *args, **kwargs)
+            except TerminationRequested:
+                # The job is being preempted; exit instead of encoding again
+                raise
             except torch.cuda.OutOfMemoryError as e:
                 # Happens when GPU runs out of memory during batch processing
                 last_exception = e
@@ -63,13 +77,167 @@ def retry_on_exception(func):
     return wrapper
 
 
-def get_default_num_gpus(testing_mode: bool = False) -> int:
+class _ProducerError:
+    """Wraps an exception raised by a background producer thread."""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def prefetch_iterator(iterable: Iterable[T], max_prefetch: int) -> Iterator[T]:
+    """
+    Consume an iterable on a background thread, handing items over through a bounded queue.
+
+    This lets CPU-bound preparation of item N+1 (e.g. rendering and tokenization)
+    overlap with the consumer's work on item N. Exceptions raised by the producer
+    are re-raised in the consumer.
+
+    Args:
+        iterable (Iterable[T]): The items to produce.
+        max_prefetch (int): Maximum number of items produced ahead of the consumer.
+            A value of 0 disables the background thread.
+    """
+    if max_prefetch <= 0:
+        yield from iterable
+        return
+
+    items: queue.Queue = queue.Queue(maxsize=max_prefetch)
+    stop_event = threading.Event()
+    sentinel = object()
+
+    def put(item) -> bool:
+        while not stop_event.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            put(_ProducerError(e))
+        else:
+            put(sentinel)
+
+    producer = threading.Thread(target=produce, name="prefetch-producer", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is sentinel:
+                break
+            if isinstance(item, _ProducerError):
+                raise item.exception
+            yield item
+    finally:
+        stop_event.set()
+        producer.join()
+
+
+def get_available_cpu_cores() -> int:
+    """Number of CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_cpu_worker_layout(
+    num_workers: Optional[int] = None, threads_per_worker: Optional[int] = None
+) -> Tuple[int, int]:
+    """
+    Partition the available CPU cores into worker processes and intra-op threads.
+
+    Args:
+        num_workers (Optional[int]): Number of worker processes. Derived from the
+            available cores when not given.
+        threads_per_worker (Optional[int]): Intra-op threads per worker. Derived from
+            the available cores when not given.
+
+    Returns:
+        Tuple[int, int]: Number of workers and threads per worker.
+    """
+    cores = get_available_cpu_cores()
+    if num_workers is None and threads_per_worker is None:
+        # Transformer inference scales well up to a handful of threads per process;
+        # beyond that, more processes give better throughput
+        threads_per_worker = min(8, cores)
+    if num_workers is None:
+        num_workers = max(1, cores // threads_per_worker)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cores // num_workers)
+    if num_workers * threads_per_worker > cores:
+        logger.warning(
+            f"{num_workers} CPU workers with {threads_per_worker} threads each "
+            f"oversubscribe the {cores} available cores"
+        )
+    return num_workers, threads_per_worker
+
+
+def split_row_blocks(
+    row_costs: np.ndarray, block_rows: int
+) -> Tuple[List[Tuple[int, int]], np.ndarray]:
+    """
+    Split rows into contiguous blocks and order them longest first.
+
+    Args:
+        row_costs (np.ndarray): Estimated encoding cost of every row, e.g. its
+            text length.
+        block_rows (int): Rows per block.
+
+    Returns:
+        Tuple[List[Tuple[int, int]], np.ndarray]: Row range of every block, and
+        the block indices sorted by descending total cost.
+    """
+    num_rows = len(row_costs)
+    blocks = [
+        (start, min(start + block_rows, num_rows))
+        for start in range(0, num_rows, block_rows)
+    ]
+    if not blocks:
+        return blocks, np.empty(0, dtype=np.int64)
+    costs = np.add.reduceat(np.asarray(row_costs, dtype=np.float64), [s for s, _ in blocks])
+    return blocks, np.argsort(-costs, kind="stable")
+
+
+def assign_blocks(block_costs: np.ndarray, num_workers: int) -> List[List[int]]:
+    """
+    Statically assign blocks to workers, longest processing time first.
+
+    Every block goes to the worker with the least assigned cost so far, which
+    keeps the finish times of the workers close without communication.
+
+    Args:
+        block_costs (np.ndarray): Estimated cost of every block.
+        num_workers (int): Number of workers.
+
+    Returns:
+        List[List[int]]: Block indices of every worker, longest first.
+    """
+    assignments: List[List[int]] = [[] for _ in range(num_workers)]
+    loads = [(0.0, worker) for worker in range(num_workers)]
+    for block in np.argsort(-np.asarray(block_costs), kind="stable"):
+        load, worker = heapq.heappop(loads)
+        assignments[worker].append(int(block))
+        heapq.heappush(loads, (load + float(block_costs[block]), worker))
+    return assignments
+
+
+def get_default_num_gpus(testing_mode: bool = False, cpu_mode: bool = False) -> int:
     """
     Get the default number of GPUs based on available CUDA devices.
 
     Args:
         testing_mode (bool): If True, allows CPU usage with warnings. For testing only.
+        cpu_mode (bool): If True, run on CPU workers in production; returns the
+            default number of CPU worker processes.
     """
+    if cpu_mode:
+        return get_cpu_worker_layout()[0]
     if not torch.cuda.is_available():
         if testing_mode:
             logger.warning(
@@ -78,7 +246,8 @@ def get_default_num_gpus(testing_mode: bool = False) -> int:
             )
             return 1
         raise RuntimeError(
-            "No CUDA devices detected. This functionality requires at least one GPU."
+            "No CUDA devices detected. This functionality requires at least one GPU. "
+            "Use CPU mode to run on CPU workers."
         )
     return torch.cuda.device_count()
 
@@ -91,8 +260,13 @@ def compute_pairwise_dense(
     device: Optional[Union[str, torch.device]] = None,
     scaling: Optional[str] = None,
     kw: float = 0.1,
+    output_device: Optional[Union[str, torch.device]] = "cpu",
 ) -> Tensor:
-    """Compute pairwise metric in batches between two sets of vectors."""
+    """Compute pairwise metric in batches between two sets of vectors.
+
+    The result is assembled on ``output_device`` (the CPU by default, where it
+    fits more easily), or left on the compute device with ``output_device=device``.
+    """
     assert batch_size > 0, "Batch size must be positive."
 
     if not device:
@@ -103,7 +277,7 @@ def compute_pairwise_dense(
 
     tensor1, tensor2 = tensor1.to(device), tensor2.to(device)
     n_samples1, n_samples2 = tensor1.size(0), tensor2.size(0)
-    results = torch.zeros(n_samples1, n_samples2, device="cpu")
+    results = torch.zeros(n_samples1, n_samples2, device=output_device)
 
     if metric == "cosine":
         tensor1, tensor2 = (
@@ -134,7 +308,7 @@ def compute_pairwise_dense(
         for j in range(0, n_samples2, batch_size):
             end_j = min(j + batch_size, n_samples2)
             cols = tensor2[j:end_j]
-            batch_results = calculate_metric(rows, cols, metric, kw).cpu()
+            batch_results = calculate_metric(rows, cols, metric, kw).to(results.device)
             results[i:end_i, j:end_j] = batch_results
 
     if scaling == "min-max":
@@ -144,4 +318,65 @@ def compute_pairwise_dense(
     elif scaling == "additive":
         results = (results + 1) / 2
 
-    return results
\ No newline at end of file
+    return results
+
+
+def compute_topk_similarities(
+    tensor: Tensor,
+    num_neighbors: int,
+    batch_size: int = 8192,
+    device: Optional[Union[str, torch.device]] = None,
+    scaling: Optional[str] = "additive",
+) -> Tuple[Tensor, Tensor]:
+    """
+    Compute the exact top-k cosine similarities of every row, block by block.
+
+    Only one ``batch_size`` x ``batch_size`` block of similarities and the running
+    top-k of the current rows are held on the device at a time, so memory grows
+    with ``n * num_neighbors`` instead of ``n * n``.
+
+    Args:
+        tensor (Tensor): Vectors of shape ``(n, dim)``.
+        num_neighbors (int): Neighbours kept per row, including the row itself.
+        batch_size (int): Rows and columns per similarity block.
+        device (Optional[Union[str, torch.device]]): Device to compute on.
+        scaling (Optional[str]): ``"additive"`` maps similarities to ``[0, 1]``
+            like ``compute_pairwise_dense``.
+
+    Returns:
+        Tuple[Tensor, Tensor]: Similarities and column indices of shape
+        ``(n, min(num_neighbors, n))`` on the CPU, sorted by descending similarity.
+    """
+    assert batch_size > 0, "Batch size must be positive."
+    if not device:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    tensor = F.normalize(tensor.to(device), p=2, dim=1)
+    n_samples = tensor.size(0)
+    k = min(num_neighbors, n_samples)
+    values = torch.empty((n_samples, k), dtype=torch.float32)
+    indices = torch.empty((n_samples, k), dtype=torch.int64)
+
+    for i in range(0, n_samples, batch_size):
+        end_i = min(i + batch_size, n_samples)
+        rows = tensor[i:end_i]
+        best_values, best_indices = None, None
+        for j in range(0, n_samples, batch_size):
+            block = torch.mm(rows, tensor[j : j + batch_size].T)
+            block_values, block_indices = block.topk(min(k, block.size(1)), dim=1)
+            block_indices += j
+            if best_values is not None:
+                # Merge with the running top-k of these rows
+                block_values = torch.cat([best_values, block_values], dim=1)
+                block_indices = torch.cat([best_indices, block_indices], dim=1)
+                block_values, order = block_values.topk(
+                    min(k, block_values.size(1)), dim=1
+                )
+                block_indices = block_indices.gather(1, order)
+            best_values, best_indices = block_values, block_indices
+        values[i:end_i] = best_values.float().cpu()
+        indices[i:end_i] = best_indices.cpu()
+
+    if scaling == "additive":
+        values = (values + 1) / 2
+    return values, indices
@@ -0,0 +1,131 @@
+# Standard
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+# Third Party
+from jinja2 import BaseLoader, Environment, Template
+
+# Column holding the rendered text of every row
+RENDERED_TEXT_COLUMN = "__rendered_text"
+
+# Built-in templates of TemplateConfig with equivalent Python formatters
+DEFAULT_TEMPLATE = "{{ text }}"
+CONVERSATION_TEMPLATE = (
+    "{% for msg in messages if msg.role != 'system' %}"
+    "{{ msg.role }}: {{ msg.content }}\n{% endfor %}"
+)
+QA_TEMPLATE = "Question: {{ question }}\nAnswer: {{ answer }}"
+
+_MISSING = object()
+
+
+def _to_str(value: Any) -> str:
+    """Render a value the way Jinja does; missing values render as empty strings."""
+    if value is _MISSING:
+        return ""
+    return value if isinstance(value, str) else str(value)
+
+
+def _column(batch: Dict[str, List[Any]], name: str, num_rows: int) -> List[Any]:
+    return batch[name] if name in batch else [_MISSING] * num_rows
+
+
+def _format_default(batch: Dict[str, List[Any]], num_rows: int) -> List[str]:
+    return [_to_str(text) for text in _column(batch, "text", num_rows)]
+
+
+def _format_conversation(batch: Dict[str, List[Any]], num_rows: int) -> List[str]:
+    return [
+        "".join(
+            f"{_to_str(msg.get('role', _MISSING))}: {_to_str(msg.get('content', _MISSING))}\n"
+            # Like an undefined loop target in Jinja, a missing column renders nothing
+            for msg in ([] if messages is _MISSING else messages)
+            if msg.get("role", _MISSING) != "system"
+        )
+        for messages in _column(batch, "messages", num_rows)
+    ]
+
+
+def _format_qa(batch: Dict[str, List[Any]], num_rows: int) -> List[str]:
+    return [
+        f"Question: {_to_str(question)}\nAnswer: {_to_str(answer)}"
+        for question, answer in zip(
+            _column(batch, "question", num_rows),
+            _column(batch, "answer", num_rows),
+            strict=True,
+        )
+    ]
+
+
+_FAST_FORMATTERS: Dict[str, Callable[[Dict[str, List[Any]], int], List[str]]] = {
+    DEFAULT_TEMPLATE: _format_default,
+    CONVERSATION_TEMPLATE: _format_conversation,
+    QA_TEMPLATE: _format_qa,
+}
+
+
+@lru_cache(maxsize=None)
+def _compile_template(template_source: str) -> Template:
+    return Environment(loader=BaseLoader()).from_string(template_source)
+
+
+def render_batch(
+    batch: Dict[str, List[Any]], template_source: str
+) -> Dict[str, List[str]]:
+    """
+    Render a batch of rows given as columns.
+
+    Built-in templates are rendered by equivalent Python formatters; any other
+    template is rendered with Jinja row by row.
+
+    Args:
+        batch (Dict[str, List[Any]]): Columns of the batch, as passed by
+            ``datasets.Dataset.map(batched=True)``.
+        template_source (str): Jinja template source.
+
+    Returns:
+        Dict[str, List[str]]: The rendered texts in ``RENDERED_TEXT_COLUMN``.
+    """
+    num_rows = len(next(iter(batch.values()))) if batch else 0
+    formatter = _FAST_FORMATTERS.get(template_source)
+    if formatter is not None:
+        return {RENDERED_TEXT_COLUMN: formatter(batch, num_rows)}
+
+    template = _compile_template(template_source)
+    columns = list(batch.keys())
+    return {
+        RENDERED_TEXT_COLUMN: [
+            template.render(**{name: batch[name][i] for name in columns})
+            for i in range(num_rows)
+        ]
+    }
+
+
+def render_dataset(
+    dataset, template_source: str, num_proc: Optional[int] = None, batch_size: int = 1000
+):
+    """
+    Render every row of a dataset into a single Arrow text column.
+
+    The result is written by ``datasets`` to an Arrow cache file, so encoder
+    workers that receive slices of it memory-map the rendered texts instead of
+    copying them.
+
+    Args:
+        dataset: The dataset to render.
+        template_source (str): Jinja template source.
+        num_proc (Optional[int]): Number of rendering processes.
+        batch_size (int): Rows per rendering call.
+
+    Returns:
+        A dataset with only ``RENDERED_TEXT_COLUMN``.
+    """
+    return dataset.map(
+        render_batch,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc if num_proc and num_proc > 1 else None,
+        fn_kwargs={"template_source": template_source},
+        remove_columns=dataset.column_names,
+        desc="Rendering templates",
+    )
@@ -0,0 +1,193 @@
+# Standard
+from typing import Any, Dict, List, Optional
+
+# Third Party
+import numpy as np
+
+# Which tokens to keep when a text exceeds the sequence cap. The instruction
+# prefix is always kept; "tail" and "head+tail" drop tokens from the text itself.
+TRUNCATION_POLICIES = ("head", "tail", "head+tail")
+
+TOKEN_LENGTH_REPORT_FILE = "token_lengths.json"
+
+
+def validate_truncation_policy(truncation: str) -> None:
+    """Raise a ValueError for unsupported truncation policies."""
+    if truncation not in TRUNCATION_POLICIES:
+        raise ValueError(
+            f"Unsupported truncation policy: '{truncation}'. "
+            f"Supported policies are: {list(TRUNCATION_POLICIES)}"
+        )
+
+
+def truncate_token_ids(
+    ids: List[int], budget: int, num_prefix_tokens: int = 0, truncation: str = "head"
+) -> List[int]:
+    """
+    Truncate token ids (without special tokens) to at most ``budget`` tokens.
+
+    Args:
+        ids (List[int]): Token ids of one input.
+        budget (int): Maximum number of tokens to keep.
+        num_prefix_tokens (int): Leading tokens that are always kept (the instruction).
+        truncation (str): One of ``TRUNCATION_POLICIES``.
+
+    Returns:
+        List[int]: The kept token ids.
+    """
+    if len(ids) <= budget:
+        return ids
+    if truncation == "head" or num_prefix_tokens >= budget:
+        return ids[:budget]
+
+    if truncation == "tail":
+        head = num_prefix_tokens
+    else:
+        head = num_prefix_tokens + (budget - num_prefix_tokens + 1) // 2
+    tail = budget - head
+    return ids[:head] + (ids[len(ids) - tail :] if tail > 0 else [])
+
+
+def count_tokens(
+    batch: Dict[str, List[str]], tokenizer, prefix: str, column: str
+) -> Dict[str, List[int]]:
+    """
+    Count the untruncated tokens of a batch of texts, for ``datasets.Dataset.map``.
+
+    Args:
+        batch (Dict[str, List[str]]): Columns of the batch.
+        tokenizer: Tokenizer of the encoder.
+        prefix (str): Text prepended to every input (the instruction).
+        column (str): Column holding the texts.
+
+    Returns:
+        Dict[str, List[int]]: Token counts including special tokens in ``num_tokens``.
+    """
+    num_special = tokenizer.num_special_tokens_to_add()
+    encodings = tokenizer(
+        [prefix + text for text in batch[column]],
+        add_special_tokens=False,
+        padding=False,
+        truncation=False,
+        verbose=False,
+    )
+    return {"num_tokens": [len(ids) + num_special for ids in encodings["input_ids"]]}
+
+
+def make_batches(
+    lengths: List[int],
+    batch_size: int,
+    max_tokens_per_batch: Optional[int] = None,
+    sort_by_length: bool = True,
+) -> List[np.ndarray]:
+    """Group input positions into forward batches.
+
+    With ``sort_by_length`` enabled, positions are ordered by descending
+    token length so that sequences of similar length share a batch. With
+    ``max_tokens_per_batch`` set, each batch holds as many sequences as fit
+    the padded-token budget (always at least one).
+    """
+    if sort_by_length:
+        order = np.argsort(-np.asarray(lengths), kind="stable")
+    else:
+        order = np.arange(len(lengths))
+
+    if max_tokens_per_batch is None:
+        return [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+    batches = []
+    start, longest = 0, 0
+    for end, idx in enumerate(order):
+        candidate = max(longest, lengths[idx])
+        if end > start and candidate * (end - start + 1) > max_tokens_per_batch:
+            batches.append(order[start:end])
+            start, candidate = end, lengths[idx]
+        longest = candidate
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def _padded_tokens(
+    lengths: np.ndarray,
+    chunk_size: int,
+    batch_size: int,
+    max_tokens_per_batch: Optional[int],
+    sort_by_length: bool,
+) -> int:
+    """Number of padded tokens the encoder processes for the given input lengths."""
+    total = 0
+    for start in range(0, len(lengths), chunk_size):
+        chunk = lengths[start : start + chunk_size]
+        for batch in make_batches(chunk, batch_size, max_tokens_per_batch, sort_by_length):
+            total += int(chunk[batch].max()) * len(batch)
+    return total
+
+
+def summarize_token_lengths(
+    lengths: np.ndarray,
+    max_length: int,
+    truncation: str,
+    chunk_size: int,
+    batch_size: int,
+    max_tokens_per_batch: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Summarize token lengths and the padding waste of encoding them.
+
+    Args:
+        lengths (np.ndarray): Untruncated token length of every input, including
+            the instruction and special tokens.
+        max_length (int): Sequence cap of the encoder.
+        truncation (str): Truncation policy applied beyond the cap.
+        chunk_size (int): Number of inputs the encoder batches at a time (the
+            shard batch size).
+        batch_size (int): Sequences per forward batch of the encoder.
+        max_tokens_per_batch (Optional[int]): Padded-token budget per forward batch.
+
+    Returns:
+        Dict[str, Any]: Percentiles, a power-of-two histogram, truncation
+        statistics and padding waste with and without length sorting.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    capped = np.minimum(lengths, max_length)
+    report: Dict[str, Any] = {
+        "num_texts": int(len(lengths)),
+        "max_length": int(max_length),
+        "truncation": truncation,
+    }
+    if len(lengths) == 0:
+        return report
+
+    report["percentiles"] = {
+        f"p{q}": int(np.percentile(lengths, q)) for q in (50, 90, 95, 99)
+    }
+    report["percentiles"]["max"] = int(lengths.max())
+    report["mean_length"] = float(lengths.mean())
+
+    edges = [0]
+    while edges[-1] < lengths.max():
+        edges.append(max(32, edges[-1] * 2))
+    counts, _ = np.histogram(lengths, bins=edges + [edges[-1] + 1])
+    report["histogram"] = [
+        {"min_length": low, "max_length": high - 1, "count": int(count)}
+        for low, high, count in zip(
+            edges, edges[1:] + [edges[-1] + 1], counts, strict=True
+        )
+        if count > 0
+    ]
+
+    truncated = lengths > max_length
+    report["num_truncated"] = int(truncated.sum())
+    report["truncated_fraction"] = float(truncated.mean())
+    report["dropped_token_fraction"] = float(1 - capped.sum() / lengths.sum())
+
+    real_tokens = int(capped.sum())
+    for name, sort_by_length in (("sorted", True), ("unsorted", False)):
+        padded = _padded_tokens(
+            capped, chunk_size, batch_size, max_tokens_per_batch, sort_by_length
+        )
+        report[f"padded_tokens_{name}"] = padded
+        report[f"padding_waste_{name}"] = float(1 - real_tokens / padded)
+    report["real_tokens"] = real_tokens
+    return report
@@ -0,0 +1,97 @@
+"""
+Test the approximate nearest-neighbour similarity graphs of subset selection.
+
+Neighbours found by hnswlib and faiss must match most of the exact top-k
+neighbours, with the same similarities, and persisted indexes must be reused.
+"""
+
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.utils.ann_index import (  # noqa: E402
+    ann_index_path,
+    compute_ann_similarities,
+)
+from scripts.subset_selection.utils.subset_selection_utils import (  # noqa: E402
+    compute_topk_similarities,
+)
+
+NUM_NEIGHBORS = 10
+
+PARAMS = {
+    "hnswlib": {"backend": "hnswlib", "m": 16, "ef_construction": 100, "ef_search": 50},
+    "faiss": {"backend": "faiss", "nlist": None, "nprobe": 8},
+}
+
+
+@pytest.fixture(params=list(PARAMS))
+def params(request):
+    pytest.importorskip(request.param)
+    return PARAMS[request.param]
+
+
+def make_embeddings(num_rows=2000, dim=32):
+    """Rows around a few dozen centres, like embeddings of related texts."""
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(40, dim))
+    rows = centres[rng.integers(0, len(centres), num_rows)]
+    return torch.from_numpy((rows + 0.5 * rng.normal(size=rows.shape)).astype(np.float32))
+
+
+def recall(indices, exact_indices):
+    found = [
+        len(set(row.tolist()) & set(exact_row.tolist()))
+        for row, exact_row in zip(indices, exact_indices, strict=True)
+    ]
+    return sum(found) / exact_indices.numel()
+
+
+def test_ann_recall_matches_exact_topk(params):
+    embeddings = make_embeddings()
+    _, exact_indices = compute_topk_similarities(
+        embeddings, NUM_NEIGHBORS, device="cpu"
+    )
+
+    values, indices = compute_ann_similarities(embeddings, NUM_NEIGHBORS, params)
+
+    assert values.shape == indices.shape == exact_indices.shape
+    assert recall(indices, exact_indices) >= 0.9
+    # Every row finds itself, and the reported similarities are exact ones
+    assert (indices[:, 0] == torch.arange(len(embeddings))).float().mean() >= 0.99
+    normalized = torch.nn.functional.normalize(embeddings, dim=1)
+    expected = (normalized.unsqueeze(1) * normalized[indices]).sum(dim=2)
+    torch.testing.assert_close(values, (expected + 1) / 2, atol=1e-4, rtol=0)
+    assert values.max() <= 1 + 1e-5
+
+
+def test_persisted_index_is_reused(params, tmp_path):
+    embeddings = make_embeddings(500)
+    index_path = ann_index_path(str(tmp_path), "fold_0", embeddings.numpy(), params)
+
+    first = compute_ann_similarities(
+        embeddings, NUM_NEIGHBORS, params, index_path=index_path
+    )
+    assert Path(index_path).exists()
+    mtime = Path(index_path).stat().st_mtime_ns
+    second = compute_ann_similarities(
+        embeddings, NUM_NEIGHBORS, params, index_path=index_path
+    )
+
+    assert Path(index_path).stat().st_mtime_ns == mtime
+    torch.testing.assert_close(second[0], first[0])
+    torch.testing.assert_close(second[1], first[1])
+    # Other vectors or settings get an index of their own
+    assert ann_index_path(str(tmp_path), "fold_0", embeddings.numpy()[:-1], params) != (
+        index_path
+    )
+    assert (
+        ann_index_path(str(tmp_path), "fold_0", embeddings.numpy(), {**params, "x": 1})
+        != index_path
+    )
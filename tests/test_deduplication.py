@@ -0,0 +1,131 @@
+"""
+Test the deduplication of identical texts in subset selection.
+
+Identical texts of a batch are encoded once, and deduplicated selection maps
+the selected unique texts back to dataset rows while sizing subsets by all rows.
+"""
+
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+h5py = pytest.importorskip("h5py")
+datasets = pytest.importorskip("datasets")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.encoders import ENCODER_REGISTRY  # noqa: E402
+from scripts.subset_selection.subset_selection import (  # noqa: E402
+    BasicConfig,
+    DataProcessor,
+    EncoderConfig,
+    ProcessingConfig,
+    SystemConfig,
+    TemplateConfig,
+    _find_unique_rows,
+    _process_dataset_shard,
+)
+from scripts.subset_selection.utils.embedding_cache import (  # noqa: E402
+    compute_cache_keys,
+    keys_from_uint8,
+)
+from scripts.subset_selection.utils.template_rendering import (  # noqa: E402
+    RENDERED_TEXT_COLUMN,
+)
+
+DIM = 4
+TEXTS = ["a", "b", "a", "c", "b", "a", "d", "d", "a", "e"]
+
+
+def text_embedding(text):
+    """Distinct unit vector of every text."""
+    embedding = np.random.default_rng(ord(text)).normal(size=DIM)
+    return (embedding / np.linalg.norm(embedding)).astype(np.float32)
+
+
+class CountingEncoder:
+    """Encoder that records every text it encodes."""
+
+    embedding_dim = DIM
+    cache_key_fields = {"model_name": "counting"}
+    encoded = []
+
+    def __init__(self, device):
+        pass
+
+    def prepare_batches(self, inputs, instruction=""):
+        return list(inputs)
+
+    def encode_into(self, prepared, out, offset=0, show_progress=False):
+        CountingEncoder.encoded.extend(prepared)
+        for i, text in enumerate(prepared):
+            out[offset + i] = text_embedding(text)
+
+
+def test_duplicate_texts_are_encoded_once(tmp_path, monkeypatch):
+    monkeypatch.setitem(ENCODER_REGISTRY, "counting", CountingEncoder)
+    monkeypatch.setattr(CountingEncoder, "encoded", [])
+    shard = datasets.Dataset.from_dict({RENDERED_TEXT_COLUMN: TEXTS})
+
+    shard_file = _process_dataset_shard(
+        (
+            0,
+            shard,
+            (0, len(TEXTS)),
+            str(tmp_path),
+            "counting",
+            {},
+            "",
+            len(TEXTS),
+            0,
+            None,
+            "float32",
+            False,
+            0,
+        )
+    )
+
+    assert sorted(CountingEncoder.encoded) == sorted(set(TEXTS))
+    with h5py.File(shard_file, "r") as f:
+        np.testing.assert_array_equal(
+            f["embeddings"][:], np.stack([text_embedding(text) for text in TEXTS])
+        )
+        assert list(keys_from_uint8(f["keys"][:])) == list(
+            compute_cache_keys(TEXTS, {"model_name": "counting", "instruction": ""})
+        )
+
+
+def make_processor(tmp_path, subset_sizes):
+    config = ProcessingConfig(
+        input_files=[str(tmp_path / "data.jsonl")],
+        subset_sizes=subset_sizes,
+        basic=BasicConfig(
+            output_dir=str(tmp_path), num_folds=1, optimizer_backend="torch"
+        ),
+        encoder=EncoderConfig(),
+        template=TemplateConfig(),
+        system=SystemConfig(cpu_mode=True, cpu_workers=1, threads_per_worker=1),
+    )
+    return DataProcessor(config)
+
+
+def test_selection_maps_unique_texts_to_rows_and_sizes_by_all_rows(tmp_path):
+    row_ids, counts = _find_unique_rows(compute_cache_keys(TEXTS, {}))
+    embeddings = torch.from_numpy(np.stack([text_embedding(TEXTS[i]) for i in row_ids]))
+    weights = torch.tensor(counts, dtype=torch.float32)
+    processor = make_processor(tmp_path, [0.3, 0.9, 2])
+
+    subsets = processor.select_subsets("data", embeddings, weights, row_ids)
+
+    # First occurrence of each unique text
+    np.testing.assert_array_equal(row_ids, [0, 1, 3, 6, 9])
+    # 30% of the 10 rows, not of the 5 unique texts
+    assert len(subsets[0.3]) == 3
+    # At most every unique text
+    assert sorted(subsets[0.9]) == [0, 1, 3, 6, 9]
+    assert len(subsets[2]) == 2
+    for indices in subsets.values():
+        assert set(indices) <= set(row_ids.tolist())
@@ -0,0 +1,160 @@
+"""
+Test distributed subset selection.
+
+Two gloo ranks encode a bundle of small files and select their subsets; the
+merged embeddings stores and the subsets must match a single-process run.
+A tiny randomly initialized model stands in for the Arctic encoder.
+"""
+
+from pathlib import Path
+import json
+import os
+import socket
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+h5py = pytest.importorskip("h5py")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("datasets")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.subset_selection import subset_datasets  # noqa: E402
+
+MODEL_NAME = "Snowflake/snowflake-arctic-embed-l-v2.0"
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu".split()
+INPUT_NAMES = ["part0", "part1"]
+SUBSET_SIZES = [5, 0.5]
+WORLD_SIZE = 2
+
+SETTINGS = {
+    "template_name": "default",
+    "num_folds": 2,
+    "optimizer_backend": "torch",
+    "max_length": 64,
+    "cpu_workers": 1,
+    "threads_per_worker": 1,
+}
+
+
+def write_model(home):
+    """Save a tiny model where the encoder looks for local models."""
+    model_dir = home / ".cache" / "instructlab" / "models" / MODEL_NAME
+    model_dir.mkdir(parents=True)
+    vocab_file = model_dir / "vocab.txt"
+    vocab_file.write_text("\n".join(["<cls>", "<pad>", "<eos>", "<unk>", "<mask>"] + WORDS))
+    # A word-level vocabulary tokenizer, so no tokenizer files need to be downloaded
+    transformers.EsmTokenizer(str(vocab_file)).save_pretrained(str(model_dir))
+
+    torch.manual_seed(0)
+    config = transformers.XLMRobertaConfig(
+        vocab_size=5 + len(WORDS),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=130,
+        pad_token_id=1,
+        # The default initialization embeds all texts almost alike
+        initializer_range=0.5,
+    )
+    transformers.XLMRobertaModel(config, add_pooling_layer=False).save_pretrained(
+        str(model_dir)
+    )
+
+
+def write_inputs(data_dir):
+    """Write two small input files, which are encoded as one bundle."""
+    rng = np.random.default_rng(0)
+    input_files = []
+    for name in INPUT_NAMES:
+        path = data_dir / f"{name}.jsonl"
+        with open(path, "w", encoding="utf-8") as f:
+            for _ in range(30):
+                text = " ".join(rng.choice(WORDS, rng.integers(3, 12)))
+                f.write(json.dumps({"text": text}) + "\n")
+        input_files.append(str(path))
+    return input_files
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_rank(rank, port, input_files, output_dir):
+    """Run subset selection as one rank of a torchrun-style launch."""
+    os.environ.update(
+        {
+            "MASTER_ADDR": "127.0.0.1",
+            "MASTER_PORT": str(port),
+            "RANK": str(rank),
+            "WORLD_SIZE": str(WORLD_SIZE),
+            "LOCAL_RANK": str(rank),
+            "LOCAL_WORLD_SIZE": str(WORLD_SIZE),
+        }
+    )
+    subset_datasets(
+        input_files,
+        SUBSET_SIZES,
+        cpu_mode=True,
+        distributed=True,
+        output_dir=output_dir,
+        **SETTINGS,
+    )
+
+
+def test_distributed_run_matches_single_process(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    write_model(tmp_path / "home")
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    input_files = write_inputs(data_dir)
+
+    single_dir = tmp_path / "single"
+    subset_datasets(
+        input_files, SUBSET_SIZES, cpu_mode=True, output_dir=str(single_dir), **SETTINGS
+    )
+    distributed_dir = tmp_path / "distributed"
+    # Bundle left over from an interrupted run, which only rank 0 may remove
+    (distributed_dir / "_file_bundle").mkdir(parents=True)
+    (distributed_dir / "_file_bundle" / "embeddings.h5").write_bytes(b"")
+    torch.multiprocessing.spawn(
+        run_rank,
+        args=(free_port(), input_files, str(distributed_dir)),
+        nprocs=WORLD_SIZE,
+    )
+
+    assert not (distributed_dir / "_file_bundle").exists()
+    for name in INPUT_NAMES:
+        store = Path(name) / "embeddings" / "embeddings.h5"
+        with h5py.File(single_dir / store, "r") as single, h5py.File(
+            distributed_dir / store, "r"
+        ) as distributed:
+            np.testing.assert_allclose(
+                distributed["embeddings"][:], single["embeddings"][:], atol=1e-5
+            )
+            np.testing.assert_array_equal(distributed["keys"][:], single["keys"][:])
+
+        single_outputs = sorted(
+            path.relative_to(single_dir) for path in single_dir.glob(f"{name}*/*.jsonl")
+        )
+        assert len(single_outputs) == len(SUBSET_SIZES)
+        for output in single_outputs:
+            assert (distributed_dir / output).read_text() == (
+                single_dir / output
+            ).read_text()
+
+        for metadata in single_dir.glob(f"{name}_*_metadata.npz"):
+            single_metadata = np.load(metadata)
+            distributed_metadata = np.load(distributed_dir / metadata.name)
+            np.testing.assert_array_equal(
+                distributed_metadata["indices"], single_metadata["indices"]
+            )
+            np.testing.assert_allclose(
+                distributed_metadata["gains"], single_metadata["gains"], rtol=1e-4
+            )
@@ -0,0 +1,140 @@
+"""
+Test the persistent embedding cache of subset selection.
+
+Covers inserts and lookups across cache shards and the eviction of the least
+recently used entries once the cache outgrows its size bound.
+"""
+
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("h5py")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.utils import embedding_cache  # noqa: E402
+from scripts.subset_selection.utils.embedding_cache import (  # noqa: E402
+    EmbeddingCache,
+    compute_cache_keys,
+)
+
+DIM = 4
+KEY_FIELDS = {"model_name": "test-model", "instruction": "Represent this"}
+
+
+def make_embeddings(num_rows, seed=0):
+    return np.random.default_rng(seed).normal(size=(num_rows, DIM)).astype(np.float32)
+
+
+def test_lookup_returns_inserted_embeddings(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), num_shards=4)
+    keys = compute_cache_keys([f"text {i}" for i in range(20)], KEY_FIELDS)
+    embeddings = make_embeddings(20)
+
+    assert cache.insert(keys[:12], embeddings[:12]) == 12
+    # Inserting again only adds the missing entries
+    assert cache.insert(keys, embeddings) == 8
+    assert len(list((tmp_path / f"dim_{DIM}").glob("*.h5"))) == 4
+
+    queries = np.concatenate(
+        [keys[::-1], compute_cache_keys(["missing"], KEY_FIELDS), keys[:2]]
+    )
+    positions, found = cache.lookup(queries, DIM)
+
+    assert sorted(positions) == [i for i in range(len(queries)) if i != 20]
+    expected = np.concatenate([embeddings[::-1], np.zeros((1, DIM)), embeddings[:2]])
+    np.testing.assert_array_equal(found, expected[positions])
+    assert found.dtype == np.float32
+
+
+def test_keys_depend_on_key_fields(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.insert(compute_cache_keys(["text"], KEY_FIELDS), make_embeddings(1))
+
+    other_keys = compute_cache_keys(["text"], {**KEY_FIELDS, "instruction": "Other"})
+    positions, _ = cache.lookup(other_keys, DIM)
+    assert len(positions) == 0
+    positions, _ = cache.lookup(compute_cache_keys(["text"], KEY_FIELDS), DIM + 1)
+    assert len(positions) == 0
+
+
+def test_insert_drops_duplicates_within_a_batch(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), num_shards=1)
+    keys = compute_cache_keys(["a", "b", "a"], KEY_FIELDS)
+
+    assert cache.insert(keys, make_embeddings(3)) == 2
+    positions, _ = cache.lookup(keys, DIM)
+    assert sorted(positions) == [0, 1, 2]
+
+
+class Clock:
+    """Stand-in for time.time that advances one second per call."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+def test_evicts_least_recently_used_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "time", Clock())
+    cache = EmbeddingCache(str(tmp_path), num_shards=1)
+    first_keys = compute_cache_keys([f"first {i}" for i in range(10)], KEY_FIELDS)
+    second_keys = compute_cache_keys([f"second {i}" for i in range(10)], KEY_FIELDS)
+    cache.insert(first_keys, make_embeddings(10))
+    cache.insert(second_keys, make_embeddings(10, seed=1))
+
+    # Inserting cached keys again, as every run does for its cache hits, marks
+    # them as recently used
+    assert cache.insert(first_keys, make_embeddings(10)) == 0
+
+    # Room for a bit more than half of the entries of the shard
+    cache.max_size_bytes = int(0.51 * cache.size_bytes())
+    cache.evict()
+
+    assert len(cache.lookup(second_keys, DIM)[0]) == 0
+    positions, found = cache.lookup(first_keys, DIM)
+    assert sorted(positions) == list(range(10))
+    np.testing.assert_array_equal(found, make_embeddings(10)[positions])
+
+
+def test_evicts_entries_across_shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "time", Clock())
+    cache = EmbeddingCache(str(tmp_path), num_shards=4)
+    keys = compute_cache_keys([f"text {i}" for i in range(40)], KEY_FIELDS)
+    for start in range(0, 40, 10):
+        cache.insert(keys[start : start + 10], make_embeddings(10, seed=start))
+
+    cache.max_size_bytes = int(0.8 * cache.size_bytes())
+    cache.evict()
+
+    # Only the oldest entries are gone, whichever shards they were in
+    positions, _ = cache.lookup(keys, DIM)
+    evicted = sorted(set(range(40)) - set(positions.tolist()))
+    assert 0 < len(evicted) < 40
+    assert max(evicted) // 10 <= min(positions) // 10
+
+
+def test_lookup_leaves_cache_files_unchanged(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), num_shards=1)
+    keys = compute_cache_keys(["a", "b"], KEY_FIELDS)
+    cache.insert(keys, make_embeddings(2))
+    path = cache._shard_path(DIM, 0)
+    mtime = os.stat(path).st_mtime_ns
+
+    cache.lookup(keys, DIM)
+
+    assert os.stat(path).st_mtime_ns == mtime
+
+
+def test_insert_keeps_cache_within_size_bound(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_size_gb=1e-12, num_shards=1)
+    cache.insert(compute_cache_keys(["a"], KEY_FIELDS), make_embeddings(1))
+
+    assert cache.size_bytes() == 0
@@ -0,0 +1,106 @@
+"""
+Test the reduced-dimension embeddings of subset selection.
+
+Truncation, seeded random projections and fitted PCA projections must give
+embeddings of the requested shape, the same ones on every load.
+"""
+
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.encoders.arctic_encoder import (  # noqa: E402
+    ArcticEmbedEncoder,
+)
+from scripts.subset_selection.utils.embedding_projection import (  # noqa: E402
+    fit_pca_projection,
+    load_projection,
+    save_projection,
+)
+from tests.test_distributed import MODEL_NAME, WORDS, write_model  # noqa: E402
+
+HIDDEN_SIZE = 32
+
+
+def make_embeddings(num_rows=50):
+    embeddings = np.random.default_rng(0).normal(size=(num_rows, HIDDEN_SIZE))
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def test_truncation_keeps_leading_dimensions():
+    assert load_projection("truncate", HIDDEN_SIZE, None) == (
+        HIDDEN_SIZE,
+        None,
+        None,
+        "truncate",
+    )
+    output_dim, matrix, _, _ = load_projection("truncate", HIDDEN_SIZE, 8)
+    assert output_dim == 8
+    assert matrix is None
+
+
+def test_random_projection_is_seeded():
+    output_dim, matrix, mean, projection_id = load_projection("random", HIDDEN_SIZE, 8)
+
+    assert output_dim == 8
+    assert matrix.shape == (HIDDEN_SIZE, 8)
+    assert matrix.dtype == np.float32
+    assert mean is None
+    _, again, _, again_id = load_projection("random", HIDDEN_SIZE, 8)
+    np.testing.assert_array_equal(matrix, again)
+    assert projection_id == again_id
+
+    with pytest.raises(ValueError):
+        load_projection("random", HIDDEN_SIZE, None)
+
+
+def test_fitted_projection_round_trip(tmp_path):
+    components, mean = fit_pca_projection(make_embeddings(), 6)
+    assert components.shape == (HIDDEN_SIZE, 6)
+    path = str(tmp_path / "pca.npz")
+    save_projection(path, components, mean)
+
+    # The output dimension is inferred from the fitted components
+    output_dim, matrix, loaded_mean, projection_id = load_projection(
+        path, HIDDEN_SIZE, None
+    )
+    assert output_dim == 6
+    np.testing.assert_array_equal(matrix, components)
+    np.testing.assert_array_equal(loaded_mean, mean)
+    assert load_projection(path, HIDDEN_SIZE, 6)[3] == projection_id
+
+    # Other components are another projection for the embedding cache
+    save_projection(path, components[:, ::-1], mean)
+    assert load_projection(path, HIDDEN_SIZE, None)[3] != projection_id
+
+    with pytest.raises(ValueError):
+        load_projection(path, HIDDEN_SIZE, 4)
+    with pytest.raises(ValueError):
+        load_projection(path, 2 * HIDDEN_SIZE, None)
+
+
+@pytest.mark.parametrize("projection", ["truncate", "random"])
+def test_encoder_returns_reduced_normalized_embeddings(tmp_path, monkeypatch, projection):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    write_model(tmp_path)
+    texts = [" ".join(WORDS[: i + 1]) for i in range(5)]
+
+    def encode():
+        encoder = ArcticEmbedEncoder(
+            MODEL_NAME, device=torch.device("cpu"), output_dim=8, projection=projection
+        )
+        assert encoder.embedding_dim == 8
+        return encoder.encode(texts, show_progress=False).numpy()
+
+    embeddings = encode()
+
+    assert embeddings.shape == (len(texts), 8)
+    np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0, rtol=1e-5)
+    np.testing.assert_allclose(encode(), embeddings, atol=1e-6)
@@ -0,0 +1,117 @@
+"""
+Test the reduced-precision embedding storage of subset selection.
+
+Embeddings stored in float16, bfloat16 or int8 must come back within the
+rounding error of their precision, and must not share cache entries with
+exact float32 embeddings.
+"""
+
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+h5py = pytest.importorskip("h5py")
+pytest.importorskip("datasets")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.subset_selection import _cache_key_fields  # noqa: E402
+from scripts.subset_selection.utils.embedding_storage import (  # noqa: E402
+    STORAGE_PRECISIONS,
+    StoredEmbeddings,
+    dequantize_embeddings,
+    quantize_embeddings,
+    storage_dtype,
+)
+
+# Half the spacing of representable values, relative to the magnitude
+RELATIVE_ERRORS = {"float32": 0.0, "float16": 2.0**-11, "bfloat16": 2.0**-8}
+
+
+def make_embeddings():
+    """Normalized random embeddings, as the encoders return them."""
+    embeddings = np.random.default_rng(0).normal(size=(64, 32)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "bfloat16"])
+def test_float_round_trip_error(precision):
+    embeddings = make_embeddings()
+    data, scales = quantize_embeddings(embeddings, precision)
+
+    assert data.dtype == storage_dtype(precision)
+    assert scales is None
+    restored = dequantize_embeddings(data, precision)
+    assert restored.dtype == np.float32
+    # Small float16 values are subnormal and carry an absolute error instead
+    bound = RELATIVE_ERRORS[precision] * np.abs(embeddings) + 1e-7
+    assert np.all(np.abs(restored - embeddings) <= bound)
+
+
+def test_bfloat16_rounds_like_torch():
+    embeddings = make_embeddings()
+    data, _ = quantize_embeddings(embeddings, "bfloat16")
+
+    expected = torch.from_numpy(embeddings).to(torch.bfloat16).float().numpy()
+    np.testing.assert_array_equal(dequantize_embeddings(data, "bfloat16"), expected)
+
+
+def test_int8_round_trip_error():
+    embeddings = make_embeddings()
+    embeddings[3] = 0.0
+    data, scales = quantize_embeddings(embeddings, "int8")
+
+    assert data.dtype == np.int8
+    np.testing.assert_allclose(scales[:3], np.abs(embeddings[:3]).max(axis=1) / 127)
+    restored = dequantize_embeddings(data, "int8", scales)
+    # Every value is rounded to the nearest multiple of its row's scale
+    assert np.all(np.abs(restored - embeddings) <= scales[:, None] / 2 + 1e-7)
+    np.testing.assert_array_equal(restored[3], 0.0)
+
+    with pytest.raises(ValueError):
+        dequantize_embeddings(data, "int8")
+
+
+@pytest.mark.parametrize("precision", STORAGE_PRECISIONS)
+def test_stored_embeddings_read_back_from_file(precision, tmp_path):
+    embeddings = make_embeddings()
+    data, scales = quantize_embeddings(embeddings, precision)
+    with h5py.File(tmp_path / "embeddings.h5", "w") as f:
+        f.create_dataset("embeddings", data=data)
+        f["embeddings"].attrs["precision"] = precision
+        if scales is not None:
+            f.create_dataset("scales", data=scales)
+
+    rows = np.array([5, 1, 9])
+    with h5py.File(tmp_path / "embeddings.h5", "r") as f:
+        stored = StoredEmbeddings.from_h5(f, rows)
+
+    assert stored.precision == precision
+    expected = dequantize_embeddings(data, precision, scales)[rows]
+    np.testing.assert_array_equal(stored.dequantize(), expected)
+    np.testing.assert_array_equal(stored[np.array([2, 0])].numpy(), expected[[2, 0]])
+
+
+def test_unknown_precision_is_rejected():
+    with pytest.raises(ValueError):
+        quantize_embeddings(make_embeddings(), "float8")
+
+
+def test_reduced_precisions_have_own_cache_keys():
+    encoder = SimpleNamespace(cache_key_fields={"model_name": "test-model"})
+    key_fields = {
+        precision: _cache_key_fields(encoder, "Represent this", precision)
+        for precision in STORAGE_PRECISIONS
+    }
+
+    assert key_fields["float32"] == {
+        "model_name": "test-model",
+        "instruction": "Represent this",
+    }
+    assert len({str(sorted(fields.items())) for fields in key_fields.values()}) == len(
+        STORAGE_PRECISIONS
+    )
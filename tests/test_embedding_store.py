@@ -0,0 +1,272 @@
+"""
+Test the embeddings stores of subset selection.
+
+Covers the files that incremental runs append to: stores split out of an
+encoded bundle of small files, and the remapping of dataset rows onto an
+append-only store; and the copied or virtual merge of per-device shards.
+"""
+
+from pathlib import Path
+import json
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+pytest.importorskip("torch")
+datasets = pytest.importorskip("datasets")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection import subset_selection  # noqa: E402
+from scripts.subset_selection.subset_selection import (  # noqa: E402
+    BasicConfig,
+    DataProcessor,
+    EncoderConfig,
+    ProcessingConfig,
+    SystemConfig,
+    TemplateConfig,
+    _append_embedding_file,
+    _compute_row_fingerprints,
+    _create_row_index,
+    _merge_shard_files,
+    _write_embedding_rows,
+)
+from scripts.subset_selection.utils.embedding_cache import (  # noqa: E402
+    compute_cache_keys,
+    keys_from_uint8,
+    keys_to_uint8,
+)
+from scripts.subset_selection.utils.embedding_storage import (  # noqa: E402
+    quantize_embeddings,
+)
+
+DIM = 8
+
+
+def write_embeddings_file(path, texts, precision="float32"):
+    """Write a merged embeddings file whose embeddings are derived from the texts."""
+    keys = compute_cache_keys(texts, {})
+    embeddings = text_embeddings(texts)
+    with h5py.File(path, "w") as f:
+        f.create_dataset("embeddings", data=embeddings, maxshape=(None, DIM))
+        f["embeddings"].attrs["precision"] = precision
+        f.create_dataset("keys", data=keys_to_uint8(keys), maxshape=(None, 32))
+    return embeddings
+
+
+def text_embeddings(texts):
+    """Deterministic embedding of every text."""
+    return np.stack(
+        [
+            np.random.default_rng(zlib.crc32(text.encode())).normal(size=DIM)
+            for text in texts
+        ]
+    ).astype(np.float32)
+
+
+def test_store_split_from_bundle_accepts_appends(tmp_path):
+    texts = [f"text {i}" for i in range(10)]
+    bundle_path = tmp_path / "bundle.h5"
+    embeddings = write_embeddings_file(bundle_path, texts)
+
+    store_path = str(tmp_path / "store.h5")
+    fingerprints = compute_cache_keys(texts[3:8], {"row": True})
+    with h5py.File(bundle_path, "r") as src:
+        _write_embedding_rows(src, store_path, 3, 8, fingerprints)
+
+    delta_texts = ["new 0", "new 1"]
+    delta_path = tmp_path / "delta.h5"
+    delta_embeddings = write_embeddings_file(delta_path, delta_texts)
+    delta_fingerprints = compute_cache_keys(delta_texts, {"row": True})
+
+    start = _append_embedding_file(store_path, str(delta_path), delta_fingerprints)
+
+    assert start == 5
+    with h5py.File(store_path, "r") as f:
+        np.testing.assert_array_equal(
+            f["embeddings"][:], np.concatenate([embeddings[3:8], delta_embeddings])
+        )
+        assert f["embeddings"].attrs["precision"] == "float32"
+        assert list(keys_from_uint8(f["keys"][:])) == list(
+            compute_cache_keys(texts[3:8] + delta_texts, {})
+        )
+        assert list(keys_from_uint8(f["row_fingerprints"][:])) == list(
+            np.concatenate([fingerprints, delta_fingerprints])
+        )
+
+
+def test_append_rejects_other_precision(tmp_path):
+    store_path = str(tmp_path / "store.h5")
+    bundle_path = tmp_path / "bundle.h5"
+    write_embeddings_file(bundle_path, ["a", "b"])
+    with h5py.File(bundle_path, "r") as src:
+        _write_embedding_rows(src, store_path, 0, 2, compute_cache_keys(["a", "b"], {}))
+
+    delta_path = tmp_path / "delta.h5"
+    with h5py.File(delta_path, "w") as f:
+        f.create_dataset("embeddings", data=np.zeros((1, DIM), dtype=np.float16))
+        f.create_dataset("keys", data=keys_to_uint8(compute_cache_keys(["c"], {})))
+
+    with pytest.raises(ValueError):
+        _append_embedding_file(store_path, str(delta_path), compute_cache_keys(["c"], {}))
+
+
+def write_shard_files(output_dir):
+    """Write int8 shard files the way encoder workers lay them out."""
+    shard_files = []
+    for shard_id, texts in enumerate([["a", "b", "c"], ["d"], ["e", "f"]]):
+        shard_dir = output_dir / f"shard_{shard_id}"
+        shard_dir.mkdir(parents=True)
+        data, scales = quantize_embeddings(text_embeddings(texts), "int8")
+        path = shard_dir / f"embeddings_shard_{shard_id}.h5"
+        with h5py.File(path, "w") as f:
+            f.create_dataset("embeddings", data=data)
+            f["embeddings"].attrs["precision"] = "int8"
+            f.create_dataset("scales", data=scales)
+            f.create_dataset("keys", data=keys_to_uint8(compute_cache_keys(texts, {})))
+        shard_files.append(str(path))
+    return shard_files
+
+
+def read_store(path):
+    with h5py.File(path, "r") as f:
+        return {name: (f[name][:], dict(f[name].attrs)) for name in f}
+
+
+def test_virtual_merge_reads_back_like_copied_merge(tmp_path):
+    copied_dir, virtual_dir = tmp_path / "copied", tmp_path / "virtual"
+    _merge_shard_files(write_shard_files(copied_dir), str(copied_dir / "embeddings.h5"))
+    virtual_shards = write_shard_files(virtual_dir)
+    _merge_shard_files(virtual_shards, str(virtual_dir / "embeddings.h5"), virtual=True)
+
+    # Copied shards are removed, virtually merged ones are still referenced
+    assert not list(copied_dir.glob("shard_*/*.h5"))
+    assert all(os.path.exists(path) for path in virtual_shards)
+    copied = read_store(copied_dir / "embeddings.h5")
+    assert set(copied) == {"embeddings", "scales", "keys"}
+    assert copied["embeddings"][0].shape == (6, DIM)
+
+    # The shards are referenced relative to the merged file, so both can be moved
+    moved_dir = tmp_path / "moved"
+    os.rename(virtual_dir, moved_dir)
+    virtual = read_store(moved_dir / "embeddings.h5")
+    assert set(virtual) == set(copied)
+    for name, (data, attrs) in copied.items():
+        np.testing.assert_array_equal(virtual[name][0], data)
+        assert virtual[name][1] == attrs
+
+
+def make_processor(tmp_path, encoded, **basic_settings):
+    """Data processor whose encoder embeds texts with ``text_embeddings``."""
+    config = ProcessingConfig(
+        input_files=[str(tmp_path / "data.jsonl")],
+        subset_sizes=[0.5],
+        basic=BasicConfig(output_dir=str(tmp_path), incremental=True, **basic_settings),
+        encoder=EncoderConfig(),
+        template=TemplateConfig(template_name="default"),
+        system=SystemConfig(cpu_mode=True),
+    )
+    processor = DataProcessor(config)
+
+    def encode_dataset(dataset, output_dir, merged_path, virtual_merge=False):
+        os.makedirs(output_dir, exist_ok=True)
+        encoded.extend(dataset["text"])
+        write_embeddings_file(merged_path, dataset["text"])
+
+    processor._encode_dataset = encode_dataset
+    return processor
+
+
+def make_dataset(texts):
+    dataset = datasets.Dataset.from_dict({"text": texts})
+    return dataset, _compute_row_fingerprints(dataset, [("data.jsonl", len(texts))])
+
+
+def test_update_appends_new_rows_and_remaps_current_rows(tmp_path):
+    texts = [f"text {i}" for i in range(5)]
+    store_path = str(tmp_path / "embeddings.h5")
+    write_embeddings_file(store_path, texts)
+    with h5py.File(store_path, "a") as f:
+        _create_row_index(f, make_dataset(texts)[1], np.arange(len(texts)))
+
+    # Rows were removed, reordered and inserted since the store was written
+    new_texts = ["text 3", "new 0", "text 0", "text 2", "new 1"]
+    dataset, fingerprints = make_dataset(new_texts)
+    encoded = []
+    processor = make_processor(tmp_path, encoded)
+
+    assert processor._update_embedding_store(
+        dataset, str(tmp_path), store_path, fingerprints
+    ) == store_path
+    assert encoded == ["new 0", "new 1"]
+    assert not (tmp_path / "delta").exists()
+    with h5py.File(store_path, "r") as f:
+        current_rows = f["current_rows"][:]
+        np.testing.assert_array_equal(current_rows, [3, 5, 0, 2, 6])
+        np.testing.assert_array_equal(
+            f["embeddings"][:][current_rows], text_embeddings(new_texts)
+        )
+        assert f["row_fingerprints"].shape[0] == 7
+
+    # An unchanged dataset reuses every stored row
+    encoded.clear()
+    processor._update_embedding_store(dataset, str(tmp_path), store_path, fingerprints)
+    assert encoded == []
+    with h5py.File(store_path, "r") as f:
+        np.testing.assert_array_equal(f["current_rows"][:], current_rows)
+        assert f["embeddings"].shape[0] == 7
+
+
+def test_bundled_files_are_loaded_and_fingerprinted_once(tmp_path, monkeypatch):
+    input_files = []
+    for name in ["part0", "part1", "part2"]:
+        path = tmp_path / f"{name}.jsonl"
+        with open(path, "w", encoding="utf-8") as f:
+            for i in range(6):
+                f.write(json.dumps({"text": f"{name} text {i}"}) + "\n")
+        input_files.append(str(path))
+    encoded = []
+    processor = make_processor(
+        tmp_path, encoded, num_folds=1, optimizer_backend="torch"
+    )
+
+    loaded = []
+    load_and_combine_datasets = processor.load_and_combine_datasets
+
+    def counting_load(files):
+        loaded.extend(files)
+        return load_and_combine_datasets(files)
+
+    processor.load_and_combine_datasets = counting_load
+    fingerprinted = []
+    compute_row_fingerprints = _compute_row_fingerprints
+
+    def counting_fingerprints(dataset, sources):
+        fingerprinted.extend(source for source, _ in sources)
+        return compute_row_fingerprints(dataset, sources)
+
+    monkeypatch.setattr(
+        subset_selection, "_compute_row_fingerprints", counting_fingerprints
+    )
+
+    processor.process_files(input_files, str(tmp_path / "output"))
+
+    # All three files were encoded as one bundle
+    assert len(encoded) == 18
+    assert loaded == input_files
+    assert fingerprinted == input_files
+    for input_file in input_files:
+        name = Path(input_file).stem
+        with h5py.File(tmp_path / "output" / name / "embeddings" / "embeddings.h5") as f:
+            np.testing.assert_array_equal(
+                f["row_fingerprints"][:],
+                keys_to_uint8(
+                    compute_row_fingerprints(
+                        datasets.Dataset.from_json(input_file), [(input_file, 6)]
+                    )
+                ),
+            )
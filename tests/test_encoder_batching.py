@@ -0,0 +1,232 @@
+"""
+Test how the Arctic encoder of subset selection batches its inputs.
+
+Inputs are grouped into length-sorted forward batches, and their embeddings
+come back in input order. The tiny model of the distributed test stands in
+for the Arctic encoder.
+"""
+
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.encoders.arctic_encoder import (  # noqa: E402
+    OOM_RECOVERY_STEPS,
+    ArcticEmbedEncoder,
+    is_out_of_memory_error,
+)
+from scripts.subset_selection.utils.token_lengths import (  # noqa: E402
+    make_batches,
+    truncate_token_ids,
+)
+from tests.test_distributed import MODEL_NAME, WORDS, write_model  # noqa: E402
+
+LENGTHS = [5, 17, 3, 17, 9, 1, 12, 8, 30, 2]
+TEXTS = [" ".join(WORDS[: 1 + i % len(WORDS)]) for i in (4, 11, 0, 7, 2, 9, 5, 1)]
+
+
+@pytest.fixture
+def encoder(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    write_model(tmp_path)
+
+    def make_encoder(**kwargs):
+        return ArcticEmbedEncoder(MODEL_NAME, device=torch.device("cpu"), **kwargs)
+
+    return make_encoder
+
+
+def test_batches_are_sorted_by_descending_length():
+    batches = make_batches(LENGTHS, batch_size=3)
+
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+    order = np.concatenate(batches)
+    assert sorted(order) == list(range(len(LENGTHS)))
+    assert list(np.asarray(LENGTHS)[order]) == sorted(LENGTHS, reverse=True)
+
+
+def test_unsorted_batches_keep_input_order():
+    batches = make_batches(LENGTHS, batch_size=4, sort_by_length=False)
+
+    assert [list(batch) for batch in batches] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+@pytest.mark.parametrize("budget", [1, 16, 40, 100])
+def test_token_budget_bounds_padded_batches(budget):
+    batches = make_batches(LENGTHS, batch_size=3, max_tokens_per_batch=budget)
+
+    order = np.concatenate(batches)
+    assert sorted(order) == list(range(len(LENGTHS)))
+    for batch in batches:
+        padded = max(LENGTHS[i] for i in batch) * len(batch)
+        # A sequence longer than the budget gets a batch of its own
+        assert padded <= budget or len(batch) == 1
+    # Batches are only split where the next sequence would exceed the budget
+    for batch in batches[:-1]:
+        padded = max(LENGTHS[i] for i in batch) * (len(batch) + 1)
+        assert padded > budget
+
+
+def test_token_budget_ignores_batch_size():
+    batches = make_batches([4] * 10, batch_size=2, max_tokens_per_batch=20)
+
+    assert [len(batch) for batch in batches] == [5, 5]
+
+
+def test_encoder_batches_fit_token_budget(encoder):
+    budgeted = encoder(max_tokens_per_batch=24)
+
+    prepared = budgeted.prepare_batches(TEXTS)
+
+    assert len(prepared) > 1
+    for positions, batch in prepared:
+        assert batch["input_ids"].numel() <= 24 or len(positions) == 1
+
+
+@pytest.mark.parametrize("sort_by_length", [True, False])
+def test_embeddings_come_back_in_input_order(encoder, sort_by_length):
+    batched = encoder(sort_by_length=sort_by_length)
+    batched.cfg.batch_size = 3
+
+    prepared = batched.prepare_batches(TEXTS)
+    positions = np.concatenate([batch_positions for batch_positions, _ in prepared])
+    assert len(prepared) == 3
+    assert sorted(positions) == list(range(len(TEXTS)))
+    assert (list(positions) != list(range(len(TEXTS)))) == sort_by_length
+
+    # Each text on its own, without any padding
+    single = np.stack(
+        [batched.encode([text], show_progress=False)[0].numpy() for text in TEXTS]
+    )
+    np.testing.assert_allclose(
+        batched.encode_prepared(prepared, show_progress=False).numpy(), single, atol=1e-5
+    )
+
+
+@pytest.mark.parametrize(
+    "truncation, expected",
+    [
+        ("head", [0, 1, 2, 3, 4, 5]),
+        ("tail", [0, 1, 6, 7, 8, 9]),
+        # The budget left after the prefix is split, rounding towards the head
+        ("head+tail", [0, 1, 2, 3, 8, 9]),
+    ],
+)
+def test_truncation_keeps_prefix_and_policy_tokens(truncation, expected):
+    ids = list(range(10))
+
+    assert truncate_token_ids(ids, 6, num_prefix_tokens=2, truncation=truncation) == expected
+    # Inputs within the budget are kept whole
+    assert truncate_token_ids(ids, 10, 2, truncation) == ids
+    # A prefix filling the budget leaves no room for the text
+    assert truncate_token_ids(ids, 2, 2, truncation) == [0, 1]
+
+
+def test_encoder_truncates_to_max_length(encoder):
+    text = " ".join(WORDS)
+    tokens = {}
+    for truncation in ["head", "tail", "head+tail"]:
+        truncated = encoder(max_length=8, truncation=truncation)
+        [(_, batch)] = truncated.prepare_batches([text], instruction="Represent")
+        # Without the leading and trailing special tokens
+        tokens[truncation] = batch["input_ids"][0, 1:-1].tolist()
+
+    full = truncated.tokenizer(f"Represent: {text}", add_special_tokens=False)["input_ids"]
+    prefix = full[: truncated._prefix_lengths["Represent"]]
+    text_budget = 6 - len(prefix)
+    assert text_budget > 1
+    # Every policy keeps the instruction ahead of the text tokens
+    assert tokens["head"] == full[:6]
+    assert tokens["tail"] == prefix + full[-text_budget:]
+    head = (text_budget + 1) // 2
+    assert tokens["head+tail"] == (
+        full[: len(prefix) + head] + full[-(text_budget - head) :]
+    )
+
+
+class MemoryLimit:
+    """Stand-in for a forward call that runs out of memory beyond a token limit."""
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.calls = []
+
+    def __call__(self, batch):
+        rows, seq_len = batch["input_ids"].shape
+        self.calls.append(rows)
+        if rows * seq_len > self.max_tokens:
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory. Tried to allocate")
+        return batch["input_ids"][:, :1].float()
+
+
+def make_batch(num_rows, seq_len=4):
+    return {
+        "input_ids": torch.arange(num_rows).repeat_interleave(seq_len).view(num_rows, -1),
+        "attention_mask": torch.ones(num_rows, seq_len, dtype=torch.long),
+    }
+
+
+def test_out_of_memory_errors_are_recognized():
+    assert is_out_of_memory_error(torch.cuda.OutOfMemoryError("CUDA out of memory"))
+    assert is_out_of_memory_error(MemoryError())
+    assert is_out_of_memory_error(RuntimeError("DefaultCPUAllocator: can't allocate memory"))
+    assert not is_out_of_memory_error(RuntimeError("shape mismatch"))
+
+
+def test_out_of_memory_splits_batch_and_keeps_order(encoder):
+    adaptive = encoder()
+    adaptive._embed_batch = MemoryLimit(max_tokens=12)
+
+    embeddings = adaptive._embed_batch_adaptive(make_batch(8))
+
+    np.testing.assert_array_equal(embeddings.view(-1).numpy(), np.arange(8))
+    # 32 and 16 tokens fail, after which 2 rows (8 tokens) fit every call
+    assert adaptive._embed_batch.calls == [8, 4, 2, 2, 2, 2]
+    assert adaptive._token_limit == 8
+
+
+def test_token_limit_recovers_after_successful_calls(encoder):
+    adaptive = encoder()
+    adaptive._embed_batch = MemoryLimit(max_tokens=12)
+    adaptive._embed_batch_adaptive(make_batch(8))
+    calls = len(adaptive._embed_batch.calls)
+
+    # The limit doubles after OOM_RECOVERY_STEPS successful calls in a row
+    adaptive._embed_batch.max_tokens = 1000
+    for _ in range(OOM_RECOVERY_STEPS - 4):
+        adaptive._embed_batch_adaptive(make_batch(2))
+    assert adaptive._token_limit == 16
+    adaptive._embed_batch_adaptive(make_batch(8))
+    assert adaptive._embed_batch.calls[-2:] == [4, 4]
+    assert len(adaptive._embed_batch.calls) == calls + OOM_RECOVERY_STEPS - 4 + 2
+
+
+def test_out_of_memory_on_a_single_row_is_raised(encoder):
+    adaptive = encoder()
+    adaptive._embed_batch = MemoryLimit(max_tokens=2)
+
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        adaptive._embed_batch_adaptive(make_batch(4))
+    assert adaptive._embed_batch.calls == [4, 2, 1]
+
+
+def test_other_errors_are_not_retried(encoder):
+    adaptive = encoder()
+    calls = []
+
+    def broken(batch):
+        calls.append(len(batch["input_ids"]))
+        raise RuntimeError("shape mismatch")
+
+    adaptive._embed_batch = broken
+    with pytest.raises(RuntimeError, match="shape mismatch"):
+        adaptive._embed_batch_adaptive(make_batch(4))
+    assert calls == [4]
+    assert adaptive._token_limit is None
@@ -0,0 +1,264 @@
+"""
+Test the torch facility location maximizer of subset selection.
+
+The maximizer replaces submodlib's on the GPU. Its greedy choices are checked
+against a plain numpy greedy on small dense, sparse and embedding kernels, and
+against submodlib itself where it is installed.
+"""
+
+from pathlib import Path
+import re
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+scipy_sparse = pytest.importorskip("scipy.sparse")
+
+try:
+    import submodlib
+except ImportError:
+    submodlib = None
+
+requires_submodlib = pytest.mark.skipif(
+    submodlib is None, reason="submodlib is not installed"
+)
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.utils.facility_location import (  # noqa: E402
+    DenseKernel,
+    EmbeddingKernel,
+    SparseKernel,
+    maximize_facility_location,
+    stochastic_sample_size,
+    symmetrize_knn_graph,
+)
+
+NUM_ROWS = 300
+BUDGET = 20
+NUM_NEIGHBORS = 15
+
+
+def make_vectors() -> np.ndarray:
+    """Random clustered vectors."""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(8, 16))
+    vectors = centers[rng.integers(0, 8, NUM_ROWS)] + 0.5 * rng.normal(size=(NUM_ROWS, 16))
+    return vectors.astype(np.float32)
+
+
+def make_weights() -> np.ndarray:
+    return np.random.default_rng(1).integers(1, 5, NUM_ROWS).astype(np.float32)
+
+
+def make_similarities(weighted: bool = False) -> np.ndarray:
+    """Cosine similarities of the vectors, scaled to [0, 1]."""
+    vectors = make_vectors()
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    sijs = ((vectors @ vectors.T + 1) / 2).astype(np.float32)
+    if weighted:
+        sijs *= make_weights()[:, None]
+    return sijs
+
+
+def make_knn_graph(sijs: np.ndarray):
+    """Keep the NUM_NEIGHBORS largest similarities of every row."""
+    columns = np.argsort(-sijs, axis=1)[:, :NUM_NEIGHBORS]
+    rows = np.repeat(np.arange(NUM_ROWS), NUM_NEIGHBORS)
+    values = np.take_along_axis(sijs, columns, axis=1).reshape(-1)
+    return scipy_sparse.csr_matrix(
+        (values, (rows, columns.reshape(-1))), shape=(NUM_ROWS, NUM_ROWS)
+    )
+
+
+def submodlib_greedy(optimizer: str, epsilon: float = 0.1, **kernel_kwargs):
+    function = submodlib.FacilityLocationFunction(
+        n=NUM_ROWS, separate_rep=False, **kernel_kwargs
+    )
+    return function.maximize(
+        budget=BUDGET,
+        optimizer=optimizer,
+        epsilon=epsilon,
+        stopIfZeroGain=False,
+        stopIfNegativeGain=False,
+        verbose=False,
+    )
+
+
+def reference_greedy(sijs: np.ndarray):
+    """Naive facility location greedy on a dense similarity matrix."""
+    coverage = np.zeros(len(sijs))
+    selection = []
+    for _ in range(BUDGET):
+        gains = np.maximum(sijs, coverage[:, None]).sum(axis=0) - coverage.sum()
+        gains[[idx for idx, _ in selection]] = -np.inf
+        best = int(np.argmax(gains))
+        selection.append((best, gains[best]))
+        coverage = np.maximum(coverage, sijs[:, best])
+    return selection
+
+
+def assert_same_selection(result, expected):
+    assert [idx for idx, _ in result] == [idx for idx, _ in expected]
+    np.testing.assert_allclose(
+        [gain for _, gain in result], [gain for _, gain in expected], rtol=1e-4
+    )
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_dense_naive_greedy_matches_reference(weighted):
+    sijs = make_similarities(weighted)
+    result = maximize_facility_location(
+        DenseKernel(torch.from_numpy(sijs)), BUDGET, optimizer="NaiveGreedy"
+    )
+    assert_same_selection(result, reference_greedy(sijs))
+
+
+def test_sparse_naive_greedy_matches_reference():
+    graph = make_knn_graph(make_similarities())
+    result = maximize_facility_location(
+        SparseKernel.from_scipy(graph), BUDGET, optimizer="NaiveGreedy"
+    )
+    assert_same_selection(result, reference_greedy(symmetrize_knn_graph(graph).toarray()))
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_embedding_naive_greedy_matches_reference(weighted):
+    weights = torch.from_numpy(make_weights()) if weighted else None
+    kernel = EmbeddingKernel(torch.from_numpy(make_vectors()), weights)
+    result = maximize_facility_location(kernel, BUDGET, optimizer="NaiveGreedy")
+    assert_same_selection(result, reference_greedy(make_similarities(weighted)))
+
+
+def test_stochastic_greedy_is_seeded():
+    kernel = DenseKernel(torch.from_numpy(make_similarities()))
+    result = maximize_facility_location(kernel, BUDGET, epsilon=0.1, seed=3)
+
+    assert len({idx for idx, _ in result}) == BUDGET
+    assert result == maximize_facility_location(kernel, BUDGET, epsilon=0.1, seed=3)
+
+
+@requires_submodlib
+@pytest.mark.parametrize("weighted", [False, True])
+def test_dense_naive_greedy_matches_submodlib(weighted):
+    sijs = make_similarities(weighted)
+    result = maximize_facility_location(
+        DenseKernel(torch.from_numpy(sijs)), BUDGET, optimizer="NaiveGreedy"
+    )
+    expected = submodlib_greedy("NaiveGreedy", sijs=sijs, mode="dense")
+    assert_same_selection(result, expected)
+
+
+@requires_submodlib
+def test_sparse_naive_greedy_matches_submodlib():
+    graph = make_knn_graph(make_similarities())
+    result = maximize_facility_location(
+        SparseKernel.from_scipy(graph), BUDGET, optimizer="NaiveGreedy"
+    )
+    expected = submodlib_greedy(
+        "NaiveGreedy", sijs=graph, mode="sparse", num_neighbors=NUM_NEIGHBORS
+    )
+    assert_same_selection(result, expected)
+
+
+def test_weighted_sparse_greedy_weights_rows_after_symmetrizing():
+    graph = make_knn_graph(make_similarities())
+    weights = make_weights()
+    # Row i counts weights[i] times, also for entries taken from row j
+    expected_sijs = symmetrize_knn_graph(graph).toarray() * weights[:, None]
+    expected = maximize_facility_location(
+        DenseKernel(torch.from_numpy(expected_sijs)), BUDGET, optimizer="NaiveGreedy"
+    )
+
+    result = maximize_facility_location(
+        SparseKernel.from_scipy(graph, weights=weights), BUDGET, optimizer="NaiveGreedy"
+    )
+    assert_same_selection(result, expected)
+
+
+@requires_submodlib
+def test_weighted_sparse_graph_matches_submodlib():
+    graph = make_knn_graph(make_similarities())
+    weights = make_weights()
+    expected = reference_greedy(symmetrize_knn_graph(graph).toarray() * weights[:, None])
+
+    weighted_graph = symmetrize_knn_graph(graph).multiply(weights[:, None]).tocsr()
+    submodlib_result = submodlib_greedy(
+        "NaiveGreedy", sijs=weighted_graph, mode="sparse", num_neighbors=NUM_NEIGHBORS
+    )
+    assert_same_selection(submodlib_result, expected)
+
+
+@requires_submodlib
+@pytest.mark.parametrize("weighted", [False, True])
+def test_embedding_naive_greedy_matches_submodlib(weighted):
+    weights = torch.from_numpy(make_weights()) if weighted else None
+    kernel = EmbeddingKernel(torch.from_numpy(make_vectors()), weights)
+    result = maximize_facility_location(kernel, BUDGET, optimizer="NaiveGreedy")
+    expected = submodlib_greedy(
+        "NaiveGreedy", sijs=make_similarities(weighted), mode="dense"
+    )
+    assert_same_selection(result, expected)
+
+
+@requires_submodlib
+def test_stochastic_greedy_objective_close_to_submodlib():
+    sijs = make_similarities()
+    result = maximize_facility_location(
+        DenseKernel(torch.from_numpy(sijs)), BUDGET, epsilon=0.1, seed=0
+    )
+    expected = submodlib_greedy("LazierThanLazyGreedy", sijs=sijs, mode="dense")
+
+    assert len({idx for idx, _ in result}) == BUDGET
+    objective = sijs[:, [idx for idx, _ in result]].max(axis=1).sum()
+    expected_objective = sijs[:, [idx for idx, _ in expected]].max(axis=1).sum()
+    assert objective >= 0.98 * expected_objective
+
+
+@pytest.mark.parametrize(
+    "epsilon, expected", [(0.5, 10), (160.0, 160), (1.0, 1), (0.999999, 1)]
+)
+def test_stochastic_sample_size(epsilon, expected):
+    assert stochastic_sample_size(NUM_ROWS, BUDGET, epsilon) == expected
+
+
+@requires_submodlib
+@pytest.mark.parametrize("epsilon", [0.1, 0.5, 1.0, 2.0, 160.0])
+def test_stochastic_sample_size_matches_submodlib(epsilon, capfd):
+    function = submodlib.FacilityLocationFunction(
+        n=NUM_ROWS, separate_rep=False, sijs=make_similarities(), mode="dense"
+    )
+    function.maximize(
+        budget=BUDGET,
+        optimizer="LazierThanLazyGreedy",
+        epsilon=epsilon,
+        verbose=True,
+        show_progress=False,
+    )
+    output = capfd.readouterr().out
+    reported = re.search(r"Random set size = (\d+)", output)
+    assert int(reported.group(1)) == stochastic_sample_size(NUM_ROWS, BUDGET, epsilon)
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {"similarity_mode": "unknown"},
+        {"num_neighbors": 0},
+        {"optimizer_backend": "unknown"},
+        {"similarity_mode": "streaming", "optimizer_backend": "submodlib"},
+    ],
+)
+def test_subset_datasets_validates_selection_settings(settings, tmp_path):
+    from scripts.subset_selection.subset_selection import subset_datasets
+
+    with pytest.raises(ValueError):
+        subset_datasets(
+            input_files=[str(tmp_path / "data.jsonl")],
+            subset_sizes=[0.1],
+            testing_mode=True,
+            output_dir=str(tmp_path),
+            **settings,
+        )
@@ -0,0 +1,161 @@
+"""
+Test the persisted greedy orderings of subset selection.
+
+Smaller subsets reuse the orderings of an earlier run as prefixes, while other
+embeddings or selection settings optimize again.
+"""
+
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+h5py = pytest.importorskip("h5py")
+pytest.importorskip("datasets")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.subset_selection import (  # noqa: E402
+    GREEDY_ORDERINGS_FILE,
+    BasicConfig,
+    DataProcessor,
+    EncoderConfig,
+    ProcessingConfig,
+    SystemConfig,
+    TemplateConfig,
+    _embeddings_store_id,
+)
+from scripts.subset_selection.utils.embedding_cache import (  # noqa: E402
+    compute_cache_keys,
+    keys_to_uint8,
+)
+
+DIM = 8
+NUM_ROWS = 40
+
+
+def make_embeddings(seed=0):
+    embeddings = np.random.default_rng(seed).normal(size=(NUM_ROWS, DIM))
+    return torch.from_numpy(embeddings.astype(np.float32))
+
+
+def make_processor(tmp_path, subset_sizes, epsilon=160.0):
+    """Processor whose fold optimizations are counted."""
+    config = ProcessingConfig(
+        input_files=[str(tmp_path / "data.jsonl")],
+        subset_sizes=subset_sizes,
+        basic=BasicConfig(
+            output_dir=str(tmp_path),
+            num_folds=2,
+            epsilon=epsilon,
+            optimizer_backend="torch",
+        ),
+        encoder=EncoderConfig(),
+        template=TemplateConfig(),
+        system=SystemConfig(cpu_mode=True, cpu_workers=1, threads_per_worker=1),
+    )
+    processor = DataProcessor(config)
+    processor.optimized = 0
+    optimize_folds = processor._optimize_folds
+
+    def counting_optimize_folds(*args):
+        processor.optimized += 1
+        return optimize_folds(*args)
+
+    processor._optimize_folds = counting_optimize_folds
+    return processor
+
+
+def select(tmp_path, subset_sizes, store_id="store", weights=None, epsilon=160.0):
+    processor = make_processor(tmp_path, subset_sizes, epsilon)
+    subsets = processor.select_subsets(
+        "data",
+        make_embeddings(),
+        weights,
+        orderings_file=str(tmp_path / GREEDY_ORDERINGS_FILE),
+        store_id=store_id,
+    )
+    return subsets, processor.optimized
+
+
+def test_smaller_subsets_reuse_orderings(tmp_path):
+    first, optimized = select(tmp_path, [10, 0.5])
+    assert optimized == 1
+
+    second, optimized = select(tmp_path, [10, 0.25, 6])
+    assert optimized == 0
+    assert second[10] == first[10]
+    # Nested: every smaller subset is drawn from the larger one
+    assert len(second[0.25]) == 10
+    assert len(second[6]) == 6
+    assert set(second[6]) <= set(first[0.5])
+
+    # A larger size than persisted optimizes again
+    _, optimized = select(tmp_path, [0.75])
+    assert optimized == 1
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        {"store_id": "other store"},
+        {"epsilon": 0.5},
+        {"weights": torch.arange(1, NUM_ROWS + 1, dtype=torch.float32)},
+    ],
+)
+def test_changed_inputs_invalidate_orderings(tmp_path, changes):
+    select(tmp_path, [10])
+
+    _, optimized = select(tmp_path, [5], **changes)
+    assert optimized == 1
+
+
+def test_orderings_require_store_id(tmp_path):
+    processor = make_processor(tmp_path, [5])
+    with pytest.raises(ValueError):
+        processor.select_subsets(
+            "data",
+            make_embeddings(),
+            orderings_file=str(tmp_path / GREEDY_ORDERINGS_FILE),
+        )
+
+
+def write_store(path, texts, seed=0, with_keys=True):
+    with h5py.File(path, "w") as f:
+        embeddings = np.random.default_rng(seed).normal(size=(len(texts), DIM))
+        f.create_dataset("embeddings", data=embeddings.astype(np.float32))
+        if with_keys:
+            f.create_dataset("keys", data=keys_to_uint8(compute_cache_keys(texts, {})))
+
+
+def store_id(path, current_rows=None):
+    with h5py.File(path, "r") as f:
+        return _embeddings_store_id(f, str(path), current_rows)
+
+
+def test_store_id_follows_text_keys(tmp_path):
+    texts = [f"text {i}" for i in range(5)]
+    write_store(tmp_path / "a.h5", texts)
+    write_store(tmp_path / "b.h5", texts)
+    write_store(tmp_path / "c.h5", texts[::-1])
+
+    assert store_id(tmp_path / "a.h5") == store_id(tmp_path / "b.h5")
+    assert store_id(tmp_path / "a.h5") != store_id(tmp_path / "c.h5")
+    assert store_id(tmp_path / "a.h5") != store_id(
+        tmp_path / "a.h5", current_rows=np.arange(4)
+    )
+
+
+def test_store_id_without_keys_follows_file(tmp_path):
+    path = tmp_path / "a.h5"
+    write_store(path, [f"text {i}" for i in range(5)], with_keys=False)
+    first = store_id(path)
+    assert store_id(path) == first
+
+    # A rewritten file has a new modification time
+    mtime_ns = path.stat().st_mtime_ns + 10**9
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    assert store_id(path) != first
@@ -0,0 +1,78 @@
+"""
+Smoke test the ONNX Runtime encoder of subset selection on CPU.
+
+The tiny model of the distributed test is exported, optionally quantized, and
+must embed texts like the PyTorch encoder.
+"""
+
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.encoders.arctic_encoder import (  # noqa: E402
+    ArcticEmbedEncoder,
+)
+from scripts.subset_selection.encoders.onnx_encoder import (  # noqa: E402
+    ONNX_OPSET_VERSION,
+    ArcticOnnxEncoder,
+)
+from tests.test_distributed import MODEL_NAME, WORDS, write_model  # noqa: E402
+
+TEXTS = [" ".join(WORDS[i : i + 3 + i % 5]) for i in range(8)]
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    write_model(tmp_path)
+    return tmp_path
+
+
+def encode(encoder_class, max_length=32, **kwargs):
+    encoder = encoder_class(
+        MODEL_NAME, device=torch.device("cpu"), max_length=max_length, **kwargs
+    )
+    return encoder.encode(TEXTS, show_progress=False).numpy()
+
+
+def test_onnx_encoder_matches_pytorch_encoder(home):
+    expected = encode(ArcticEmbedEncoder)
+
+    np.testing.assert_allclose(encode(ArcticOnnxEncoder), expected, atol=1e-4)
+    onnx_dir = home / ".cache" / "instructlab" / "onnx" / MODEL_NAME
+    assert (onnx_dir / f"opset{ONNX_OPSET_VERSION}-len32" / "fp32" / "model.onnx").exists()
+
+    # A cached export is reused
+    np.testing.assert_allclose(encode(ArcticOnnxEncoder), expected, atol=1e-4)
+
+
+def test_onnx_export_is_cached_per_max_length(home):
+    encode(ArcticOnnxEncoder)
+    encode(ArcticOnnxEncoder, max_length=16)
+
+    onnx_dir = home / ".cache" / "instructlab" / "onnx" / MODEL_NAME
+    assert sorted(path.name for path in onnx_dir.iterdir()) == [
+        f"opset{ONNX_OPSET_VERSION}-len16",
+        f"opset{ONNX_OPSET_VERSION}-len32",
+    ]
+
+
+def test_quantized_onnx_encoder_is_cached_apart(home):
+    expected = encode(ArcticEmbedEncoder)
+
+    quantized = encode(ArcticOnnxEncoder, quantize_int8=True)
+
+    onnx_dir = home / ".cache" / "instructlab" / "onnx" / MODEL_NAME
+    assert (onnx_dir / f"opset{ONNX_OPSET_VERSION}-len32" / "int8" / "model.onnx").exists()
+    assert quantized.shape == expected.shape
+    # Normalized embeddings stay close to their full-precision counterparts
+    assert np.all(np.sum(quantized * expected, axis=1) > 0.9)
@@ -0,0 +1,192 @@
+"""
+Test resuming interrupted shard encoding in subset selection.
+
+Covers the pending row ranges of a checkpoint, the check that committed rows
+still hold the shard's texts, and that SIGTERM stops a run without retries
+while encoder pool workers can still be terminated.
+"""
+
+from pathlib import Path
+from types import SimpleNamespace
+import multiprocessing as mp
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+datasets = pytest.importorskip("datasets")
+pytest.importorskip("torch")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.encoders import ENCODER_REGISTRY  # noqa: E402
+from scripts.subset_selection.subset_selection import (  # noqa: E402
+    _committed_keys_match,
+    _EncoderWorkerPool,
+    _pending_ranges,
+    _process_dataset_shard,
+    _TerminationGuard,
+)
+from scripts.subset_selection.utils.embedding_cache import (  # noqa: E402
+    compute_cache_keys,
+    keys_to_uint8,
+)
+from scripts.subset_selection.utils.subset_selection_utils import (  # noqa: E402
+    TerminationRequested,
+    retry_on_exception,
+)
+from scripts.subset_selection.utils.template_rendering import (  # noqa: E402
+    RENDERED_TEXT_COLUMN,
+)
+
+KEY_FIELDS = {"model_name": "test-model", "instruction": "Represent this"}
+
+
+@pytest.mark.parametrize(
+    "completed, expected",
+    [
+        ([], [(0, 10)]),
+        ([(0, 10)], []),
+        ([(0, 4)], [(4, 10)]),
+        ([(2, 4), (6, 8)], [(0, 2), (4, 6), (8, 10)]),
+        ([(6, 8), (0, 3), (2, 5)], [(5, 6), (8, 10)]),
+    ],
+)
+def test_pending_ranges(completed, expected):
+    assert _pending_ranges(completed, 10) == expected
+
+
+def write_shard_file(path, texts, committed):
+    """Write a shard file whose committed rows hold the keys of the texts."""
+    keys = np.zeros((len(texts), 32), dtype=np.uint8)
+    for start, end in committed:
+        keys[start:end] = keys_to_uint8(compute_cache_keys(texts[start:end], KEY_FIELDS))
+    with h5py.File(path, "w") as f:
+        f.create_dataset("keys", data=keys)
+
+
+def make_shard(texts):
+    return datasets.Dataset.from_dict({RENDERED_TEXT_COLUMN: texts})
+
+
+def test_committed_keys_match_unchanged_shard(tmp_path):
+    texts = [f"text {i}" for i in range(10)]
+    committed = [(0, 4), (6, 8)]
+    write_shard_file(tmp_path / "shard.h5", texts, committed)
+
+    assert _committed_keys_match(
+        str(tmp_path / "shard.h5"), make_shard(texts), committed, KEY_FIELDS, chunk_size=3
+    )
+
+
+def test_committed_keys_match_detects_changed_rows(tmp_path):
+    texts = [f"text {i}" for i in range(10)]
+    committed = [(0, 4), (6, 8)]
+    write_shard_file(tmp_path / "shard.h5", texts, committed)
+    changed = texts[:7] + ["other text"] + texts[8:]
+
+    assert not _committed_keys_match(
+        str(tmp_path / "shard.h5"), make_shard(changed), committed, KEY_FIELDS
+    )
+    # Rows outside the committed ranges may change freely
+    uncommitted_change = texts[:5] + ["other text"] + texts[6:]
+    assert _committed_keys_match(
+        str(tmp_path / "shard.h5"), make_shard(uncommitted_change), committed, KEY_FIELDS
+    )
+
+
+class Encoding:
+    def __init__(self, error):
+        self.config = SimpleNamespace(
+            system=SimpleNamespace(max_retries=3, retry_delay=0)
+        )
+        self.error = error
+        self.attempts = 0
+
+    @retry_on_exception
+    def run(self):
+        self.attempts += 1
+        raise self.error
+
+
+def test_retry_stops_on_termination():
+    encoding = Encoding(TerminationRequested("SIGTERM"))
+    with pytest.raises(TerminationRequested):
+        encoding.run()
+    assert encoding.attempts == 1
+
+
+def test_retry_retries_runtime_errors():
+    encoding = Encoding(RuntimeError("transient"))
+    with pytest.raises(RuntimeError):
+        encoding.run()
+    assert encoding.attempts == 3
+
+
+def test_termination_guard_raises_on_sigterm():
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    with pytest.raises(TerminationRequested):
+        with _TerminationGuard(raise_on_signal=True):
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(10)
+    assert signal.getsignal(signal.SIGTERM) is previous_handler
+
+
+class SlowEncoder:
+    """Encoder that marks when it starts a batch and then takes very long."""
+
+    embedding_dim = 4
+    cache_key_fields = {"model_name": "slow"}
+
+    def __init__(self, device, started_dir):
+        self.started_dir = Path(started_dir)
+
+    def prepare_batches(self, inputs, instruction=""):
+        return [inputs]
+
+    def encode_into(self, prepared, out, offset=0, show_progress=False):
+        (self.started_dir / str(os.getpid())).touch()
+        time.sleep(60)
+
+
+@pytest.mark.skipif(
+    mp.get_start_method() != "fork", reason="workers must inherit the test encoder"
+)
+def test_terminate_stops_busy_encoder_workers(tmp_path, monkeypatch):
+    monkeypatch.setitem(ENCODER_REGISTRY, "slow", SlowEncoder)
+    started_dir = tmp_path / "started"
+    started_dir.mkdir()
+    args_list = [
+        (
+            shard_id,
+            make_shard([f"text {i}" for i in range(4)]),
+            (4 * shard_id, 4 * shard_id + 4),
+            str(tmp_path),
+            "slow",
+            {"started_dir": str(started_dir)},
+            "",
+            2,
+            1,
+            None,
+            "float32",
+            False,
+            None,
+        )
+        for shard_id in range(2)
+    ]
+
+    pool = _EncoderWorkerPool(2)
+    pool._pool.map_async(_process_dataset_shard, args_list, chunksize=1)
+    deadline = time.monotonic() + 30
+    while len(list(started_dir.iterdir())) < 2 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert len(list(started_dir.iterdir())) == 2
+
+    # Workers stop in the middle of their batch instead of finishing it
+    start = time.monotonic()
+    pool.terminate()
+    assert time.monotonic() - start < 10
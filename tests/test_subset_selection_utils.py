@@ -0,0 +1,99 @@
+"""
+Test the helpers of the subset selection encoding pipeline.
+
+Covers the background prefetching of tokenized batches and the scheduling of
+row blocks onto encoder devices.
+"""
+
+from pathlib import Path
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.utils.subset_selection_utils import (  # noqa: E402
+    assign_blocks,
+    prefetch_iterator,
+    split_row_blocks,
+)
+
+
+def producer_threads():
+    return [t for t in threading.enumerate() if t.name == "prefetch-producer"]
+
+
+@pytest.mark.parametrize("max_prefetch", [0, 1, 3])
+def test_prefetch_preserves_order(max_prefetch):
+    assert list(prefetch_iterator(iter(range(100)), max_prefetch)) == list(range(100))
+    assert not producer_threads()
+
+
+def test_prefetch_reraises_producer_errors():
+    def items():
+        yield 1
+        yield 2
+        raise KeyError("broken batch")
+
+    consumed = []
+    with pytest.raises(KeyError, match="broken batch"):
+        for item in prefetch_iterator(items(), 2):
+            consumed.append(item)
+
+    assert consumed == [1, 2]
+    assert not producer_threads()
+
+
+def test_prefetch_stops_producer_on_early_exit():
+    produced = []
+
+    def items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    iterator = prefetch_iterator(items(), 2)
+    assert next(iterator) == 0
+    iterator.close()
+
+    assert not producer_threads()
+    # The producer never runs more than the queue size ahead of the consumer
+    assert len(produced) <= 1 + 2 + 1
+
+
+def test_row_blocks_cover_rows_longest_first():
+    row_costs = np.array([1, 1, 9, 9, 5, 5, 1])
+
+    blocks, order = split_row_blocks(row_costs, 2)
+
+    assert blocks == [(0, 2), (2, 4), (4, 6), (6, 7)]
+    assert list(order) == [1, 2, 0, 3]
+    assert split_row_blocks(np.empty(0), 2)[0] == []
+
+
+@pytest.mark.parametrize("num_workers", [1, 3, 8])
+def test_assigned_blocks_are_balanced_and_complete(num_workers):
+    block_costs = np.random.default_rng(0).pareto(1.5, size=50) + 1
+
+    assignments = assign_blocks(block_costs, num_workers)
+
+    assert len(assignments) == num_workers
+    assert sorted(block for blocks in assignments for block in blocks) == list(range(50))
+    for blocks in assignments:
+        # Every worker processes its blocks longest first
+        assert list(block_costs[blocks]) == sorted(block_costs[blocks], reverse=True)
+    # The busiest worker got its last block while it was the least loaded one,
+    # so it exceeds the average load by at most that block
+    loads = [block_costs[blocks].sum() for blocks in assignments]
+    busiest = assignments[int(np.argmax(loads))]
+    assert max(loads) <= block_costs.sum() / num_workers + block_costs[busiest[-1]]
+
+
+def test_more_workers_than_blocks():
+    assignments = assign_blocks(np.array([3.0, 1.0]), 4)
+
+    assert sorted(map(len, assignments)) == [0, 0, 1, 1]
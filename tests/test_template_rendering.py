@@ -0,0 +1,77 @@
+"""
+Test the template rendering of subset selection.
+
+The built-in templates are rendered by Python formatters instead of Jinja; their
+output must match Jinja's for normal rows, missing columns and missing keys.
+"""
+
+from pathlib import Path
+import sys
+
+import pytest
+
+jinja2 = pytest.importorskip("jinja2")
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scripts.subset_selection.utils.template_rendering import (  # noqa: E402
+    CONVERSATION_TEMPLATE,
+    DEFAULT_TEMPLATE,
+    QA_TEMPLATE,
+    RENDERED_TEXT_COLUMN,
+    render_batch,
+)
+
+MESSAGES = [
+    [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+    ],
+    [{"role": "user"}, {"content": "No role"}, {"role": "assistant", "content": None}],
+    [],
+]
+
+BATCHES = {
+    DEFAULT_TEMPLATE: [
+        {"text": ["plain", "", 42, None]},
+        {"other": ["a", "b"]},
+    ],
+    CONVERSATION_TEMPLATE: [
+        {"messages": MESSAGES},
+        {"text": ["no messages", "at all"]},
+    ],
+    QA_TEMPLATE: [
+        {"question": ["Why?", None], "answer": ["Because.", 3.5]},
+        {"question": ["Only a question", "Another one"]},
+        {"answer": ["Only an answer"]},
+    ],
+}
+
+
+def jinja_render(batch, template_source):
+    template = jinja2.Template(template_source)
+    num_rows = len(next(iter(batch.values())))
+    return [
+        template.render(**{name: column[i] for name, column in batch.items()})
+        for i in range(num_rows)
+    ]
+
+
+@pytest.mark.parametrize(
+    "template_source, batch",
+    [
+        (template_source, batch)
+        for template_source, batches in BATCHES.items()
+        for batch in batches
+    ],
+)
+def test_fast_formatters_match_jinja(template_source, batch):
+    rendered = render_batch(batch, template_source)[RENDERED_TEXT_COLUMN]
+    assert rendered == jinja_render(batch, template_source)
+
+
+def test_other_templates_render_with_jinja():
+    batch = {"title": ["A", "B"], "body": ["x", "y"]}
+    template_source = "{{ title | upper }}: {{ body }}"
+    assert render_batch(batch, template_source)[RENDERED_TEXT_COLUMN] == ["A: x", "B: y"]